@@ -0,0 +1,142 @@
+# Shared HTTP sessions for Tinkoff API clients
+# Одна сессия на весь запуск: соединения (TLS, keep-alive) переиспользуются
+import logging
+import threading
+
+import aiohttp
+import requests
+import tinvest
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from configuration import Config
+
+logger = logging.getLogger("ApiClient")
+logger.setLevel(logging.INFO)
+
+
+class ConnectionCounter:
+    """Счетчик открытых соединений - для оценки пользы от пула"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.opened = 0
+
+    def increment(self):
+        with self._lock:
+            self.opened += 1
+
+
+connections = ConnectionCounter()
+
+
+class _CountingHTTPConnectionPool(HTTPConnectionPool):
+    def _new_conn(self):
+        connections.increment()
+        return super()._new_conn()
+
+
+class _CountingHTTPSConnectionPool(HTTPSConnectionPool):
+    def _new_conn(self):
+        connections.increment()
+        return super()._new_conn()
+
+
+class PooledHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter, считающий новые соединения в пуле"""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': _CountingHTTPConnectionPool,
+            'https': _CountingHTTPSConnectionPool,
+        }
+
+
+class PooledSession(requests.Session):
+    """Сессия requests с пулом соединений и таймаутом по умолчанию"""
+
+    def __init__(self, timeout, pool_size):
+        super().__init__()
+        self.timeout = timeout
+        adapter = PooledHTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.mount('https://', adapter)
+        self.mount('http://', adapter)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return super().request(method, url, **kwargs)
+
+
+class SyncClient(tinvest.SyncClient):
+    """tinvest.SyncClient с адресом API, например, fake_server.py"""
+
+    def __init__(self, token, *, base_url=None, **kwargs):
+        super().__init__(token, **kwargs)
+        if base_url:
+            self._base_url = base_url.rstrip('/')
+
+
+class AsyncClient(tinvest.AsyncClient):
+    """tinvest.AsyncClient с адресом API, например, fake_server.py"""
+
+    def __init__(self, token, *, base_url=None, **kwargs):
+        super().__init__(token, **kwargs)
+        if base_url:
+            self._base_url = base_url.rstrip('/')
+
+
+_sync_client = None
+_sync_client_lock = threading.Lock()
+
+
+def get_sync_client():
+    """Возвращает общий для всего запуска tinvest.SyncClient
+
+    Returns:
+        SyncClient: клиент с пулом соединений
+    """
+    global _sync_client
+    with _sync_client_lock:
+        if _sync_client is None:
+            logger.debug("Creating shared API client")
+            session = PooledSession(config.api_timeout, config.api_pool_size)
+            _sync_client = SyncClient(config.token, session=session, base_url=config.api_url)
+    return _sync_client
+
+
+def make_async_client(limit=None):
+    """Создает AsyncClient с общими настройками сессии
+    Вызывать только внутри работающего event loop.
+
+    Args:
+        limit (int, optional): максимальное количество соединений в пуле
+
+    Returns:
+        AsyncClient: клиент
+    """
+    return AsyncClient(config.token, session=make_async_session(limit), base_url=config.api_url)
+
+
+def make_async_session(limit=None):
+    """Создает aiohttp-сессию для tinvest.AsyncClient
+    Вызывать только внутри работающего event loop.
+
+    Args:
+        limit (int, optional): максимальное количество соединений в пуле
+
+    Returns:
+        aiohttp.ClientSession: сессия с общими настройками и счетчиком соединений
+    """
+    async def on_connection_create_end(session, context, params):
+        connections.increment()
+
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_connection_create_end.append(on_connection_create_end)
+    connector = aiohttp.TCPConnector(limit=limit or config.api_pool_size)
+    timeout = aiohttp.ClientTimeout(total=config.api_timeout)
+    return aiohttp.ClientSession(connector=connector, timeout=timeout,
+                                 trace_configs=[trace_config])
+
+
+config = Config()
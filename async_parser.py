@@ -0,0 +1,184 @@
+# Concurrent prefetch of market data from Tinkoff API
+# Заполняет локальные кэши (database.py) до начала расчетов,
+# после чего синхронные функции data_parser.py берут данные из кэша
+import asyncio
+import logging
+
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+import aiohttp
+import tinvest
+from dateutil.relativedelta import relativedelta
+
+import api_client
+import market_data
+from recorder import recorder
+
+logger = logging.getLogger("AsyncParser")
+logger.setLevel(logging.INFO)
+
+max_concurrency = 8  # одновременных запросов к API
+max_candles_range = timedelta(days=365)  # ограничение API для дневных свечей
+operations_range = relativedelta(months=3)  # период операций в одном запросе
+operations_retries = 3  # повторов запроса операций за период после ошибки
+operations_retry_delay = 2  # секунд, растет с каждым повтором
+# ошибки сети и сервера, после которых запрос операций повторяется
+retry_errors = (asyncio.TimeoutError, aiohttp.ClientError,
+                tinvest.TooManyRequestsError, tinvest.UnexpectedError)
+
+
+async def _request(semaphore, endpoint, method, *args, **kwargs):
+    # выполняет запрос, ограничивая количество одновременных запросов
+    async with semaphore:
+        return await recorder.call_async(endpoint, method, *args, **kwargs)
+
+
+# Загрузчики возвращают функцию записи результата в базу: все результаты
+# записываются после завершения запросов одной транзакцией, а не во время загрузки
+
+async def _fetch_instrument(client, semaphore, figi):
+    result = await _request(semaphore, 'market', client.get_market_search_by_figi, figi)
+    return lambda: market_data.database.put_instrument(result.payload)
+
+
+async def _fetch_market_price(client, semaphore, figi):
+    result = await _request(semaphore, 'market', client.get_market_orderbook, figi, 0)
+    return lambda: market_data.database.put_market_price(figi, result.payload.last_price)
+
+
+def _history_ranges(dates):
+    # разбивает период от первой до последней даты на интервалы,
+    # которые API отдает одним запросом дневных свечей
+    date_from = min(dates)
+    date_to = max(dates) + timedelta(days=1)
+    while date_from < date_to:
+        range_to = min(date_from + max_candles_range, date_to)
+        yield date_from, range_to
+        date_from = range_to
+
+
+async def _fetch_history_range(client, semaphore, figi, date_from, date_to, dates):
+    result = await _request(semaphore, 'market', client.get_market_candles,
+                            figi, date_from, date_to, tinvest.CandleResolution.day)
+    candles = [market_data.candle_row(candle) for candle in result.payload.candles]
+    logger.debug(f"{len(candles)} candles for {figi} "
+                 f"from {date_from:%Y-%m-%d} to {date_to:%Y-%m-%d}")
+
+    def store():
+        market_data.database.put_candles(figi, candles)
+        candle_dates = {candle[0] for candle in candles}
+        # торгов в эти дни не было (например, день IPO); за последние дни свеча может появиться позже
+        loaded_to = min(date_to, market_data.missing_candles_from())
+        market_data.database.put_candle_prices((date, figi, None) for date in dates
+                                               if date_from <= date < loaded_to and date not in candle_dates)
+        if date_from < loaded_to:
+            market_data.mark_history_loaded(figi, date_from, loaded_to)
+    return store
+
+
+async def _prefetch(figis, history_dates, concurrency):
+    database = market_data.database
+    semaphore = asyncio.Semaphore(concurrency)
+    tasks = []
+    async with api_client.make_async_client(limit=concurrency) as client:
+        for figi in figis:
+            if not database.get_instrument_by_figi(figi):
+                tasks.append(_fetch_instrument(client, semaphore, figi))
+            if not database.get_market_price_by_figi(figi):
+                tasks.append(_fetch_market_price(client, semaphore, figi))
+        missing_dates = defaultdict(list)
+        for figi, date in history_dates:
+            if not database.get_candle_price(date, figi) and \
+                    not database.is_candle_missing(date, figi):
+                missing_dates[figi].append(date)
+        for figi, dates in missing_dates.items():
+            for date_from, date_to in _history_ranges(dates):
+                tasks.append(_fetch_history_range(client, semaphore, figi,
+                                                  date_from, date_to, dates))
+        logger.info(f"{len(tasks)} market data requests to prefetch")
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+    with database.batch():
+        for result in results:
+            if isinstance(result, Exception):
+                # не страшно - данные будут запрошены синхронно при расчете
+                logger.warning(f"Prefetch request failed: {result!r}")
+            else:
+                result()
+
+
+def _operation_ranges(date_from, date_to):
+    # разбивает период на кварталы - каждый загружается отдельным запросом
+    while date_from < date_to:
+        range_to = min(date_from + operations_range, date_to)
+        yield date_from, range_to
+        date_from = range_to
+
+
+async def _fetch_operations_range(client, semaphore, broker_account_id, date_from, date_to):
+    # ошибка в одном периоде не влияет на остальные - повторяется только он
+    for attempt in range(operations_retries + 1):
+        try:
+            result = await _request(semaphore, 'operations', client.get_operations,
+                                    from_=date_from, to=date_to, broker_account_id=broker_account_id)
+            return date_from, date_to, result.payload.operations
+        except retry_errors as e:
+            if attempt == operations_retries:
+                return date_from, date_to, e
+            logger.warning(f"Operations from {date_from:%Y-%m-%d} to {date_to:%Y-%m-%d} "
+                           f"failed: {e!r}, retrying")
+            await asyncio.sleep(operations_retry_delay * (attempt + 1))
+
+
+async def _load_operations(broker_account_id, date_from, date_to, on_range, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+    failed = []
+    async with api_client.make_async_client(limit=concurrency) as client:
+        tasks = [_fetch_operations_range(client, semaphore, broker_account_id, range_from, range_to)
+                 for range_from, range_to in _operation_ranges(date_from, date_to)]
+        logger.info(f"{len(tasks)} operations requests")
+        # периоды обрабатываются по мере загрузки, а не после загрузки всех
+        for task in asyncio.as_completed(tasks):
+            range_from, range_to, result = await task
+            if isinstance(result, Exception):
+                logger.error(f"Operations from {range_from:%Y-%m-%d} to {range_to:%Y-%m-%d} "
+                             f"not loaded: {result!r}")
+                failed.append((range_from, range_to))
+            else:
+                on_range(range_from, range_to, result)
+    return sorted(failed)
+
+
+def load_operations(broker_account_id, date_from, date_to, on_range, concurrency=max_concurrency):
+    """Параллельно загружает операции счета по кварталам
+
+    Args:
+        broker_account_id (str): номер счета
+        date_from (datetime): начало периода
+        date_to (datetime): конец периода
+        on_range (callable): вызывается для каждого загруженного периода
+            с аргументами (начало, конец, список операций)
+        concurrency (int): максимальное количество одновременных запросов
+
+    Returns:
+        list: периоды (начало, конец), которые не удалось загрузить
+    """
+    return asyncio.run(_load_operations(broker_account_id, date_from, date_to, on_range, concurrency))
+
+
+def prefetch_market_data(figis, history_dates=(), concurrency=max_concurrency):
+    """Параллельно запрашивает рыночные данные и сохраняет их в кэш
+
+    Args:
+        figis (iterable): figi, для которых нужны инструмент и текущая цена
+        history_dates (iterable): пары (figi, дата) для исторических цен
+        concurrency (int): максимальное количество одновременных запросов
+    """
+    figis = set(figis)
+    history_dates = {(figi, datetime(date.year, date.month, date.day))
+                     for figi, date in history_dates}
+    if not figis and not history_dates:
+        return
+    logger.info('prefetching market data..')
+    asyncio.run(_prefetch(figis, history_dates, concurrency))
+    logger.info('..market data prefetched')
@@ -0,0 +1,103 @@
+# Benchmark: performance.xirr / xirr_batch against the previous scipy-based XIRR
+# Запуск из корня проекта: python benchmarks/bench_xirr.py [--series 200] [--flows 500]
+import argparse
+import os
+import random
+import sys
+import time
+
+from datetime import datetime, timedelta
+
+import numpy as np
+import scipy.optimize
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import performance  # noqa: E402
+
+
+# прежняя реализация из main.py - для сравнения скорости и результатов
+def legacy_xnpv(valuesPerDate, rate):
+    # Calculate the irregular net present value.
+    days_per_year = 365.0
+    if rate == -1.0:
+        return float('inf')
+
+    t0 = min(valuesPerDate.keys())
+    if rate <= -1.0:
+        return sum([-abs(vi) / (-1.0 - rate)**((ti - t0).days / days_per_year) for ti, vi in valuesPerDate.items()])
+    return sum([vi / (1.0 + rate)**((ti - t0).days / days_per_year) for ti, vi in valuesPerDate.items()])
+
+
+def legacy_xirr(valuesPerDate):
+    # Calculate the irregular internal rate of return
+    if not valuesPerDate:
+        return None
+    if all(v >= 0 for v in valuesPerDate.values()):
+        return float("inf")
+    if all(v <= 0 for v in valuesPerDate.values()):
+        return -float("inf")
+
+    result = None
+    try:
+        result = scipy.optimize.newton(lambda r: legacy_xnpv(valuesPerDate, r), 0)
+    except (RuntimeError, OverflowError, ValueError):    # Failed to converge?
+        pass
+
+    if not result:
+        try:
+            result = scipy.optimize.brentq(lambda r: legacy_xnpv(valuesPerDate, r), -0.999999999999999, 1e20,
+                                           maxiter=10**6)
+        except Exception:
+            pass
+
+    if not isinstance(result, complex):
+        return result
+    else:
+        return None
+
+
+def make_series(rng, flows):
+    # пополнения по датам и стоимость портфеля в последний день
+    start = datetime(2015, 1, 1)
+    days = sorted(rng.sample(range(1, 3650), flows - 1))
+    series = {start.date(): -rng.randrange(10000, 100000)}
+    for day in days:
+        series[(start + timedelta(days=day)).date()] = -rng.randrange(-20000, 100000)
+    last = (start + timedelta(days=3650)).date()
+    series[last] = int(-sum(series.values()) * rng.uniform(0.7, 2.5))
+    return series
+
+
+def measure(function, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = function()
+        best = min(best, time.perf_counter() - started)
+    return best, result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Сравнение скорости расчета XIRR')
+    parser.add_argument('--series', type=int, default=200, help='количество рядов платежей')
+    parser.add_argument('--flows', type=int, default=500, help='платежей в ряду')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    rng = random.Random(1)
+    all_series = [make_series(rng, args.flows) for _ in range(args.series)]
+
+    legacy_time, legacy = measure(lambda: [legacy_xirr(series) for series in all_series], args.repeat)
+    single_time, single = measure(lambda: [performance.xirr(list(series), list(series.values()))
+                                           for series in all_series], args.repeat)
+    batch_time, batch = measure(lambda: performance.xirr_batch([(list(series), list(series.values()))
+                                                                for series in all_series]), args.repeat)
+
+    difference = max(abs(a - b) for a, b in zip(legacy, batch))
+    print(f"{args.series} series x {args.flows} flows")
+    print(f"legacy scipy XIRR:  {legacy_time * 1000:9.1f} ms")
+    print(f"performance.xirr:   {single_time * 1000:9.1f} ms  (x{legacy_time / single_time:.1f})")
+    print(f"xirr_batch:         {batch_time * 1000:9.1f} ms  (x{legacy_time / batch_time:.1f})")
+    print(f"max difference from legacy: {difference:.2e}")
+    assert np.allclose(single, batch, rtol=1e-8, atol=1e-10)
@@ -1,6 +1,8 @@
+from collections import defaultdict, deque
 from dataclasses import dataclass
 from datetime import datetime, timedelta
 from decimal import Decimal
+from enum import Enum
 
 from tinvest import schemas as tschemas
 
@@ -28,6 +30,7 @@ class PortfolioPosition:
     today_market_rate: Decimal = 1  # Курс валюты по бирже
     today_cb_rate: Decimal = 1  # Курс валюты по центробанку
     instrument: tschemas.MarketInstrument = None
+    ledger: 'FifoLedger' = None  # партии бумаг в портфеле (FIFO)
 
     @staticmethod
     def from_api_data(pp: tschemas.PortfolioPosition,
@@ -148,3 +151,205 @@ class PortfolioOperation:
     def op_in_last_365_days(self):
         tz_info = self.op_date.tzinfo
         return self.op_date > datetime.now(tz_info) - timedelta(days=365)
+
+
+@dataclass
+class TaxLot:
+    """Партия бумаг, купленных одной операцией по одной цене"""
+    quantity: int
+    price: Decimal  # цена одной бумаги в рублях
+    date: datetime = None
+
+
+class FifoLedger:
+    """Учет партий бумаг по принципу FIFO (первым купили - первым продали)
+
+    Хранит партии (количество, цена в рублях, дата) вместо списка
+    отдельных бумаг, поэтому время работы зависит от количества операций,
+    а не от количества бумаг.
+    """
+
+    def __init__(self):
+        self.lots = deque()
+        self.quantity = 0
+        self.cost = Decimal(0)
+
+    def buy(self, quantity, price, date=None):
+        """Добавляет партию купленных бумаг
+
+        Args:
+            quantity (int): количество бумаг
+            price (Decimal): цена одной бумаги в рублях
+            date (datetime, optional): дата покупки
+        """
+        if quantity <= 0:
+            return
+        self.lots.append(TaxLot(quantity, price, date))
+        self.quantity += quantity
+        self.cost += price * quantity
+
+    def sell(self, quantity):
+        """Списывает проданные бумаги из самых старых партий
+
+        Args:
+            quantity (int): количество проданных бумаг
+
+        Returns:
+            list: списанные партии (TaxLot), последняя может быть частичной
+        """
+        sold = []
+        while quantity > 0 and self.lots:
+            lot = self.lots[0]
+            if lot.quantity <= quantity:
+                self.lots.popleft()
+                sold_lot = lot
+            else:
+                lot.quantity -= quantity
+                sold_lot = TaxLot(quantity, lot.price, lot.date)
+            quantity -= sold_lot.quantity
+            self.quantity -= sold_lot.quantity
+            self.cost -= sold_lot.price * sold_lot.quantity
+            sold.append(sold_lot)
+        if not self.lots:
+            # избавляемся от накопленной погрешности
+            self.cost = Decimal(0)
+        return sold
+
+    @property
+    def average_price(self):
+        """Средняя цена одной бумаги из оставшихся партий
+
+        Returns:
+            Decimal: средняя цена или 0, если бумаг не осталось
+        """
+        if self.quantity == 0:
+            return 0
+        return self.cost / self.quantity
+
+
+class OperationsIndex:
+    """Операции счета, сгруппированные по figi и по типу операции
+
+    Строится один раз на счет, чтобы расчеты по отдельной бумаге
+    не просматривали все операции заново.
+    Внутри групп сохраняется порядок исходного списка.
+    """
+
+    def __init__(self, operations, figi_attr='figi', type_attr='operation_type'):
+        self._figi = defaultdict(list)
+        self._type = defaultdict(list)
+        self._order = {}
+        for number, operation in enumerate(operations):
+            self._order[id(operation)] = number
+            op_type = getattr(operation, type_attr)
+            if isinstance(op_type, Enum):
+                # str-перечисления tinvest хешируются по имени, а не по значению
+                op_type = op_type.value
+            self._figi[getattr(operation, figi_attr)].append(operation)
+            self._type[op_type].append(operation)
+        self._type_attr = type_attr
+
+    def by_figi(self, *figis, op_types=None):
+        """Операции по бумагам
+
+        Args:
+            figis (str): один или несколько figi
+            op_types (iterable, optional): оставить только эти типы операций
+
+        Returns:
+            list: операции в порядке исходного списка
+        """
+        found = []
+        for figi in figis:
+            found += self._figi.get(figi, [])
+        if len(figis) > 1:
+            found.sort(key=lambda operation: self._order[id(operation)])
+        if op_types is not None:
+            found = [operation for operation in found
+                     if getattr(operation, self._type_attr) in op_types]
+        return found
+
+    def by_type(self, op_type):
+        """Операции заданного типа в порядке исходного списка"""
+        return self._type.get(op_type, [])
+
+    def __len__(self):
+        return len(self._order)
+
+    @property
+    def figis(self):
+        return [figi for figi in self._figi.keys() if figi is not None]
+
+
+class OperationsPivot:
+    """Суммы операций счета, собранные за один проход по операциям
+
+    Ключ ячейки - (тип операции, валюта, год, месяц, figi), в ячейке - сумма
+    платежей в валюте, сумма в рублях по курсу ЦБ и количество операций.
+    Для типов из daily_types суммы в рублях дополнительно собираются по дням -
+    это денежные потоки для XIRR.
+    Операции с нулевым платежом не учитываются.
+    """
+
+    def __init__(self, operations, daily_types=('PayIn', 'PayOut')):
+        self.cells = defaultdict(lambda: [Decimal(0), Decimal(0), 0])
+        self.daily = defaultdict(Decimal)  # (тип, валюта, дата) -> сумма в рублях
+        for operation in operations:
+            if operation.op_payment == 0:
+                continue
+            op_type = operation.op_type
+            if isinstance(op_type, Enum):
+                op_type = op_type.value
+            date = operation.op_date
+            cell = self.cells[(op_type, operation.op_currency, date.year, date.month, operation.op_figi)]
+            cell[0] += operation.op_payment
+            cell[1] += operation.op_payment_rub
+            cell[2] += 1
+            if op_type in daily_types:
+                self.daily[(op_type, operation.op_currency, date.date())] += operation.op_payment_rub
+
+    def _select(self, op_types, currencies, years):
+        for (op_type, currency, year, month, figi), cell in self.cells.items():
+            if op_type in op_types and (currencies is None or currency in currencies) \
+                    and (years is None or year in years):
+                yield (op_type, currency, year, month, figi), cell
+
+    def total_rub(self, *op_types, currencies=None, years=None):
+        """Сумма операций в рублях
+
+        Args:
+            op_types (str): типы операций
+            currencies (iterable, optional): только операции в этих валютах
+            years (iterable, optional): только операции этих лет
+
+        Returns:
+            Decimal: сумма
+        """
+        return sum((cell[1] for key, cell in self._select(op_types, currencies, years)), Decimal(0))
+
+    def currencies(self, *op_types):
+        """Валюты операций заданных типов"""
+        return sorted({key[1] for key, cell in self._select(op_types, None, None)})
+
+    def by_year(self, op_type, currency):
+        """Суммы платежей в валюте по годам
+
+        Returns:
+            dict: {год: сумма}
+        """
+        years = defaultdict(Decimal)
+        for key, cell in self._select((op_type,), (currency,), None):
+            years[key[2]] += cell[0]
+        return dict(years)
+
+    def daily_flows_rub(self, *op_types, currencies=None):
+        """Суммы операций в рублях по дням
+
+        Returns:
+            dict: {дата: сумма} в порядке дат
+        """
+        flows = defaultdict(Decimal)
+        for (op_type, currency, date), value in self.daily.items():
+            if op_type in op_types and (currencies is None or currency in currencies):
+                flows[date] += value
+        return dict(sorted(flows.items()))
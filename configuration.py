@@ -98,6 +98,48 @@ class Config:
                               0, 0, 0, tzinfo=timezone(self.__config['timezone']))
         return start_date
 
+    @property
+    def api_timeout(self):
+        """Таймаут запросов к API в секундах, по умолчанию - 30"""
+        return float(self.__config.get('api timeout', 30))
+
+    @property
+    def api_pool_size(self):
+        """Размер пула соединений с API, по умолчанию - 10"""
+        return int(self.__config.get('api pool size', 10))
+
+    @property
+    def api_url(self):
+        """Адрес API вместо https://api-invest.tinkoff.ru/openapi, по умолчанию - не задан"""
+        return self.__config.get('api url')
+
+    @property
+    def cbr_url(self):
+        """Адрес сервиса курсов вместо http://www.cbr.ru/scripts/, по умолчанию - не задан"""
+        return self.__config.get('cbr url')
+
+    @property
+    def operations_overlap_days(self):
+        """За сколько дней до последней завершенной операции загружать операции заново,
+        по умолчанию - 7"""
+        return int(self.__config.get('operations overlap days', 7))
+
+    @property
+    def rate_matrix(self):
+        """Пересчитывать операции в рубли через матрицу курсов, по умолчанию - нет"""
+        return self.parse_boolean(self.__config.get('rate matrix', False))
+
+    @property
+    def daily_valuation(self):
+        """Восстанавливать стоимость портфеля по дням, по умолчанию - да"""
+        return self.parse_boolean(self.__config.get('daily valuation', True))
+
+    @property
+    def xirr_periods(self):
+        """Строить лист XIRR по годам, кварталам и скользящим 12 месяцам
+        (нужна стоимость портфеля по дням), по умолчанию - да"""
+        return self.parse_boolean(self.__config.get('xirr periods', True))
+
     @property
     def now_date(self):
         """Возвращает текущую дату.
@@ -10,15 +10,18 @@ currencies_data = {
         'name': 'Доллар США',
         'num_format': '## ### ##0.00   [$$-409]',
         'figi': 'BBG0013HGFT4',
+        'cbr_id': 'R01235',
     },
     'EUR': {
         'name': 'Евро',
         'num_format': '## ### ##0.00   [$€-x-euro1]',
         'figi': 'BBG0013HJJ31',
+        'cbr_id': 'R01239',
     },
     'CHF': {
         'name': 'Швейцарский франк',
         'num_format': '## ### ##0.00   [$CHF-fr-CH]',
+        'cbr_id': 'R01775',
         # TODO: find figi for CHFRUB
     },
 }
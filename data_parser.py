@@ -1,21 +1,27 @@
 # get all necessary data from Tinkoff API
 import decimal
 import logging
+import os
 
-import time
 from pytz import timezone
 from datetime import datetime, timedelta
 from dateutil.relativedelta import relativedelta
 
 from decimal import Decimal
+from xml.etree import ElementTree
 
 from configuration import Config
 
+import pycbrf.rates
+import pycbrf.toolbox
 import tinvest
 from pycbrf.rates import ExchangeRate
-from pycbrf.toolbox import ExchangeRates
+from pycbrf.utils import WithRequests
 
-from database import Database
+import api_client
+import async_parser
+from market_data import candle_row, database, history_loaded, is_history_loaded, missing_candles_from
+from recorder import recorder
 from currencies import currencies_data, supported_currencies
 
 logger = logging.getLogger("Parser")
@@ -25,18 +31,35 @@ logger.setLevel(logging.INFO)
 ruble = ExchangeRate(code='RUB', value=Decimal(1), rate=Decimal(1), name='Рубль',
                      id='KOSTYL', num='KOSTYL', par=Decimal(1))
 delay_time = 0.1
+rates_seed_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'rates_by_date.csv')
+# адрес сервиса курсов ЦБ, см. set_cbr_url()
+cbr_url = pycbrf.rates.URL_BASE
 
 
 def get_exchange_rate_db(date=datetime.now(), currency="USD"):
     rate = database.get_exchange_rate(date, currency)
     if rate:
         return rate
+    if database.is_rate_missing(date, currency):
+        # на эту дату ЦБ курс не публиковал - действует последний опубликованный
+        rate = database.get_latest_exchange_rate(date, currency)
+        if rate:
+            return rate
     # Если курс не найден
     logger.info(f"Need to get rates for {date} from CB")
     rates = get_exchange_rate(date)
-    for curr in supported_currencies:
-        curr_rate = rates[curr].value
-        database.put_exchange_rate(date, curr, curr_rate)
+    date_received = rates.date_received
+    no_publication = (date_received.date() < datetime(date.year, date.month, date.day).date()
+                      < datetime.now().date())
+    with database.batch():
+        for curr in supported_currencies:
+            curr_rate = rates[curr].value
+            if no_publication:
+                # прошедшая дата без публикации - запоминаем, чтобы больше не запрашивать
+                database.put_exchange_rate(date_received, curr, curr_rate)
+                database.put_missing_rate(date, curr)
+            else:
+                database.put_exchange_rate(date, curr, curr_rate)
     return get_exchange_rate_db(date, currency)
 
 
@@ -47,12 +70,134 @@ def get_exchange_rates_for_date_db(date):
     return rates
 
 
+def get_exchange_rates_for_dates(dates):
+    """Курсы всех поддерживаемых валют на набор дат.
+    Недостающие в базе курсы загружаются одним запросом на валюту,
+    оставшиеся пропуски - по одной дате.
+
+    Args:
+        dates (iterable): даты (date или datetime)
+
+    Returns:
+        dict: {datetime.date: {валюта: курс}}
+    """
+    dates = {datetime(date.year, date.month, date.day).date() for date in dates}
+
+    def find_gaps(rates):
+        return sorted(date for date in dates
+                      if len(rates.get(date, {})) < len(supported_currencies))
+
+    rates = database.get_exchange_rates_for_dates(dates, supported_currencies)
+    gaps = find_gaps(rates)
+    if gaps:
+        logger.info(f"{len(gaps)} dates without CB rates in the local database")
+        load_exchange_rates(gaps[0], gaps[-1])
+        rates = database.get_exchange_rates_for_dates(dates, supported_currencies)
+        for date in find_gaps(rates):
+            rates[date] = get_exchange_rates_for_date_db(date)
+    return rates
+
+
+def set_cbr_url(url):
+    """Задает адрес сервиса курсов ЦБ, например, fake_server.py
+
+    Args:
+        url (str): адрес вместо http://www.cbr.ru/scripts/
+    """
+    global cbr_url
+    cbr_url = url
+
+
+class ExchangeRates(pycbrf.toolbox.ExchangeRates):
+    """Курсы ЦБ на дату - с адреса cbr_url.
+    Имя класса то же, что в pycbrf: оно входит в ключи записанных ответов recorder.
+    """
+
+    @classmethod
+    def _get_data(cls, on_date=None, locale_en=False):
+        url = f"{cbr_url}XML_daily{'_eng' if locale_en else ''}.asp"
+        if on_date:
+            url = f"{url}?date_req={on_date.strftime('%d/%m/%Y')}"
+        logger.debug(f'Getting exchange rates from {url} ...')
+        return cls._get_response(url).content
+
+
 def get_exchange_rate(date):
-    rate = ExchangeRates(date)
+    rate = recorder.call(None, ExchangeRates, date)
     rate.rates.append(ruble)
     return rate
 
 
+class ExchangeRatesDynamic(WithRequests):
+    """Динамика курса одной валюты ЦБ за период - одним запросом"""
+
+    def __init__(self, cbr_id, date_from, date_to):
+        url = (f"{cbr_url}XML_dynamic.asp?date_req1={date_from.strftime('%d/%m/%Y')}"
+               f"&date_req2={date_to.strftime('%d/%m/%Y')}&VAL_NM_RQ={cbr_id}")
+        logger.debug(f'Getting exchange rates dynamic from {url} ...')
+        response = self._get_response(url)
+        response.raise_for_status()
+        self.rates = self._parse(response.content)
+
+    @staticmethod
+    def _parse(data):
+        # {дата установления курса: курс за 1 единицу валюты}
+        rates = {}
+        for record in ElementTree.fromstring(data):
+            date = datetime.strptime(record.attrib['Date'], '%d.%m.%Y')
+            nominal = Decimal(record.find('Nominal').text)
+            value = Decimal(record.find('Value').text.replace(',', '.'))
+            rates[date] = value / nominal
+        return rates
+
+
+def load_exchange_rates(date_from, date_to=None):
+    """Загружает в базу курсы ЦБ за период, которых там еще нет.
+    По одному запросу на валюту - вместо запроса на каждый день.
+    В выходные и праздники курс ЦБ не устанавливается - для этих дней
+    записывается последний установленный курс.
+
+    Args:
+        date_from (datetime): начало периода
+        date_to (datetime, optional): конец периода, по умолчанию - сегодня
+    """
+    date_from = datetime(date_from.year, date_from.month, date_from.day)
+    date_to = date_to or datetime.now()
+    date_to = datetime(date_to.year, date_to.month, date_to.day)
+    days = [date_from + timedelta(days=n) for n in range((date_to - date_from).days + 1)]
+
+    rows = []
+    for currency, data in currencies_data.items():
+        # пропуски у каждой валюты свои: валюты, курсы которых уже есть
+        # (например, из rates_by_date.csv), не запрашиваются
+        known = database.get_exchange_rate_dates(currency, date_from, date_to)
+        missing = [day for day in days if day.strftime("%Y-%m-%d") not in known]
+        if not missing:
+            continue
+        load_from, load_to = missing[0], missing[-1]
+        load_days = [day for day in days if load_from <= day <= load_to]
+        if 'cbr_id' not in data:
+            # рубль
+            rows += [(day, currency, Decimal(1)) for day in load_days]
+            continue
+        logger.info(f"Loading CB {currency} rates from {load_from:%Y-%m-%d} to {load_to:%Y-%m-%d}")
+        try:
+            # с запасом назад - чтобы был курс, действующий на первый день
+            dynamic = recorder.call(None, ExchangeRatesDynamic, data['cbr_id'],
+                                    load_from - timedelta(days=14), load_to)
+        except Exception as e:
+            # не страшно - курсы будут запрошены по одному дню
+            logger.warning(f"Could not load {currency} rates dynamic from CB: {e}")
+            continue
+        rate = None
+        for day in sorted(set(dynamic.rates) | set(load_days)):
+            rate = dynamic.rates.get(day, rate)
+            if day >= load_from and rate is not None:
+                rows.append((day, currency, rate))
+    if rows:
+        database.put_exchange_rates(rows)
+
+
 def calc_investing_period():
     start_date = config.start_date.replace(tzinfo=None)
     current_date = config.now_date
@@ -64,8 +209,8 @@ def calc_investing_period():
 
 def get_accounts():
     logger.info('getting accounts')
-    client = tinvest.SyncClient(config.token)
-    accounts = client.get_accounts()
+    client = api_client.get_sync_client()
+    accounts = recorder.call('portfolio', client.get_accounts)
     logging.debug(accounts)
     logger.info('accounts received')
     # проверяем/создаем разделы для счетов в конфигурации
@@ -77,36 +222,84 @@ def get_accounts():
 
 def get_api_data(broker_account_id):
     logger.info("authorization..")
-    client = tinvest.SyncClient(config.token)
+    client = api_client.get_sync_client()
     logger.info("authorization success")
-    positions = client.get_portfolio(broker_account_id=broker_account_id)
-    operations = client.get_operations(from_=config.start_date,
-                                       to=config.now_date,
-                                       broker_account_id=broker_account_id)
+    positions = recorder.call('portfolio', client.get_portfolio,
+                               broker_account_id=broker_account_id)
+    operations = get_operations(broker_account_id)
     market_rate_today = {}
     for currency, data in currencies_data.items():
         if 'figi' in data.keys():
             market_rate_today[currency] = get_current_market_price(figi=data['figi'], depth=0)
         else:
             market_rate_today[currency] = 1
-    currencies = client.get_portfolio_currencies(broker_account_id=broker_account_id)
+    currencies = recorder.call('portfolio', client.get_portfolio_currencies,
+                                broker_account_id=broker_account_id)
     logger.info("portfolio received")
 
     return positions, operations, market_rate_today, currencies
 
 
+def get_operations(broker_account_id):
+    """Операции счета с config.start_date.
+    Из API загружаются только операции после последней завершенной
+    (с запасом 'operations overlap days'), остальные берутся из базы.
+
+    Args:
+        broker_account_id (str): номер счета
+
+    Returns:
+        tinvest.OperationsResponse: ответ API со всеми операциями периода
+    """
+    start_date = config.start_date
+    now_date = config.now_date.astimezone()
+    state = database.get_operations_sync_state(broker_account_id)
+    if state is None or start_date < state[0]:
+        # локальной истории нет или нужен более ранний период - загружаем все
+        synced_from, watermark = start_date, None
+        date_from = start_date
+    else:
+        synced_from, watermark = state
+        date_from = max(synced_from, watermark - timedelta(days=config.operations_overlap_days))
+    logger.info(f"loading operations from {date_from:%Y-%m-%d}..")
+    loaded = []
+
+    def merge(range_from, range_to, operations):
+        database.replace_operations(broker_account_id, range_from, operations, range_to)
+        loaded.extend(operations)
+
+    failed = async_parser.load_operations(broker_account_id, date_from, now_date, merge)
+    if failed:
+        # последняя попытка - по одному запросу на период, при ошибке загрузка прерывается
+        client = api_client.get_sync_client()
+        for range_from, range_to in failed:
+            response = recorder.call('operations', client.get_operations,
+                                      from_=range_from,
+                                      to=range_to,
+                                      broker_account_id=broker_account_id)
+            merge(range_from, range_to, response.payload.operations)
+
+    in_progress = [op.date for op in loaded if op.status == tinvest.OperationStatus.progress]
+    if in_progress:
+        # следующая загрузка - с первой незавершенной операции
+        watermark = min(in_progress)
+    else:
+        watermark = max([op.date for op in loaded] + ([watermark] if watermark else [date_from]))
+    database.put_operations_sync_state(broker_account_id, synced_from, watermark)
+
+    operations = database.get_operations(broker_account_id, start_date, now_date)
+    logger.info(f"{len(loaded)} operations loaded, {len(operations)} operations in the period")
+    return tinvest.OperationsResponse(payload=tinvest.Operations(operations=operations),
+                                      trackingId='local', status='Ok')
+
+
 def get_current_market_price(figi, depth=0, max_age=10*60):
     price = database.get_market_price_by_figi(figi, max_age)
     if price:
         return price
-    try:
-        client = tinvest.SyncClient(config.token)
-        book = client.get_market_orderbook(figi=figi, depth=depth)
-        price = book.payload.last_price
-    except tinvest.exceptions.TooManyRequestsError:
-        logger.warn("Превышена частота запросов API. Пауза выполнения.")
-        time.sleep(0.5)
-        return get_current_market_price(figi, depth, max_age)
+    client = api_client.get_sync_client()
+    book = recorder.call('market', client.get_market_orderbook, figi=figi, depth=depth)
+    price = book.payload.last_price
     database.put_market_price(figi, price)
     return price
 
@@ -115,29 +308,33 @@ def get_figi_history_price(figi, date=datetime.now()):
     # возвращает историческую цену актива
     # опеределяется запросом свечи за день и усреднением верхней и нижней цены
     date = datetime(date.year, date.month, date.day)
-    if date == datetime.now().date():
+    if date.date() == datetime.now().date():
         return get_current_market_price(figi)
-    price = database.get_exchange_rate(date, figi)
+    price = database.get_candle_price(date, figi)
     if price:
         # Если цена есть в локальной базе - не надо запрашивать API
         return price
+    if is_history_loaded(figi, date) or database.is_candle_missing(date, figi):
+        # свечи за этот день уже запрашивались - торгов не было
+        logger.debug(f"No candle for {figi} on {date:%Y-%m-%d} in loaded history")
+        return None
     try:
         date_to = date + timedelta(days=1)
-        client = tinvest.SyncClient(config.token)
-        result = client.get_market_candles(figi, date, date_to, tinvest.CandleResolution.day)
-        price = (result.payload.candles[0].h+result.payload.candles[0].l)/2
-    except tinvest.exceptions.TooManyRequestsError:
-        logger.warning("Превышена частота запросов API. Пауза выполнения.")
-        time.sleep(0.5)
-        return get_figi_history_price(figi, date)
+        client = api_client.get_sync_client()
+        result = recorder.call('market', client.get_market_candles,
+                                figi, date, date_to, tinvest.CandleResolution.day)
+        candle = result.payload.candles[0]
     except IndexError:
         instrument = get_instrument_by_figi(figi)
         logger.error("Что-то не то со свечами! В этот день было IPO? Или размещение средств?")
         logger.error(f"{date} - {figi} - {instrument.ticker}")
         logger.error(result)
+        if date < missing_candles_from():
+            # запоминаем, чтобы не запрашивать этот день при каждом запуске
+            database.put_missing_candle(date, figi)
         return None
-    database.put_exchange_rate(date, figi, price)
-    return price
+    database.put_candles(figi, [candle_row(candle)])
+    return (candle.h + candle.l) / 2
 
 
 def get_position_type(figi, max_age=7*24*60*60):
@@ -154,13 +351,8 @@ def get_instrument_by_figi(figi, max_age=7*24*60*60):
         logger.debug(f"Instrument for {figi} found")
         return instrument
     logger.debug(f"Need to query instrument for {figi} from API")
-    try:
-        client = tinvest.SyncClient(config.token)
-        position_data = client.get_market_search_by_figi(figi)
-    except tinvest.exceptions.TooManyRequestsError:
-        logger.warn("Превышена частота запросов API. Пауза выполнения.")
-        time.sleep(0.5)
-        return get_instrument_by_figi(figi, max_age)
+    client = api_client.get_sync_client()
+    position_data = recorder.call('market', client.get_market_search_by_figi, figi)
     database.put_instrument(position_data.payload)
     return position_data.payload
 
@@ -172,5 +364,22 @@ def get_ticker_by_figi(figi, max_age=7*24*60*60):
     return ticker
 
 
+def open_database(db_file_name):
+    """Переключает парсер на другой файл базы
+
+    Args:
+        db_file_name (str): имя файла базы, ':memory:' - временная база в памяти
+    """
+    database.open_database_connection(db_file_name)
+    history_loaded.clear()
+    seed_exchange_rates()
+
+
+def seed_exchange_rates():
+    if database.count_exchange_rates() == 0 and os.path.isfile(rates_seed_file):
+        # первый запуск - заполняем базу курсами из файла, а не запросами к ЦБ
+        database.import_rates_csv(rates_seed_file)
+
+
 config = Config()
-database = Database()
+seed_exchange_rates()
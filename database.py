@@ -1,13 +1,180 @@
+import csv
 import sqlite3
-from datetime import datetime
+import sys
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timezone
 
 import logging
 from decimal import Decimal
-from tinvest.schemas import SearchMarketInstrument
+
+import numpy as np
+from pydantic.json import pydantic_encoder
+from tinvest.schemas import Operation, SearchMarketInstrument
+
+from memory_cache import LRUCache, MISSING
 
 db_logger = logging.getLogger("DB")
 db_logger.setLevel(logging.INFO)
 
+# Порядок колонок в файлах курсов вида rates_by_date.csv: дата, USD, EUR, RUB
+rates_csv_currencies = ('USD', 'EUR', 'RUB')
+
+# Сколько строк накапливать в batch() перед записью в базу
+batch_flush_size = 5000
+# Сколько секунд ждать, пока базу освободит другой процесс
+busy_timeout = 30
+
+# Размеры кэшей в памяти по таблицам, записей
+cache_sizes = {
+    'rates': 50000,
+    'rates_missing': 10000,
+    'candles': 50000,
+    'instruments': 2000,
+    'marketprice': 2000,
+}
+# Сколько секунд верить кэшу "записи нет": ее мог добавить другой процесс
+missing_ttl = 5
+
+
+schema_version_sql = "CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL);"
+
+
+def _migration_1_baseline(cursor):
+    # таблицы первых версий программы - в базах без schema_version они уже есть
+    cursor.execute("""CREATE TABLE IF NOT EXISTS rates (
+        date TEXT,
+        currency TEXT,
+        rate TEXT,
+        PRIMARY KEY (date, currency)
+    ) WITHOUT ROWID;""")
+    # индекс для поиска последнего курса на дату и выборок по периоду
+    cursor.execute("CREATE INDEX IF NOT EXISTS rates_currency_date ON rates (currency, date);")
+    # даты, на которые курс не публиковался (выходные и праздники)
+    cursor.execute("""CREATE TABLE IF NOT EXISTS rates_missing (
+        date TEXT,
+        currency TEXT,
+        PRIMARY KEY (date, currency)
+    ) WITHOUT ROWID;""")
+    cursor.execute("""CREATE TABLE IF NOT EXISTS instruments (
+        timestamp timestamp,
+        figi TEXT,
+        ticker TEXT,
+        name TEXT,
+        currency TEXT,
+        type TEXT,
+        lot INTEGER,
+        min_price_increment TEXT,
+        isin TEXT,
+        PRIMARY KEY (figi)
+    ) WITHOUT ROWID;""")
+    cursor.execute("""CREATE TABLE IF NOT EXISTS marketprice (
+        timestamp timestamp,
+        figi TEXT,
+        price TEXT,
+        PRIMARY KEY (figi)
+    ) WITHOUT ROWID;""")
+
+
+def _migration_2_candles(cursor):
+    # исторические цены активов - отдельно от курсов валют.
+    # price IS NULL - в этот день торгов не было (например, день IPO)
+    cursor.execute("""CREATE TABLE candles (
+        figi TEXT NOT NULL,
+        date DATE NOT NULL,
+        price REAL,
+        PRIMARY KEY (figi, date)
+    ) WITHOUT ROWID;""")
+    # раньше цены хранились в rates под figi вместо кода валюты (figi - 12 символов)
+    cursor.execute("""INSERT OR REPLACE INTO candles (figi, date, price)
+        SELECT currency, date, CAST(rate AS REAL) FROM rates WHERE length(currency) = 12;""")
+    cursor.execute("""INSERT OR IGNORE INTO candles (figi, date, price)
+        SELECT currency, date, NULL FROM rates_missing WHERE length(currency) = 12;""")
+    cursor.execute("DELETE FROM rates WHERE length(currency) = 12;")
+    cursor.execute("DELETE FROM rates_missing WHERE length(currency) = 12;")
+
+
+def _migration_3_ohlcv(cursor):
+    # свеча целиком; price - середина дня (high + low) / 2, по ней считаются цены.
+    # у записей, перенесенных из rates, есть только price
+    for column in ('open REAL', 'high REAL', 'low REAL', 'close REAL', 'volume INTEGER'):
+        cursor.execute(f"ALTER TABLE candles ADD COLUMN {column};")
+
+
+def _migration_4_operations(cursor):
+    # операции счетов из API (JSON модели tinvest) и докуда они загружены
+    cursor.execute("""CREATE TABLE operations (
+        account_id TEXT NOT NULL,
+        id TEXT NOT NULL,
+        date TEXT NOT NULL,
+        status TEXT,
+        data TEXT NOT NULL,
+        PRIMARY KEY (account_id, id)
+    ) WITHOUT ROWID;""")
+    cursor.execute("CREATE INDEX operations_account_date ON operations (account_id, date);")
+    cursor.execute("""CREATE TABLE operations_sync (
+        account_id TEXT NOT NULL,
+        synced_from TEXT NOT NULL,
+        watermark TEXT NOT NULL,
+        PRIMARY KEY (account_id)
+    ) WITHOUT ROWID;""")
+
+
+def _migration_5_rates_version(cursor):
+    # счетчик изменений таблицы rates - по нему проверяется актуальность
+    # сохраненной матрицы курсов, в том числе после исправления курса на месте
+    cursor.execute("""CREATE TABLE table_versions (
+        name TEXT NOT NULL,
+        version INTEGER NOT NULL,
+        PRIMARY KEY (name)
+    ) WITHOUT ROWID;""")
+    cursor.execute("INSERT INTO table_versions (name, version) VALUES ('rates', 0);")
+    for event in ('INSERT', 'UPDATE', 'DELETE'):
+        cursor.execute(f"""CREATE TRIGGER rates_version_{event.lower()} AFTER {event} ON rates
+            BEGIN
+                UPDATE table_versions SET version = version + 1 WHERE name = 'rates';
+            END;""")
+
+
+# Миграции схемы базы: номер версии - позиция в списке, начиная с 1.
+# Новые миграции добавляются только в конец списка.
+migrations = [
+    _migration_1_baseline,
+    _migration_2_candles,
+    _migration_3_ohlcv,
+    _migration_4_operations,
+    _migration_5_rates_version,
+]
+
+# Время операций хранится в UTC - строки сортируются в хронологическом порядке
+operation_date_format = "%Y-%m-%d %H:%M:%S.%f"
+
+
+def _operation_date(date):
+    # наивное время считается местным
+    return date.astimezone(timezone.utc).strftime(operation_date_format)
+
+
+def _parse_operation_date(date_str):
+    return datetime.strptime(date_str, operation_date_format).replace(tzinfo=timezone.utc)
+
+
+def _operation_json(operation):
+    # Decimal - строкой, чтобы суммы сохранялись точно
+    return operation.json(by_alias=True, exclude_none=True,
+                          encoder=lambda v: str(v) if isinstance(v, Decimal) else pydantic_encoder(v))
+
+
+# Дневная свеча в массивах, которые возвращает Database.get_candles()
+candle_dtype = np.dtype([
+    ('date', 'datetime64[D]'),
+    ('open', 'f8'),
+    ('high', 'f8'),
+    ('low', 'f8'),
+    ('close', 'f8'),
+    ('volume', 'i8'),
+])
+
 
 class Database:
     __instance = None
@@ -15,7 +182,7 @@ class Database:
     def __new__(self, *args):
         # Singleton - позволяет иметь только один экземпляр класса
         if self.__instance is None:
-            self.__instance = object.__new__(self, *args)
+            self.__instance = object.__new__(self)
         return self.__instance
 
     def __init__(self, db_file_name="assets_db.db"):
@@ -23,80 +190,577 @@ class Database:
         self.open_database_connection(db_file_name)
 
     def init_database(self):
-        db_logger.debug("Checking exchange rates table")
-        rates_sql = """CREATE TABLE IF NOT EXISTS rates (
-            date TEXT,
-            currency TEXT,
-            rate TEXT,
-            PRIMARY KEY (date, currency)
-        ) WITHOUT ROWID;
-        """
-        try:
-            self.cursor.execute(rates_sql)
-            self.sqlite_connection.commit()
-        except Exception as e:
-            db_logger.error(e)
-
-        db_logger.debug("Checking instruments cache table")
-        instruments_sql = """CREATE TABLE IF NOT EXISTS instruments (
-            timestamp timestamp,
-            figi TEXT,
-            ticker TEXT,
-            name TEXT,
-            currency TEXT,
-            type TEXT,
-            lot INTEGER,
-            min_price_increment TEXT,
-            isin TEXT,
-            PRIMARY KEY (figi)
-        ) WITHOUT ROWID;
+        db_logger.debug("Checking database schema version")
+        with self._lock:
+            try:
+                self.cursor.execute(schema_version_sql)
+                version = self.cursor.execute("SELECT MAX(version) FROM schema_version;").fetchone()[0] or 0
+            except sqlite3.Error as e:
+                db_logger.error("Error getting schema version", e)
+                return
+            for number, migration in enumerate(migrations[version:], start=version + 1):
+                db_logger.debug(f"Migrating database to version {number}")
+                try:
+                    # каждая миграция - отдельная транзакция
+                    with self.sqlite_connection:
+                        self.cursor.execute("BEGIN;")
+                        migration(self.cursor)
+                        self.cursor.execute("INSERT INTO schema_version (version) VALUES (?);", (number,))
+                except sqlite3.Error as e:
+                    db_logger.error(f"Error migrating database to version {number}", e)
+                    return
+
+    def close_database_connection(self):
+        with self._lock:
+            self._flush()
+            self.cursor.close()
+            self.sqlite_connection.close()
+
+    @property
+    def _batch(self):
+        # состояние batch() - у каждого потока свое
+        if not hasattr(self._local, 'depth'):
+            self._local.depth = 0
+            self._local.pending = []
+            self._local.count = 0
+        return self._local
+
+    def _write(self, sql, rows):
+        self._write_statements([(sql, rows)])
+
+    def _write_statements(self, statements):
+        # [(sql, строки)] по порядку: вне batch() - сразу записывает
+        # и фиксирует одной транзакцией, внутри - накапливает до выхода из batch()
+        batch = self._batch
+        if not batch.depth:
+            self._commit(statements)
+            return
+        for sql, rows in statements:
+            rows = list(rows)
+            if batch.pending and batch.pending[-1][0] == sql:
+                batch.pending[-1][1].extend(rows)
+            else:
+                batch.pending.append((sql, rows))
+            batch.count += len(rows)
+        if batch.count >= batch_flush_size:
+            self._flush()
+
+    def _commit(self, statements):
+        # [(sql, строки)] - одна короткая транзакция: блокировка записи
+        # не остается открытой между вызовами
+        with self._lock, self.sqlite_connection:
+            for sql, rows in statements:
+                self.sqlite_connection.executemany(sql, rows)
+
+    def _flush(self):
+        # записывает и фиксирует накопленные потоком строки
+        batch = self._batch
+        pending, batch.pending, batch.count = batch.pending, [], 0
+        if pending:
+            self._commit(pending)
+
+    def _read(self, sql, params=()):
+        # внутри batch() чтение видит еще не записанные строки потока:
+        # они добавляются во временную точку сохранения и откатываются после чтения
+        pending = self._batch.pending
+        with self._lock:
+            if not pending:
+                return self.sqlite_connection.execute(sql, params).fetchall()
+            self.sqlite_connection.execute("SAVEPOINT batch_read;")
+            try:
+                for pending_sql, rows in pending:
+                    self.sqlite_connection.executemany(pending_sql, rows)
+                return self.sqlite_connection.execute(sql, params).fetchall()
+            finally:
+                self.sqlite_connection.execute("ROLLBACK TO batch_read;")
+                self.sqlite_connection.execute("RELEASE batch_read;")
+
+    def _read_one(self, sql, params=()):
+        rows = self._read(sql, params)
+        return rows[0] if rows else None
+
+    def _discard(self):
+        # отбрасывает накопленные строки - в кэше остались записи, которых нет в базе
+        batch = self._batch
+        batch.pending, batch.count = [], 0
+        for cache in self.caches.values():
+            cache.clear()
+
+    @contextmanager
+    def batch(self):
+        """Объединяет запись в одну транзакцию
+
+        Все put_* внутри блока with database.batch() записываются через executemany
+        и фиксируются одним commit() при выходе из внешнего блока (большие пачки -
+        частями по batch_flush_size строк). Транзакция не открыта, пока выполняется
+        тело блока, но блок все равно должен содержать только работу с базой,
+        без запросов к API. Если тело блока завершилось исключением,
+        накопленные строки не записываются.
         """
+        batch = self._batch
+        batch.depth += 1
         try:
-            self.cursor.execute(instruments_sql)
-            self.sqlite_connection.commit()
-        except Exception as e:
-            db_logger.error("Error creating instruments table", e)
-
-        db_logger.debug("Checking marketprice cache table")
-        marketprice_sql = """CREATE TABLE IF NOT EXISTS marketprice (
-            timestamp timestamp,
-            figi TEXT,
-            price TEXT,
-            PRIMARY KEY (figi)
-        ) WITHOUT ROWID;
-        """
+            yield self
+        except BaseException:
+            batch.depth -= 1
+            if not batch.depth:
+                self._discard()
+            raise
+        batch.depth -= 1
+        if batch.depth:
+            return
         try:
-            self.cursor.execute(marketprice_sql)
-            self.sqlite_connection.commit()
-        except Exception as e:
-            db_logger.error("Error creating marketprice table", e)
-
-    def close_database_connection(self):
-        self.sqlite_connection.commit()
-        self.cursor.close()
-        self.sqlite_connection.close()
+            self._flush()
+        except sqlite3.Error as e:
+            db_logger.error(f"Batch write error: {e!r}")
+            self._discard()
 
     def get_exchange_rate(self, date=datetime.now(), currency="USD"):
         date_str = date.strftime("%Y-%m-%d")
+        cached = self.caches['rates'].get((date_str, currency))
+        if cached is not None:
+            return None if cached is MISSING else cached
         db_logger.debug(f"Get rate for {currency} on {date_str}")
         sql_s = "SELECT * FROM rates where date = ? and currency = ?;"
         try:
-            row = self.cursor.execute(sql_s, (date_str, currency)).fetchone()
+            row = self._read_one(sql_s, (date_str, currency))
         except sqlite3.Error as e:
             db_logger.error("Error getting rate", e)
+            return None
         if not row:
+            self.caches['rates'].put_missing((date_str, currency))
             return None
-        return Decimal(row[2])
+        rate = Decimal(row[2])
+        self.caches['rates'].put((date_str, currency), rate)
+        return rate
 
     def put_exchange_rate(self, date=datetime.now(), currency="USD", rate=1.0):
         date_str = date.strftime("%Y-%m-%d")
         db_logger.debug(f"Put rate {rate} for {currency} on {date_str}")
         sql = "INSERT OR REPLACE INTO rates (date, currency, rate) VALUES (?, ?, ?);"
         try:
-            self.cursor.execute(sql, (date_str, currency, str(rate)))
-            self.sqlite_connection.commit()
+            self._write(sql, [(date_str, currency, str(rate))])
         except sqlite3.Error as e:
             db_logger.error("Rate insertion error", e)
+            self.caches['rates'].clear()
+            return False
+        self.caches['rates'].put((date_str, currency), Decimal(str(rate)))
+        return True
+
+    def get_latest_exchange_rate(self, date=datetime.now(), currency="USD"):
+        # последний известный курс на дату или ранее
+        date_str = date.strftime("%Y-%m-%d")
+        db_logger.debug(f"Get latest rate for {currency} on {date_str}")
+        sql_s = """SELECT rate FROM rates WHERE currency = ? AND date <= ?
+            ORDER BY date DESC LIMIT 1;"""
+        try:
+            row = self._read_one(sql_s, (currency, date_str))
+        except sqlite3.Error as e:
+            db_logger.error("Error getting latest rate", e)
+            return None
+        if not row:
+            return None
+        return Decimal(row['rate'])
+
+    def get_exchange_rates_for_dates(self, dates, currencies):
+        """Курсы валют на набор дат - одним запросом.
+        Для дат без публикации (rates_missing) берется последний известный курс.
+
+        Args:
+            dates (iterable): даты (date или datetime)
+            currencies (iterable): коды валют
+
+        Returns:
+            dict: {date: {валюта: Decimal}} - только найденные курсы
+        """
+        dates = {date.strftime("%Y-%m-%d"): date for date in dates}
+        currencies = tuple(currencies)
+        if not dates or not currencies:
+            return {}
+        date_from = min(dates)
+        date_to = max(dates)
+        placeholders = ", ".join("?" * len(currencies))
+        # курсы берутся с запасом до начала периода - для дат без публикации
+        # в его начале (новогодние праздники - до 10 дней)
+        sql_s = f"""SELECT currency, date, rate FROM rates
+                WHERE currency IN ({placeholders}) AND date BETWEEN date(?, '-30 days') AND ?
+            UNION ALL
+            SELECT currency, date, NULL FROM rates_missing
+                WHERE currency IN ({placeholders}) AND date BETWEEN ? AND ?
+            ORDER BY currency, date;"""
+        params = currencies + (date_from, date_to) + currencies + (date_from, date_to)
+        try:
+            rows = self._read(sql_s, params)
+        except sqlite3.Error as e:
+            db_logger.error("Error getting rates for dates", e)
+            return {}
+        result = {}
+        last_currency, last_rate = None, None
+        for row in rows:
+            if row['currency'] != last_currency:
+                last_currency, last_rate = row['currency'], None
+            if row['rate'] is not None:
+                last_rate = Decimal(row['rate'])
+                self.caches['rates'].put((row['date'], row['currency']), last_rate)
+            if row['date'] in dates and last_rate is not None:
+                result.setdefault(dates[row['date']], {})[row['currency']] = last_rate
+        return result
+
+    def put_missing_rate(self, date, currency):
+        # запоминает, что на дату курс не публиковался
+        date_str = date.strftime("%Y-%m-%d")
+        db_logger.debug(f"Put missing rate for {currency} on {date_str}")
+        sql = "INSERT OR REPLACE INTO rates_missing (date, currency) VALUES (?, ?);"
+        try:
+            self._write(sql, [(date_str, currency)])
+        except sqlite3.Error as e:
+            db_logger.error("Missing rate insertion error", e)
+            return False
+        self.caches['rates_missing'].put((date_str, currency), True)
+        return True
+
+    def is_rate_missing(self, date, currency):
+        date_str = date.strftime("%Y-%m-%d")
+        cached = self.caches['rates_missing'].get((date_str, currency))
+        if cached is not None:
+            return cached is not MISSING
+        sql_s = "SELECT 1 FROM rates_missing WHERE date = ? AND currency = ?;"
+        try:
+            row = self._read_one(sql_s, (date_str, currency))
+        except sqlite3.Error as e:
+            db_logger.error("Error getting missing rate", e)
+            return False
+        if row is None:
+            self.caches['rates_missing'].put_missing((date_str, currency))
+            return False
+        self.caches['rates_missing'].put((date_str, currency), True)
+        return True
+
+    def put_exchange_rates(self, rates):
+        """Записывает много курсов одной транзакцией
+
+        Args:
+            rates (iterable): тройки (дата, валюта, курс)
+
+        Returns:
+            bool: True - если записано
+        """
+        rows = [(date.strftime("%Y-%m-%d"), currency, str(rate)) for date, currency, rate in rates]
+        db_logger.debug(f"Put {len(rows)} rates")
+        sql = "INSERT OR REPLACE INTO rates (date, currency, rate) VALUES (?, ?, ?);"
+        try:
+            self._write(sql, rows)
+        except sqlite3.Error as e:
+            db_logger.error("Rates insertion error", e)
+            self.caches['rates'].clear()
+            return False
+        for date_str, currency, rate in rows:
+            self.caches['rates'].put((date_str, currency), Decimal(rate))
+        return True
+
+    def get_exchange_rate_dates(self, currency, date_from, date_to):
+        """Даты, на которые в базе есть курс валюты
+
+        Args:
+            currency (str): код валюты
+            date_from (datetime): начало периода
+            date_to (datetime): конец периода (включительно)
+
+        Returns:
+            set: строки дат в формате YYYY-MM-DD
+        """
+        sql_s = "SELECT date FROM rates WHERE currency = ? AND date BETWEEN ? AND ?;"
+        try:
+            rows = self._read(sql_s, (currency,
+                                               date_from.strftime("%Y-%m-%d"),
+                                               date_to.strftime("%Y-%m-%d")))
+        except sqlite3.Error as e:
+            db_logger.error("Error getting rate dates", e)
+            return set()
+        return {row['date'] for row in rows}
+
+    def get_exchange_rate_history(self, currency, date_from, date_to):
+        """Курсы валюты за период
+
+        Args:
+            currency (str): код валюты
+            date_from (datetime): начало периода
+            date_to (datetime): конец периода (включительно)
+
+        Returns:
+            list: пары (дата в формате YYYY-MM-DD, Decimal) по возрастанию дат
+        """
+        sql_s = """SELECT date, rate FROM rates WHERE currency = ? AND date BETWEEN ? AND ?
+            ORDER BY date;"""
+        try:
+            rows = self._read(sql_s, (currency,
+                                      date_from.strftime("%Y-%m-%d"),
+                                      date_to.strftime("%Y-%m-%d")))
+        except sqlite3.Error as e:
+            db_logger.error("Error getting rate history", e)
+            return []
+        return [(row['date'], Decimal(row['rate'])) for row in rows]
+
+    def count_exchange_rates(self):
+        sql_s = "SELECT COUNT(*) FROM rates;"
+        try:
+            return self._read_one(sql_s)[0]
+        except sqlite3.Error as e:
+            db_logger.error("Error counting rates", e)
+            return 0
+
+    def get_rates_version(self):
+        # растет при любом изменении таблицы rates
+        sql_s = "SELECT version FROM table_versions WHERE name = 'rates';"
+        try:
+            return self._read_one(sql_s)[0]
+        except sqlite3.Error as e:
+            db_logger.error("Error getting rates version", e)
+            return None
+
+    def import_rates_csv(self, file_name, currencies=rates_csv_currencies):
+        """Загружает курсы из CSV-файла одной транзакцией.
+        Строка файла: дата (YYYY-MM-DD), затем курсы в порядке currencies.
+
+        Returns:
+            int: количество загруженных курсов
+        """
+        rows = []
+        with open(file_name, newline='') as csv_file:
+            for line in csv.reader(csv_file):
+                if not line or line[0].startswith('#'):
+                    continue
+                date_str = line[0].strip()
+                for currency, rate in zip(currencies, line[1:]):
+                    rows.append((date_str, currency, rate.strip()))
+        db_logger.info(f"Importing {len(rows)} rates from {file_name}")
+        sql = "INSERT OR REPLACE INTO rates (date, currency, rate) VALUES (?, ?, ?);"
+        try:
+            self._write(sql, rows)
+        except sqlite3.Error as e:
+            db_logger.error("Rates import error", e)
+            return 0
+        # в кэше могли остаться отметки об отсутствии загруженных курсов
+        self.caches['rates'].clear()
+        return len(rows)
+
+    def export_rates_csv(self, file_name, currencies=rates_csv_currencies):
+        """Выгружает курсы в CSV-файл того же формата, что и import_rates_csv.
+        Выгружаются только даты, на которые известны курсы всех валют.
+
+        Returns:
+            int: количество выгруженных дат
+        """
+        placeholders = ", ".join("?" * len(currencies))
+        sql_s = f"SELECT date, currency, rate FROM rates WHERE currency IN ({placeholders}) ORDER BY date;"
+        try:
+            rows = self._read(sql_s, tuple(currencies))
+        except sqlite3.Error as e:
+            db_logger.error("Rates export error", e)
+            return 0
+        by_date = {}
+        for row in rows:
+            by_date.setdefault(row['date'], {})[row['currency']] = row['rate']
+        count = 0
+        with open(file_name, 'w', newline='') as csv_file:
+            writer = csv.writer(csv_file)
+            for date_str, rates in by_date.items():
+                if len(rates) != len(currencies):
+                    continue
+                writer.writerow([date_str] + [rates[currency] for currency in currencies])
+                count += 1
+        db_logger.info(f"Exported rates for {count} dates to {file_name}")
+        return count
+
+    def _get_candle(self, date, figi):
+        # (есть ли запись в базе, цена); цена None - торгов в этот день не было
+        date_str = date.strftime("%Y-%m-%d")
+        cached = self.caches['candles'].get((date_str, figi))
+        if cached is not None:
+            return (False, None) if cached is MISSING else cached
+        db_logger.debug(f"Get candle for {figi} on {date_str}")
+        sql_s = "SELECT price FROM candles WHERE figi = ? AND date = ?;"
+        try:
+            row = self._read_one(sql_s, (figi, date_str))
+        except sqlite3.Error as e:
+            db_logger.error("Error getting candle", e)
+            return False, None
+        if row is None:
+            self.caches['candles'].put_missing((date_str, figi))
+            return False, None
+        entry = (True, None if row['price'] is None else Decimal(str(row['price'])))
+        self.caches['candles'].put((date_str, figi), entry)
+        return entry
+
+    def get_candle_price(self, date, figi):
+        return self._get_candle(date, figi)[1]
+
+    def is_candle_missing(self, date, figi):
+        # True - известно, что торгов в этот день не было
+        found, price = self._get_candle(date, figi)
+        return found and price is None
+
+    def put_candle_prices(self, prices):
+        """Записывает исторические цены активов
+
+        Args:
+            prices (iterable): тройки (дата, figi, цена); цена None - торгов не было
+
+        Returns:
+            bool: True - если записано
+        """
+        rows = [(figi, date.strftime("%Y-%m-%d"), None if price is None else float(price))
+                for date, figi, price in prices]
+        db_logger.debug(f"Put {len(rows)} candles")
+        # обновляется только цена - свеча, записанная put_candles(), сохраняется
+        sql = """INSERT INTO candles (figi, date, price) VALUES (?, ?, ?)
+            ON CONFLICT (figi, date) DO UPDATE SET price = excluded.price;"""
+        try:
+            self._write(sql, rows)
+        except sqlite3.Error as e:
+            db_logger.error("Candles insertion error", e)
+            self.caches['candles'].clear()
+            return False
+        for figi, date_str, price in rows:
+            self.caches['candles'].put((date_str, figi),
+                                       (True, None if price is None else Decimal(str(price))))
+        return True
+
+    def put_candle_price(self, date, figi, price):
+        return self.put_candle_prices([(date, figi, price)])
+
+    def put_missing_candle(self, date, figi):
+        return self.put_candle_prices([(date, figi, None)])
+
+    def put_candles(self, figi, candles):
+        """Записывает дневные свечи актива
+
+        Args:
+            figi (str): figi актива
+            candles (iterable): кортежи (дата, open, high, low, close, volume)
+
+        Returns:
+            bool: True - если записано
+        """
+        rows = [(figi, date.strftime("%Y-%m-%d"), float((high + low) / 2),
+                 float(open_), float(high), float(low), float(close), int(volume))
+                for date, open_, high, low, close, volume in candles]
+        db_logger.debug(f"Put {len(rows)} candles for {figi}")
+        sql = """INSERT OR REPLACE INTO candles (figi, date, price,
+            open, high, low, close, volume)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?);"""
+        try:
+            self._write(sql, rows)
+        except sqlite3.Error as e:
+            db_logger.error("Candles insertion error", e)
+            self.caches['candles'].clear()
+            return False
+        for row in rows:
+            self.caches['candles'].put((row[1], figi), (True, Decimal(str(row[2]))))
+        return True
+
+    def get_candles(self, figi, date_from, date_to):
+        """Дневные свечи актива за период
+
+        Args:
+            figi (str): figi актива
+            date_from (datetime): начало периода
+            date_to (datetime): конец периода (включительно)
+
+        Returns:
+            numpy.ndarray: массив с типом candle_dtype, по возрастанию дат.
+                Дни без торгов и цены без свечи (из старых версий базы) не включаются
+        """
+        sql_s = """SELECT date, open, high, low, close, volume FROM candles
+            WHERE figi = ? AND date BETWEEN ? AND ? AND close IS NOT NULL
+            ORDER BY date;"""
+        try:
+            rows = self._read(sql_s, (figi,
+                                      date_from.strftime("%Y-%m-%d"),
+                                      date_to.strftime("%Y-%m-%d")))
+        except sqlite3.Error as e:
+            db_logger.error("Error getting candles", e)
+            return np.empty(0, dtype=candle_dtype)
+        return np.array([tuple(row) for row in rows], dtype=candle_dtype)
+
+    def replace_operations(self, account_id, date_from, operations, date_to=None):
+        """Заменяет операции счета за период загруженными из API
+
+        Args:
+            account_id (str): номер счета
+            date_from (datetime): начало загруженного периода
+            operations (iterable): операции tinvest.Operation за период
+            date_to (datetime, optional): конец периода (не включительно), по умолчанию - без конца
+
+        Returns:
+            bool: True - если записано
+        """
+        rows = [(account_id, operation.id, _operation_date(operation.date), operation.status.value,
+                 _operation_json(operation)) for operation in operations]
+        db_logger.debug(f"Replace operations of {account_id} from {date_from} with {len(rows)} operations")
+        # операции, отмененные за период, тоже должны исчезнуть
+        if date_to is None:
+            delete = ("DELETE FROM operations WHERE account_id = ? AND date >= ?;",
+                      [(account_id, _operation_date(date_from))])
+        else:
+            delete = ("DELETE FROM operations WHERE account_id = ? AND date >= ? AND date < ?;",
+                      [(account_id, _operation_date(date_from), _operation_date(date_to))])
+        insert = ("""INSERT OR REPLACE INTO operations
+            (account_id, id, date, status, data) VALUES (?, ?, ?, ?, ?);""", rows)
+        try:
+            # удаление и запись - в одной транзакции (или в транзакции внешнего batch())
+            self._write_statements([delete, insert])
+        except sqlite3.Error as e:
+            db_logger.error("Operations insertion error", e)
+            return False
+        return True
+
+    def get_operations(self, account_id, date_from, date_to):
+        """Операции счета за период - от новых к старым, как их отдает API
+
+        Args:
+            account_id (str): номер счета
+            date_from (datetime): начало периода
+            date_to (datetime): конец периода
+
+        Returns:
+            list: операции tinvest.Operation
+        """
+        sql_s = """SELECT data FROM operations WHERE account_id = ? AND date BETWEEN ? AND ?
+            ORDER BY date DESC;"""
+        try:
+            rows = self._read(sql_s, (account_id,
+                                      _operation_date(date_from),
+                                      _operation_date(date_to)))
+        except sqlite3.Error as e:
+            db_logger.error("Error getting operations", e)
+            return []
+        return [Operation.parse_raw(row['data']) for row in rows]
+
+    def get_operations_sync_state(self, account_id):
+        """Докуда загружены операции счета
+
+        Returns:
+            tuple: (начало загруженной истории, watermark) или None, если счет не загружался.
+                После watermark операции надо загружать заново
+        """
+        sql_s = "SELECT synced_from, watermark FROM operations_sync WHERE account_id = ?;"
+        try:
+            row = self._read_one(sql_s, (account_id,))
+        except sqlite3.Error as e:
+            db_logger.error("Error getting operations sync state", e)
+            return None
+        if row is None:
+            return None
+        return _parse_operation_date(row['synced_from']), _parse_operation_date(row['watermark'])
+
+    def put_operations_sync_state(self, account_id, synced_from, watermark):
+        sql = """INSERT OR REPLACE INTO operations_sync (account_id, synced_from, watermark)
+            VALUES (?, ?, ?);"""
+        try:
+            self._write(sql, [(account_id, _operation_date(synced_from), _operation_date(watermark))])
+        except sqlite3.Error as e:
+            db_logger.error("Operations sync state insertion error", e)
             return False
         return True
 
@@ -110,22 +774,25 @@ class Database:
             type, lot, min_price_increment, isin)
             VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?);"""
         try:
-            self.cursor.execute(sql, (date_str,
-                                      figi, ticker, instrument.name, instrument.currency,
-                                      instrument.type, str(instrument.lot),
-                                      str(instrument.min_price_increment), instrument.isin))
-            self.sqlite_connection.commit()
+            self._write(sql, [(date_str,
+                               figi, ticker, instrument.name, instrument.currency,
+                               instrument.type, str(instrument.lot),
+                               str(instrument.min_price_increment), instrument.isin)])
         except sqlite3.Error as e:
             db_logger.error("Instrument insertion error", e)
             return False
+        self.caches['instruments'].put(figi, instrument, date_str.timestamp())
         return True
 
     def get_instrument_by_figi(self, figi, max_age=7*24*60*60):
         # max_age - timeout of getting old - default - 1 week
+        cached = self.caches['instruments'].get(figi, max_age)
+        if cached is not None:
+            return cached
         db_logger.debug(f"Get instrument for {figi}")
         sql_s = "SELECT * FROM instruments where figi = ?;"
         try:
-            row = self.cursor.execute(sql_s, (figi,)).fetchone()
+            row = self._read_one(sql_s, (figi,))
             if row and datetime.now().timestamp() - row['timestamp'].timestamp() > max_age:
                 db_logger.debug(f"Instrument for {figi} is too old")
                 row = None
@@ -142,6 +809,7 @@ class Database:
                                             currency=row['currency'],
                                             min_price_increment=row['min_price_increment'],
                                             isin=row['isin'])
+        self.caches['instruments'].put(figi, instrument, row['timestamp'].timestamp())
         return instrument
 
     def put_market_price(self, figi, price=Decimal(1.0)):
@@ -151,19 +819,22 @@ class Database:
             figi, price)
             VALUES (?, ?, ?);"""
         try:
-            self.cursor.execute(sql, (date_str, figi, str(price)))
-            self.sqlite_connection.commit()
+            self._write(sql, [(date_str, figi, str(price))])
         except sqlite3.Error as e:
             db_logger.error("Marketprice insertion error", e)
             return False
+        self.caches['marketprice'].put(figi, Decimal(str(price)), date_str.timestamp())
         return True
 
     def get_market_price_by_figi(self, figi, max_age=10*60):
         # max_age - timeout of getting old - default - 10 minutes
+        cached = self.caches['marketprice'].get(figi, max_age)
+        if cached is not None:
+            return cached
         db_logger.debug(f"Get market price for {figi}")
         sql_s = "SELECT * FROM marketprice where figi = ?;"
         try:
-            row = self.cursor.execute(sql_s, (figi,)).fetchone()
+            row = self._read_one(sql_s, (figi,))
             if row and datetime.now().timestamp() - row['timestamp'].timestamp() > max_age:
                 db_logger.debug(f"Market price for {figi} is too old")
                 row = None
@@ -172,22 +843,53 @@ class Database:
         if not row or row is None:
             return None
         db_logger.debug(f"Returning market price for {figi}")
-        return Decimal(row['price'])
+        price = Decimal(row['price'])
+        self.caches['marketprice'].put(figi, price, row['timestamp'].timestamp())
+        return price
+
+    def log_cache_stats(self):
+        for cache in self.caches.values():
+            db_logger.info(f"Cache {cache}")
 
     def open_database_connection(self, db_file_name="assets_db.db"):
+        if getattr(self, 'sqlite_connection', None) is not None:
+            # предыдущее соединение закрывается, чтобы не держать файл базы и WAL
+            try:
+                self.close_database_connection()
+            except sqlite3.ProgrammingError:
+                pass  # уже закрыто
+        # кэш относится к конкретному файлу базы
+        self.caches = {table: LRUCache(table, size, missing_ttl=missing_ttl)
+                       for table, size in cache_sizes.items()}
+        # соединение общее для всех потоков, запросы выполняются по очереди под блокировкой.
+        # Строки batch() копятся у каждого потока отдельно, а каждая запись - целая транзакция
+        # от BEGIN до COMMIT под блокировкой: commit() или rollback() одного потока
+        # не затрагивает строки другого, открытых транзакций между вызовами нет
+        self._lock = threading.RLock()
+        self._local = threading.local()
         try:
             db_logger.debug("Connecting to the DB...")
             self.sqlite_connection = sqlite3.connect(db_file_name,
+                                                     timeout=busy_timeout,
+                                                     check_same_thread=False,
                                                      detect_types=sqlite3.PARSE_DECLTYPES |
                                                      sqlite3.PARSE_COLNAMES)
             self.sqlite_connection.row_factory = sqlite3.Row
             self.cursor = self.sqlite_connection.cursor()
+            # WAL - читатели не блокируют писателя, несколько запусков могут
+            # работать с одной базой; NORMAL - без fsync на каждую транзакцию
+            self.cursor.execute("PRAGMA journal_mode=WAL;")
+            self.cursor.execute("PRAGMA synchronous=NORMAL;")
+            self.cursor.execute(f"PRAGMA busy_timeout={int(busy_timeout * 1000)};")
             self.init_database()
         except sqlite3.Error as error:
             db_logger.error("Error connecting database", error)
 
 
 if __name__ == '__main__':
+    # python database.py --export-rates rates_by_date.csv - обновить файл курсов из базы
+    logging.basicConfig(level=logging.INFO)
     db = Database()
-    db.open_database_connection()
+    if len(sys.argv) == 3 and sys.argv[1] == '--export-rates':
+        db.export_rates_csv(sys.argv[2])
     db.close_database_connection()
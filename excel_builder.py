@@ -1,6 +1,7 @@
 # Creating and filling an Excel file
 
 import logging
+import math
 import xlsxwriter
 
 import currencies
@@ -26,7 +27,8 @@ def get_color(num):
 
 def build_excel_file(account, my_positions, my_operations, rates_today_cb, market_rate_today,
                      average_percent, portfolio_cost_rub_market, sum_profile,
-                     investing_period_str, cash_rub, payin_payout, xirr_value, tax_rate):
+                     investing_period_str, cash_rub, payin_payout, xirr_value, tax_rate, xirr_periods=None,
+                     twr_value=None):
 
     logger.info('creating excel file..')
     excel_file_name = config.get_account_filename(account.broker_account_id)
@@ -39,6 +41,7 @@ def build_excel_file(account, my_positions, my_operations, rates_today_cb, marke
     worksheet_divs = workbook.add_worksheet("Coupons and Dividends")
     worksheet_deduct = workbook.add_worksheet("IIS Deduction")
     worksheet_parts = workbook.add_worksheet("Parts")
+    worksheet_xirr = workbook.add_worksheet("XIRR by Periods")
 
     # styles
     cell_format = {}
@@ -363,6 +366,24 @@ def build_excel_file(account, my_positions, my_operations, rates_today_cb, marke
         # XIRR value (the irregular internal rate of return)
         worksheet_port.write(s_row + 10, s_col, 'XIRR', cell_format['bold_right'])
         worksheet_port.write(s_row + 10, s_col + 1, str(xirr_value) + " %", cell_format['bold_right'])
+        if not twr_value:
+            return
+        # TWR (time-weighted return) - does not depend on the timing of PayIns and PayOuts
+        worksheet_port.write(s_row + 11, s_col, 'TWR annual', cell_format['bold_right'])
+        worksheet_port.write(s_row + 11, s_col + 1, str(twr_value['annual']) + " %", cell_format['bold_right'])
+        worksheet_port.write(s_row + 12, s_col, 'TWR total', cell_format['bold_right'])
+        worksheet_port.write(s_row + 12, s_col + 1, str(twr_value['total']) + " %", cell_format['right'])
+        # by years, the latest years - as many as fit above the clarification
+        xirr_years = {period.label: period.rate for period in (xirr_periods or {}).get('years', [])}
+        worksheet_port.write(s_row + 1, s_col + 3, 'Year', cell_format['bold_center'])
+        worksheet_port.write(s_row + 1, s_col + 4, 'TWR', cell_format['bold_right'])
+        worksheet_port.write(s_row + 1, s_col + 5, 'XIRR', cell_format['bold_right'])
+        for row, year in enumerate(sorted(twr_value['years'], reverse=True)[:12], start=s_row + 2):
+            worksheet_port.write(row, s_col + 3, year, cell_format['bold_center'])
+            worksheet_port.write(row, s_col + 4, str(twr_value['years'][year]) + " %", cell_format['right'])
+            rate = xirr_years.get(str(year))
+            rate = str(round(rate * 100, 2)) if rate is not None and math.isfinite(rate) else "---"
+            worksheet_port.write(row, s_col + 5, rate + " %", cell_format['right'])
 
     def print_dividends_and_coupons():
         logger.info('printing dividends and coupons statistics..')
@@ -674,6 +695,50 @@ def build_excel_file(account, my_positions, my_operations, rates_today_cb, marke
                                        merge_format['left'])
             n += 1 + line[2]
 
+    def print_xirr_periods():
+        if not xirr_periods:
+            worksheet_xirr.hide()
+            return
+        logger.info('printing XIRR by periods..')
+        cell_format['xirr'] = workbook.add_format({'num_format': '0.00 %', 'align': 'right'})
+
+        start_col = 1
+        worksheet_xirr.set_column(start_col, start_col, 12)
+        worksheet_xirr.set_column(start_col + 1, start_col + 2, 12)
+        worksheet_xirr.set_column(start_col + 3, start_col + 5, 16)
+        worksheet_xirr.set_column(start_col + 6, start_col + 6, 10)
+        worksheet_xirr.merge_range(1, start_col, 1, start_col + 6,
+                                   'XIRR по периодам: стоимость портфеля на начало - вложение, '
+                                   'на конец - выплата', merge_format['bold_center'])
+        worksheet_xirr.merge_range(2, start_col, 2, start_col + 6,
+                                   '* - стоимость в прошлом оценена по ценам закрытия дневных свечей '
+                                   'и курсу ЦБ; ставка годовая', merge_format['left_small'])
+        titles = (('years', 'Годы'), ('quarters', 'Кварталы'), ('rolling', 'Скользящие 12 месяцев'))
+        start_row = 4
+        for name, title in titles:
+            if not xirr_periods.get(name):
+                continue
+            worksheet_xirr.merge_range(start_row, start_col, start_row, start_col + 6,
+                                       title, merge_format['bold_left'])
+            start_row += 1
+            for col, header in enumerate(['Period', 'Start', 'End', 'Value start',
+                                          'PayIn - PayOut', 'Value end', 'XIRR']):
+                worksheet_xirr.write(start_row, start_col + col, header, cell_format['bold_center'])
+            start_row += 1
+            for period in reversed(xirr_periods[name]):
+                worksheet_xirr.write(start_row, start_col, period.label, cell_format['bold_center'])
+                worksheet_xirr.write(start_row, start_col + 1, period.start.strftime('%Y %b %d'), cell_format['center'])
+                worksheet_xirr.write(start_row, start_col + 2, period.end.strftime('%Y %b %d'), cell_format['center'])
+                worksheet_xirr.write(start_row, start_col + 3, period.value_start, cell_format['RUB'])
+                worksheet_xirr.write(start_row, start_col + 4, period.flows, cell_format['RUB'])
+                worksheet_xirr.write(start_row, start_col + 5, period.value_end, cell_format['RUB'])
+                if period.rate is not None and math.isfinite(period.rate):
+                    worksheet_xirr.write(start_row, start_col + 6, period.rate, cell_format['xirr'])
+                else:
+                    worksheet_xirr.write(start_row, start_col + 6, '---', cell_format['right'])
+                start_row += 1
+            start_row += 2
+
     last_row_pos = print_portfolio(1, 1)
     print_operations(1, 2)
     print_statistics(last_row_pos + 3, 1)
@@ -681,6 +746,7 @@ def build_excel_file(account, my_positions, my_operations, rates_today_cb, marke
     print_dividends_and_coupons()
     print_iis_deduction_table()
     print_parts()
+    print_xirr_periods()
 
     # finish Excel
     logger.info('Excel file composed! With name: '+excel_file_name)
@@ -0,0 +1,387 @@
+# Local stand-in for Tinkoff OpenAPI v1 and CB rates service
+# Отдает синтетические счета, портфели, операции и свечи заданного объема -
+# для нагрузочных прогонов без обращения к настоящему брокеру.
+# Запуск: python fake_server.py --accounts 20 --positions 500 --operations 50000
+# Затем в config.yaml (см. docs/configuration.md):
+#   api url: http://127.0.0.1:8080/openapi
+#   cbr url: http://127.0.0.1:8080/cbr/
+import argparse
+import bisect
+import json
+import logging
+import math
+import random
+import threading
+import time
+
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from currencies import currencies_data
+
+logger = logging.getLogger("FakeServer")
+logger.setLevel(logging.INFO)
+
+msk = timezone(timedelta(hours=3))
+# курс ЦБ в начале периода - дальше колеблется вокруг него
+base_rates = {'USD': 74, 'EUR': 88, 'CHF': 80}
+# доли инструментов по валютам и типам
+instrument_currencies = (('RUB', 0.7), ('USD', 0.2), ('EUR', 0.1))
+instrument_types = (('Stock', 0.6), ('Bond', 0.25), ('Etf', 0.15))
+# доли типов операций (кроме покупок, обеспечивающих позиции портфеля)
+operation_types = (('Buy', 0.45), ('Sell', 0.15), ('BrokerCommission', 0.15), ('Dividend', 0.06),
+                   ('TaxDividend', 0.03), ('Coupon', 0.05), ('PayIn', 0.07), ('PayOut', 0.02),
+                   ('ServiceCommission', 0.02))
+
+
+def _choice(rng, weighted):
+    return rng.choices([value for value, weight in weighted], [weight for value, weight in weighted])[0]
+
+
+def _money(value, currency):
+    return {'currency': currency, 'value': str(round(Decimal(value), 2))}
+
+
+class SyntheticBroker:
+    """Синтетические данные брокера: счета, инструменты, операции и цены.
+    Одни и те же параметры (и seed) дают одни и те же данные.
+    """
+
+    def __init__(self, accounts=2, positions=20, operations=1000, start=datetime(2020, 1, 1), seed=0):
+        self.rng = random.Random(seed)
+        self.start = datetime(start.year, start.month, start.day)
+        self.today = datetime.combine(datetime.now().date(), datetime.min.time())
+        self.days = [self.start + timedelta(days=n) for n in range((self.today - self.start).days)
+                     if (self.start + timedelta(days=n)).weekday() < 5] or [self.start]
+        self.instruments = {}
+        self.phases = {}
+        for currency, data in currencies_data.items():
+            if 'figi' in data:
+                self._add_instrument(data['figi'], f'{currency}000UTSTOM', 'Currency', 'RUB',
+                                     base_rates[currency], name=data['name'])
+        self.accounts = []
+        self.portfolios = {}
+        self.cash = {}
+        self.operations = {}  # счет -> операции по дате
+        self.operation_dates = {}  # счет -> даты операций, для поиска по периоду
+        for number in range(accounts):
+            account_id = str(2000000000 + number)
+            account_type = 'TinkoffIis' if number % 3 == 2 else 'Tinkoff'
+            self.accounts.append({'brokerAccountType': account_type, 'brokerAccountId': account_id})
+            self._generate_account(account_id, positions, operations)
+
+    def _add_instrument(self, figi, ticker, instrument_type, currency, price, name=None):
+        self.instruments[figi] = {
+            'figi': figi, 'ticker': ticker, 'isin': f'RU{figi[3:]}', 'minPriceIncrement': '0.01',
+            'lot': 1, 'currency': currency, 'name': name or f'Synthetic {instrument_type} {ticker}',
+            'type': instrument_type, 'price': price,
+        }
+        self.phases[figi] = self.rng.uniform(0, 2 * math.pi)
+
+    def price(self, figi, day):
+        """Цена инструмента за день - колебания вокруг начальной цены с годовым периодом"""
+        instrument = self.instruments[figi]
+        days = (day - self.start).days
+        return round(Decimal(instrument['price'] * (1 + 0.2 * math.sin(days / 58 + self.phases[figi]))), 2)
+
+    def rate(self, currency, day):
+        """Курс ЦБ за единицу валюты"""
+        days = (day - self.start).days
+        return round(Decimal(base_rates[currency] * (1 + 0.1 * math.sin(days / 90))), 4)
+
+    def _generate_account(self, account_id, positions, operations):
+        rng = self.rng
+        figis = []
+        for number in range(positions):
+            figi = f'BBG{rng.getrandbits(32):09X}'[:12]
+            if figi not in self.instruments:
+                self._add_instrument(figi, f'T{len(self.instruments):05d}', _choice(rng, instrument_types),
+                                     _choice(rng, instrument_currencies), rng.uniform(10, 500))
+            figis.append(figi)
+        held = defaultdict(int)
+        cost = defaultdict(Decimal)  # сумма покупок оставшихся бумаг - для средней цены
+        cash = defaultdict(Decimal)
+        ops = []
+        days = sorted(rng.choice(self.days) for _ in range(max(operations - len(figis) - 1, 0)))
+        # сначала пополнение, затем по покупке каждой бумаги портфеля
+        initial = [('PayIn', None)] + [('Buy', figi) for figi in figis]
+        plan = [(self.days[0], op_type, figi) for op_type, figi in initial[:operations]]
+        plan += [(day, _choice(rng, operation_types), None) for day in days]
+        stocks = [figi for figi in figis if self.instruments[figi]['type'] == 'Stock']
+        bonds = [figi for figi in figis if self.instruments[figi]['type'] == 'Bond']
+        for number, (day, op_type, figi) in enumerate(plan):
+            # после начальных покупок в портфеле есть все бумаги, продажи оставляют хотя бы одну
+            if figi is not None or op_type in ('PayIn', 'PayOut', 'ServiceCommission'):
+                pass
+            elif op_type in ('Buy', 'Sell', 'BrokerCommission') and figis:
+                figi = rng.choice(figis)
+                if op_type == 'Sell' and held[figi] < 2:
+                    op_type = 'Buy'
+            elif op_type in ('Dividend', 'TaxDividend') and stocks:
+                figi = rng.choice(stocks)
+            elif op_type == 'Coupon' and bonds:
+                figi = rng.choice(bonds)
+            else:
+                op_type = 'PayIn'
+            # начальные операции - до остальных операций первого дня
+            hour = 9 if number < len(initial) else rng.randint(10, 18)
+            date = day.replace(hour=hour, minute=rng.randint(0, 59), tzinfo=msk)
+            currency = self.instruments[figi]['currency'] if figi else 'RUB'
+            operation = {
+                'id': f'{account_id}{number:08d}', 'status': 'Done', 'date': date.isoformat(),
+                'operationType': op_type, 'currency': currency, 'isMarginCall': False,
+            }
+            if op_type in ('Buy', 'Sell'):
+                price = self.price(figi, day)
+                if op_type == 'Buy':
+                    quantity = rng.randint(1, 10)
+                    held[figi] += quantity
+                    cost[figi] += price * quantity
+                    payment = -price * quantity
+                else:
+                    quantity = rng.randint(1, held[figi] - 1)
+                    cost[figi] -= cost[figi] * quantity / held[figi]
+                    held[figi] -= quantity
+                    payment = price * quantity
+                operation.update({
+                    'price': str(price), 'quantity': quantity, 'quantityExecuted': quantity,
+                    'commission': _money(abs(payment) * Decimal('0.0005'), currency),
+                    'trades': [{'tradeId': f'{account_id}{number:08d}', 'date': date.isoformat(),
+                                'price': str(price), 'quantity': quantity}],
+                })
+            elif op_type == 'PayIn':
+                payment = Decimal(rng.randrange(10000, 200000, 1000))
+            elif op_type == 'PayOut':
+                payment = -Decimal(rng.randrange(1000, 20000, 1000))
+            elif op_type in ('Dividend', 'Coupon'):
+                payment = round(self.price(figi, day) * held[figi] * Decimal('0.02'), 2)
+            elif op_type == 'TaxDividend':
+                payment = -round(self.price(figi, day) * held[figi] * Decimal('0.0026'), 2)
+            else:
+                payment = -Decimal(rng.randrange(1, 300))
+            if figi:
+                operation.update({'figi': figi, 'instrumentType': self.instruments[figi]['type']})
+            operation['payment'] = str(round(payment, 2))
+            cash[currency] += payment
+            ops.append(operation)
+        ops.sort(key=lambda op: op['date'])
+        self.operations[account_id] = ops
+        self.operation_dates[account_id] = [datetime.fromisoformat(op['date']) for op in ops]
+        self.portfolios[account_id] = []
+        for figi in figis:
+            if not held[figi] or any(pos['figi'] == figi for pos in self.portfolios[account_id]):
+                continue
+            instrument = self.instruments[figi]
+            average = cost[figi] / held[figi]
+            current = self.price(figi, self.days[-1])
+            self.portfolios[account_id].append({
+                'figi': figi, 'ticker': instrument['ticker'], 'isin': instrument['isin'],
+                'instrumentType': instrument['type'], 'name': instrument['name'],
+                'balance': held[figi], 'lots': held[figi], 'blocked': 0,
+                'averagePositionPrice': _money(average, instrument['currency']),
+                'expectedYield': _money((current - average) * held[figi], instrument['currency']),
+            })
+        self.cash[account_id] = [{'currency': currency, 'balance': str(round(max(balance, 0), 2))}
+                                 for currency, balance in cash.items()]
+
+    def get_operations(self, account_id, date_from, date_to):
+        dates = self.operation_dates[account_id]
+        ops = self.operations[account_id]
+        return ops[bisect.bisect_left(dates, date_from):bisect.bisect_left(dates, date_to)]
+
+    def get_candles(self, figi, date_from, date_to):
+        day = datetime(date_from.year, date_from.month, date_from.day)
+        candles = []
+        while day < date_to.replace(tzinfo=None) and day < self.today:
+            if day.weekday() < 5 and day >= self.start:
+                price = self.price(figi, day)
+                candles.append({'figi': figi, 'interval': 'day', 'time': day.replace(hour=7).isoformat() + 'Z',
+                                'o': str(price), 'c': str(price),
+                                'h': str(round(price * Decimal('1.01'), 2)),
+                                'l': str(round(price * Decimal('0.99'), 2)),
+                                'v': 1000 + (day - self.start).days % 997})
+            day += timedelta(days=1)
+        return candles
+
+    def cbr_daily(self, day):
+        # XML_daily.asp - курсы всех валют на дату
+        valutes = ''.join(
+            f'<Valute ID="{data["cbr_id"]}"><NumCode>000</NumCode><CharCode>{currency}</CharCode>'
+            f'<Nominal>1</Nominal><Name>{data["name"]}</Name>'
+            f'<Value>{str(self.rate(currency, day)).replace(".", ",")}</Value></Valute>'
+            for currency, data in currencies_data.items() if 'cbr_id' in data)
+        return f'<?xml version="1.0" encoding="windows-1251"?><ValCurs Date="{day:%d.%m.%Y}" name="Foreign Currency Market">{valutes}</ValCurs>'
+
+    def cbr_dynamic(self, cbr_id, date_from, date_to):
+        # XML_dynamic.asp - курс одной валюты за период, только рабочие дни
+        currency = next(currency for currency, data in currencies_data.items() if data.get('cbr_id') == cbr_id)
+        records = []
+        day = date_from
+        while day <= date_to:
+            if day.weekday() < 5:
+                records.append(f'<Record Date="{day:%d.%m.%Y}" Id="{cbr_id}"><Nominal>1</Nominal>'
+                               f'<Value>{str(self.rate(currency, day)).replace(".", ",")}</Value></Record>')
+            day += timedelta(days=1)
+        return f'<?xml version="1.0" encoding="windows-1251"?><ValCurs ID="{cbr_id}" name="Foreign Currency Market Dynamic">{"".join(records)}</ValCurs>'
+
+
+def _parse_date(value):
+    date = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    return date if date.tzinfo else date.replace(tzinfo=timezone.utc)
+
+
+class FakeApiHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive - как у настоящего API
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def _send(self, status, body, content_type='application/json'):
+        data = body.encode('utf-8') if isinstance(body, str) else body
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _ok(self, payload):
+        self._send(HTTPStatus.OK, json.dumps({'trackingId': 'fake', 'status': 'Ok', 'payload': payload}))
+
+    def _error(self, message, code='VALIDATION_ERROR'):
+        self._send(HTTPStatus.BAD_REQUEST, json.dumps({'trackingId': 'fake', 'status': 'Error',
+                                                       'payload': {'message': message, 'code': code}}))
+
+    def do_GET(self):
+        server = self.server
+        url = urlparse(self.path)
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        path = url.path.rstrip('/')
+        server.count(path)
+        if server.latency:
+            time.sleep(server.latency * random.uniform(0.5, 1.5))
+        if server.throttle and random.random() < server.throttle:
+            server.count('429')
+            self._send(HTTPStatus.TOO_MANY_REQUESTS, '{"trackingId":"fake","status":"Error"}')
+            return
+        broker = server.broker
+        try:
+            if path.endswith('XML_daily.asp'):
+                day = datetime.strptime(params['date_req'], '%d/%m/%Y') if 'date_req' in params else broker.today
+                self._send(HTTPStatus.OK, broker.cbr_daily(day).encode('windows-1251'), 'application/xml')
+            elif path.endswith('XML_dynamic.asp'):
+                self._send(HTTPStatus.OK, broker.cbr_dynamic(params['VAL_NM_RQ'],
+                                                             datetime.strptime(params['date_req1'], '%d/%m/%Y'),
+                                                             datetime.strptime(params['date_req2'], '%d/%m/%Y')),
+                           'application/xml')
+            elif path.endswith('/user/accounts'):
+                self._ok({'accounts': broker.accounts})
+            elif path.endswith('/portfolio/currencies'):
+                self._ok({'currencies': broker.cash[self._account(params)]})
+            elif path.endswith('/portfolio'):
+                self._ok({'positions': broker.portfolios[self._account(params)]})
+            elif path.endswith('/operations'):
+                self._ok({'operations': broker.get_operations(self._account(params),
+                                                              _parse_date(params['from']),
+                                                              _parse_date(params['to']))})
+            elif path.endswith('/market/orderbook'):
+                figi = params['figi']
+                price = str(broker.price(figi, broker.today))
+                self._ok({'figi': figi, 'depth': int(params.get('depth', 0)), 'bids': [], 'asks': [],
+                          'tradeStatus': 'NormalTrading', 'minPriceIncrement': '0.01',
+                          'lastPrice': price, 'closePrice': price})
+            elif path.endswith('/market/candles'):
+                self._ok({'figi': params['figi'], 'interval': params['interval'],
+                          'candles': broker.get_candles(params['figi'], _parse_date(params['from']),
+                                                        _parse_date(params['to']))})
+            elif path.endswith('/market/search/by-figi'):
+                instrument = dict(broker.instruments[params['figi']])
+                del instrument['price']
+                self._ok(instrument)
+            else:
+                self._send(HTTPStatus.NOT_FOUND, '{"status":"Error"}')
+        except KeyError as e:
+            self._error(f'Unknown parameter value {e}')
+
+    def _account(self, params):
+        account_id = params.get('brokerAccountId', self.server.broker.accounts[0]['brokerAccountId'])
+        if account_id not in self.server.broker.portfolios:
+            raise KeyError(account_id)
+        return account_id
+
+
+class FakeServer(ThreadingHTTPServer):
+    """HTTP-сервер с синтетическим брокером, задержкой и ответами 429"""
+
+    daemon_threads = True
+
+    def __init__(self, broker, address=('127.0.0.1', 0), latency=0.0, throttle=0.0):
+        super().__init__(address, FakeApiHandler)
+        self.broker = broker
+        self.latency = latency  # средняя задержка ответа в секундах
+        self.throttle = throttle  # доля запросов, получающих ответ 429
+        self.requests = Counter()
+        self._lock = threading.Lock()
+
+    def count(self, path):
+        with self._lock:
+            self.requests[path] += 1
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}'
+
+
+def start_server(broker, address=('127.0.0.1', 0), latency=0.0, throttle=0.0):
+    """Запускает сервер в фоновом потоке
+
+    Args:
+        broker (SyntheticBroker): данные, которые отдает сервер
+        address (tuple): адрес и порт, порт 0 - любой свободный
+        latency (float): средняя задержка ответа в секундах
+        throttle (float): доля запросов, получающих ответ 429
+
+    Returns:
+        FakeServer: запущенный сервер, остановить - server.shutdown()
+    """
+    server = FakeServer(broker, address, latency, throttle)
+    threading.Thread(target=server.serve_forever, name='fake-server', daemon=True).start()
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Локальная замена Tinkoff OpenAPI v1 и сервиса курсов ЦБ')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--accounts', type=int, default=2, help='количество счетов')
+    parser.add_argument('--positions', type=int, default=20, help='позиций в портфеле каждого счета')
+    parser.add_argument('--operations', type=int, default=1000, help='операций на каждом счете')
+    parser.add_argument('--start', default='2020-01-01', help='дата первой операции, ГГГГ-ММ-ДД')
+    parser.add_argument('--latency', type=float, default=0.0, help='средняя задержка ответа, секунд')
+    parser.add_argument('--throttle', type=float, default=0.0, help='доля ответов 429, от 0 до 1')
+    parser.add_argument('--seed', type=int, default=0, help='начальное значение генератора данных')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)-3s] %(name)s: %(message)s',
+                        datefmt='%H:%M:%S')
+
+    started = time.time()
+    broker = SyntheticBroker(args.accounts, args.positions, args.operations,
+                             datetime.strptime(args.start, '%Y-%m-%d'), args.seed)
+    logger.info(f"{args.accounts} accounts, {len(broker.instruments)} instruments, "
+                f"{sum(map(len, broker.operations.values()))} operations generated "
+                f"in {time.time() - started:.2f} seconds")
+    server = FakeServer(broker, (args.host, args.port), args.latency, args.throttle)
+    logger.info(f"api url: {server.url}/openapi")
+    logger.info(f"cbr url: {server.url}/cbr/")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        for path, count in sorted(server.requests.items()):
+            logger.info(f"{path}: {count} requests")
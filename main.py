@@ -6,26 +6,47 @@
 # Данные для расчётов поставляются из data_parser.py
 # Выходные данные используются в excel_builder.py
 
+import argparse
+import atexit
+import functools
 import logging
-import sys
+import math
 import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from decimal import Decimal
 import operator
-import scipy.optimize
 
-from classes import PortfolioOperation, PortfolioPosition
+from classes import FifoLedger, OperationsIndex, OperationsPivot, PortfolioOperation, PortfolioPosition
 from configuration import Config
 
+import api_client
+import async_parser
 import data_parser
+import database
 
 import excel_builder
+import performance
+import rate_limiter
+import rate_matrix
+import recorder
+import valuation
 from excel_builder import build_excel_file, supported_currencies, assets_types
 
+logger = logging.getLogger("Main")
+logger.setLevel(logging.INFO)
 
-def get_portfolio_cash_rub():
+tax_rate = 13  # percents
+# сохранять оценку портфеля по дням в файлы valuation_<счет>.npz; при записи и воспроизведении - нет
+valuation_files = True
+
+
+def get_portfolio_cash_rub(currencies):
     """
     Находит, сколько рублей в портфеле кэшем
+    Args:
+        currencies: валютные позиции портфеля из API
+
     Returns: cur.balance
     """
     for cur in currencies.payload.currencies:
@@ -35,24 +56,31 @@ def get_portfolio_cash_rub():
 
 
 # tax calculation
-def calculate_ave_buy_price_rub(this_pos):
+def build_fifo_ledger(this_pos, operations_index, rates_by_date):
     """
-    Рассчитывает среднюю цену покупки бумаги в рублях.
-    Нужно для последующего расчёта налогов.
+    Собирает партии бумаги (FIFO), оставшиеся в портфеле после всех операций.
+    Цены партий - в рублях по курсу ЦБ на дату покупки.
     Args:
-        this_pos: принимает figi бумаги
+        this_pos: позиция портфеля из API
+        operations_index: OperationsIndex операций счета из API
+        rates_by_date: курсы ЦБ на даты операций
 
-    Returns: возвращает среднюю цену покупки бумаги
+    Returns: FifoLedger с оставшимися партиями
 
     """
-    item_list = []
-    # for this position's figi - add units into the list from operations
-    for ops in reversed(operations.payload.operations):
-        date = datetime.date(ops.date)
-        rate_for_date = data_parser.get_exchange_rates_for_date_db(date)
+    ledger = FifoLedger()
+    figis = [this_pos.figi]
+    if this_pos.figi == 'BBG00QPYJ5H0':
+        # solving problem with TCSG stocks:
+        figis.append('BBG005DXJS36')
+    # for this position's figi - add lots into the ledger from operations
+    for ops in reversed(operations_index.by_figi(*figis, op_types=('Buy', 'BuyCard', 'Sell'))):
+        if ops.payment == 0:
+            continue
 
-        if ops.figi == this_pos.figi and ops.payment != 0:
+        if ops.figi == this_pos.figi:
             if ops.operation_type == 'Buy' or ops.operation_type == 'BuyCard':
+                date = datetime.date(ops.date)
                 # Определим - был ли в истории сплит или обратный сплит
                 op_price = Decimal(ops.payment / ops.quantity_executed)
                 quantity = ops.quantity_executed
@@ -85,44 +113,57 @@ def calculate_ave_buy_price_rub(this_pos):
 
                 # Когда опередлились с количеством активов по заявленной цене - считаем
                 if ops.currency in supported_currencies:
+                    rate_for_date = rates_by_date[date]
                     # price for 1 item
                     item = (ops.payment / quantity) * rate_for_date[ops.currency]
-                    # add bought items to the list:
-                    item_list += [item] * quantity
+                    # add bought items to the ledger:
+                    ledger.buy(quantity, item, ops.date)
                 else:
                     logger.warning('unknown currency in position: ' + this_pos.name)
             elif ops.operation_type == 'Sell':
-                # remove sold items from the list:
-                number = ops.quantity_executed
-                del item_list[:number]
+                # remove sold items from the ledger:
+                ledger.sell(ops.quantity_executed)
+        else:
+            # TCSG stocks bought under the old figi
+            if ops.operation_type == 'Buy':
+                if ops.currency == 'RUB':
+                    # price for 1 item
+                    item = ops.payment / ops.quantity_executed
+                    # add bought items to the ledger:
+                    ledger.buy(ops.quantity_executed, item, ops.date)
+                else:
+                    logger.warning('unknown currency in position: ' + this_pos.name)
+            elif ops.operation_type == 'Sell':
+                # remove sold items from the ledger:
+                ledger.sell(ops.quantity_executed)
 
-        # solving problem with TCSG stocks:
-        if this_pos.figi == 'BBG00QPYJ5H0':
-            if ops.figi == 'BBG005DXJS36' and ops.payment != 0:
-                if ops.operation_type == 'Buy':
-                    if ops.currency == 'RUB':
-                        # price for 1 item
-                        item = ops.payment / ops.quantity_executed
-                        # add bought items to the list:
-                        item_list += [item] * ops.quantity_executed
-                    else:
-                        logger.warning('unknown currency in position: ' + this_pos.name)
-                elif ops.operation_type == 'Sell':
-                    # remove sold items from the list:
-                    number = ops.quantity_executed
-                    del item_list[:number]
+    return ledger
 
-    # calculate average buying price in Rub
-    ave_buy_price_rub = 0
-    if len(item_list) != 0:
-        ave_buy_price_rub = sum(item_list) / len(item_list)
 
-    return abs(ave_buy_price_rub)
+def calculate_ave_buy_price_rub(ledger):
+    """
+    Рассчитывает среднюю цену покупки бумаги в рублях.
+    Нужно для последующего расчёта налогов.
+    Args:
+        ledger: партии бумаги, собранные build_fifo_ledger()
+
+    Returns: возвращает среднюю цену покупки бумаги
+
+    """
+    # calculate average buying price in Rub
+    return abs(ledger.average_price)
 
 
-def creating_positions_objects():
+def creating_positions_objects(positions, operations_index, market_rate_today, rates_by_date, today_date):
     """
     Создаёт объекты класса PortfolioPosition для каждой бумаги в портфеле
+    Args:
+        positions: позиции портфеля из API
+        operations_index: OperationsIndex операций счета из API
+        market_rate_today: рыночные курсы валют на сегодня
+        rates_by_date: курсы ЦБ на даты операций и сегодня
+        today_date: сегодняшняя дата
+
     Returns: список типа list с объектами, именуемый my_positions
 
     """
@@ -130,8 +171,18 @@ def creating_positions_objects():
 
     number_positions = len(positions.payload.positions)
     logger.info(f'{number_positions} positions in portfolio')
-    number_operations = len(operations.payload.operations)
-    logger.info(f'{number_operations} operations in period')
+    logger.info(f'{len(operations_index)} operations in period')
+
+    # запрашиваем все нужные рыночные данные параллельно - до расчетов
+    history_dates = []
+    for this_pos in positions.payload.positions:
+        if this_pos.average_position_price.value <= 0:
+            continue
+        for ops in operations_index.by_figi(this_pos.figi, op_types=('Buy', 'BuyCard')):
+            if ops.payment != 0 and ops.currency == this_pos.average_position_price.currency:
+                history_dates.append((ops.figi, ops.date))
+    async_parser.prefetch_market_data([pos.figi for pos in positions.payload.positions],
+                                      history_dates)
 
     my_positions = list()
     for this_pos in positions.payload.positions:
@@ -140,14 +191,15 @@ def creating_positions_objects():
 
         currency = this_pos.average_position_price.currency
         market_rate = market_rate_today[currency]
-        cb_rate = data_parser.get_exchange_rate_db(today_date, currency)
+        cb_rate = rates_by_date[today_date][currency]
 
         tmp_position = PortfolioPosition.from_api_data(this_pos, this_pos_instrument,
                                                        curr_market_price,
                                                        market_rate, cb_rate)
 
         if this_pos.average_position_price.value > 0:
-            ave_buy_price_rub = calculate_ave_buy_price_rub(this_pos)
+            tmp_position.ledger = build_fifo_ledger(this_pos, operations_index, rates_by_date)
+            ave_buy_price_rub = calculate_ave_buy_price_rub(tmp_position.ledger)
             logger.info(this_pos.name)
         else:  # in the case, if this position has ZERO purchase price
             ave_buy_price_rub = Decimal(0)
@@ -162,7 +214,7 @@ def creating_positions_objects():
     return my_positions
 
 
-def get_average_percent():
+def get_average_percent(my_positions, market_rate_today):
     """
     Рассчитывает общий процент изменения по всем открытым позициям, как в приложении Тинькофф
     Returns: средний процент по открытым позициям
@@ -180,7 +232,7 @@ def get_average_percent():
     return 0
 
 
-def get_portfolio_cost_rub_market():
+def get_portfolio_cost_rub_market(my_positions, market_rate_today, cash_rub):
     """
     Считает стоимость всего портфеля в рублях по текущему РЫНОЧНОМУ курсу
     Returns: стоимость портфеля + свободные рубли на счёте
@@ -195,7 +247,7 @@ def get_portfolio_cost_rub_market():
     return sum(costs_list) + cash_rub
 
 
-def calculate_cb_value_rub_sum():
+def calculate_cb_value_rub_sum(my_positions, cash_rub):
     """
     Считает стоимость всего портфеля в рублях по курсу ЦБ на сегодня.
     Returns: стоимость всего портфеля в рублях + свободные рубли на счёте
@@ -204,7 +256,7 @@ def calculate_cb_value_rub_sum():
     return sum(pos.market_cost_rub_cb for pos in my_positions) + cash_rub
 
 
-def calculate_sum_pos_ave_buy_rub():
+def calculate_sum_pos_ave_buy_rub(my_positions):
     """
     Returns: Сумма стоимости покупки в рублях всех бумаг в портфеле
 
@@ -212,7 +264,7 @@ def calculate_sum_pos_ave_buy_rub():
     return sum(pos.sum_buy_rub for pos in my_positions)
 
 
-def calculate_profit_sum():
+def calculate_profit_sum(my_positions):
     """
     Считает сумму налогооблагаемой базы всех позиций
 
@@ -224,24 +276,24 @@ def calculate_profit_sum():
     return sum(list)
 
 
-def calculate_profit_tax():
+def calculate_profit_tax(profit):
     """
     Считает предполагаемый налог с прибыли в случае закрытия прибыльной позиции.
     ВАЖНО: не учитывает налог по ранее закрытым позициям
     """
-    return round(sum_profile['profit'] * Decimal(tax_rate / 100), 2)
+    return round(profit * Decimal(tax_rate / 100), 2)
 
 
-def calculate_loss_tax():
+def calculate_loss_tax(loss):
     """
     Считает предполагаемый налоговый вычет в случае закрытия убыточной позиции.
     ВАЖНО: не учитывает налог по ранее закрытым позициям
     """
 
-    return round(sum_profile['loss'] * Decimal(tax_rate / 100), 2)
+    return round(loss * Decimal(tax_rate / 100), 2)
 
 
-def calculate_loss_sum():
+def calculate_loss_sum(my_positions):
     """
     Суммирует "налоговый вычет" по убыточным позициям
     """
@@ -252,14 +304,14 @@ def calculate_loss_sum():
     return sum(list)
 
 
-def calculate_sum_exp_tax():
+def calculate_sum_exp_tax(my_positions):
     """
     Суммирует ожидаемый налог по всему портфелю
     """
     return Decimal(max(0, sum(pos.exp_tax for pos in my_positions)))
 
 
-def calculate_parts():
+def calculate_parts(my_positions, cash_rub):
     logger.info('calculating parts')
     parts = {'totalValue': cash_rub,
              'RUB': {
@@ -311,9 +363,13 @@ def calculate_parts():
     return parts
 
 
-def calculate_iis_deduction():
+def calculate_iis_deduction(operations_pivot, broker_account_type):
     """Расчет вычета по счетам ИИС
 
+    Args:
+        operations_pivot: OperationsPivot операций счета
+        broker_account_type: тип счета в API
+
     Returns:
         None: если счет не ИИС
         Dict: {int(год): {'pay_in': Decimal('взносы'), 'base': Decimal('налоговая база'),
@@ -321,26 +377,20 @@ def calculate_iis_deduction():
                0: Decimal('сумма вычетов за все годы')}
               }
     """
-    if sum_profile['broker_account_type'] != "TinkoffIis":
+    if broker_account_type != "TinkoffIis":
         logger.debug("account is not of IIS Type")
         return None
     logger.info("calculating IIS deductions data")
 
-    year_sums = {}
-    for operation in my_operations:
-        if operation.op_type != 'PayIn':
+    # По состоянию на 08.09.2021 пополнять ИИС можно только рублями,
+    # Поэтому проверка формальная на случай - если вдруг это изменится
+    for currency in operations_pivot.currencies('PayIn'):
+        if currency == "RUB":
             continue
-        # По состоянию на 08.09.2021 пополнять ИИС можно только рублями,
-        # Поэтому проверка формальная на случай - если вдруг это изменится
-        operation_year = int(operation.op_date.strftime('%Y'))
-        if operation.op_currency != "RUB":
+        for operation_year, payment in operations_pivot.by_year('PayIn', currency).items():
             logger.warning(f"Пополнение ИИС в {operation_year} году не в рублях!")
-            logger.warning(operation)
-            continue
-        if operation_year not in year_sums.keys():
-            year_sums[operation_year] = {'pay_in': operation.op_payment}
-        else:
-            year_sums[operation_year]["pay_in"] += operation.op_payment
+            logger.warning(f"{payment} {currency}")
+    year_sums = {year: {'pay_in': payin} for year, payin in operations_pivot.by_year('PayIn', 'RUB').items()}
 
     deduct_total = 0
     base_limit = Decimal(400000)  # Ограничение налоговой базы по закону
@@ -366,16 +416,29 @@ def calculate_iis_deduction():
     return year_sums
 
 
-def create_operations_objects():
+def create_operations_objects(operations, rates_by_date, cb_rate_matrix=None):
     """
     Создаёт объекты класса PortfolioOperation
+    Args:
+        operations: операции счета из API
+        rates_by_date: курсы ЦБ на даты операций
+        cb_rate_matrix: RateMatrix для пересчета всех платежей сразу, если включена
+
     Returns: список list с объектами операций именуемый my_operations
     """
     logger.info('creating operations objects..')
     my_operations = list()
-    for this_op in operations.payload.operations:
-        date = datetime.date(this_op.date)
-        rate_for_date = data_parser.get_exchange_rates_for_date_db(date)
+    payments_rub = None
+    if cb_rate_matrix is not None:
+        # все платежи пересчитываются в рубли одним точным умножением в целых числах;
+        # None - платеж пересчитывается ниже по rates_by_date
+        try:
+            payments_rub = cb_rate_matrix.convert([op.payment for op in operations.payload.operations],
+                                                  [op.currency for op in operations.payload.operations],
+                                                  [op.date for op in operations.payload.operations])
+        except KeyError as e:
+            logger.warning(f'rate matrix is not used: {e}')
+    for index, this_op in enumerate(operations.payload.operations):
         # ticker
         if this_op.figi is not None:
             ticker = data_parser.get_ticker_by_figi(this_op.figi)
@@ -384,7 +447,10 @@ def create_operations_objects():
 
         # payment_RUB
         if this_op.currency in supported_currencies:
-            payment_rub = this_op.payment * rate_for_date[this_op.currency]
+            if payments_rub is not None and payments_rub[index] is not None:
+                payment_rub = payments_rub[index]
+            else:
+                payment_rub = this_op.payment * rates_by_date[datetime.date(this_op.date)][this_op.currency]
         else:
             logger.warning('unknown currency in operation: ' + this_op)
             payment_rub = 0
@@ -401,101 +467,48 @@ def create_operations_objects():
     return my_operations
 
 
-def calculate_operations_sums_rub(current_op_type):
+def calculate_operations_sums_rub(operations_pivot, current_op_type):
     """
     Для каждого типа операций рассчитывается сумма все не нулевых операций
     Args:
+        operations_pivot: OperationsPivot операций счета
         current_op_type: тип операции
 
     Returns: сумма в рублях
 
     """
-    op_list = []
-    for op in my_operations:
-        if op.op_type == current_op_type and op.op_payment != 0:
-            if op.op_currency in supported_currencies:
-                date = datetime.date(op.op_date)  # op_date has a datetime.datetime type.
-                                                  # I don't know, what is the problem.
-                rate_for_date = data_parser.get_exchange_rates_for_date_db(date)
-                op_list.append(op.op_payment * rate_for_date[op.op_currency])
-            else:
-                logger.warning(f'Unsupported currency: {op.op_currency}')
-    return sum(op_list)
-
-
-def xnpv(valuesPerDate, rate):
-    # Calculate the irregular net present value.
-    days_per_year = 365.0
-    if rate == -1.0:
-        return float('inf')
-
-    t0 = min(valuesPerDate.keys())
-    if rate <= -1.0:
-        return sum([-abs(vi) / (-1.0 - rate)**((ti - t0).days / days_per_year) for ti, vi in valuesPerDate.items()])
-    return sum([vi / (1.0 + rate)**((ti - t0).days / days_per_year) for ti, vi in valuesPerDate.items()])
+    for currency in operations_pivot.currencies(current_op_type):
+        if currency not in supported_currencies:
+            logger.warning(f'Unsupported currency: {currency}')
+    # already converted by the CB rate for the operation's date
+    return operations_pivot.total_rub(current_op_type, currencies=supported_currencies)
 
 
 def xirr(valuesPerDate):
     # Calculate the irregular internal rate of return
     if not valuesPerDate:
         return None
-    if all(v >= 0 for v in valuesPerDate.values()):
-        return float("inf")
-    if all(v <= 0 for v in valuesPerDate.values()):
-        return -float("inf")
-
-    result = None
-    try:
-        result = scipy.optimize.newton(lambda r: xnpv(valuesPerDate, r), 0)
-    except (RuntimeError, OverflowError, ValueError):    # Failed to converge?
-        pass
-    except Exception as e:
-        logger.error(f"XIRR - unknown exception during calculation: {e}")
-
-    if not result:
-        logger.info("XIRR - trying another method of calculation")
-        try:
-            result = scipy.optimize.brentq(lambda r: xnpv(valuesPerDate, r), -0.999999999999999, 1e20, maxiter=10**6)
-        except Exception as e:
-            logger.warning(f"Could not calculate XIRR: {e}")
-
-    if not isinstance(result, complex):
-        return result
-    else:
-        return None
+    return performance.xirr(list(valuesPerDate.keys()), list(valuesPerDate.values()))
 
 
-def calculate_xirr(operations, portfolio_value):
+def calculate_xirr(operations_pivot, portfolio_value):
     """
     Функция расчёта реальной эффективности инвестиций по формуле XIRR
     Args:
-        operations: список операций, нужен для учёта всех пополнений и списаний
+        operations_pivot: OperationsPivot операций счета, нужен для учёта всех пополнений и списаний
         portfolio_value: стоимость портфеля на конец периода
 
     Returns: значение XIRR в процентах
 
     """
     logger.info('calculating XIRR..')
-    dates_values = {}
-    for op in operations:
-        if (op.op_type == 'PayIn' or op.op_type == 'PayOut') and op.op_payment != 0:
-            if op.op_currency in supported_currencies:
-                date = datetime.date(op.op_date)
-                rate_for_date = data_parser.get_exchange_rates_for_date_db(date)
-                dates_values[op.op_date] = -(op.op_payment * rate_for_date[op.op_currency])  # reverting the sign
-            else:
-                logger.warning(f'Unsupported currency: {op.op_currency}')
-
-    dates_values_sorted = {}
-    for date in sorted(dates_values.keys()):
-        dates_values_sorted[date] = int(dates_values[date])
+    for currency in operations_pivot.currencies('PayIn', 'PayOut'):
+        if currency not in supported_currencies:
+            logger.warning(f'Unsupported currency: {currency}')
 
     dates_values_composed = {}
-    for date in dates_values_sorted.keys():
-        if datetime.date(date) not in dates_values_composed.keys():
-            dates_values_composed[datetime.date(date)] = dates_values_sorted[date]
-        else:
-            dates_values_composed[datetime.date(date)] += dates_values_sorted[date]
+    for date, value in operations_pivot.daily_flows_rub('PayIn', 'PayOut', currencies=supported_currencies).items():
+        dates_values_composed[date] = int(-value)  # reverting the sign
 
     dates_values_composed[datetime.date(config.now_date)] = int(portfolio_value)
 
@@ -507,81 +520,260 @@ def calculate_xirr(operations, portfolio_value):
     return x
 
 
+def calculate_daily_valuation(account_id, operations):
+    """
+    Стоимость портфеля в рублях на каждый день с начала периода
+    Args:
+        account_id: номер счета - для файла сохраненной оценки
+        operations: операции счета из API
+
+    Returns: valuation.DailyValuation
+    """
+    file_name = valuation.valuation_file_name.format(account_id) if valuation_files else None
+    return valuation.get_daily_valuation(operations.payload.operations, data_parser.database,
+                                         config.start_date, config.now_date, file_name,
+                                         prefetch=functools.partial(async_parser.prefetch_market_data, []))
+
+
+def calculate_xirr_periods(operations_pivot, daily_valuation, exp_tax):
+    """
+    XIRR по календарным годам, кварталам и скользящим 12 месяцам
+    Args:
+        operations_pivot: OperationsPivot операций счета - пополнения и списания по дням
+        daily_valuation: valuation.DailyValuation - стоимость портфеля по дням
+        exp_tax: ожидаемый налог - вычитается из стоимости на сегодня, см. build_account_report()
+
+    Returns: словарь {'years', 'quarters', 'rolling'} со списками performance.PeriodXirr
+    """
+    flows = operations_pivot.daily_flows_rub('PayIn', 'PayOut', currencies=supported_currencies)
+    if not flows:
+        return {}
+    logger.info('calculating XIRR by periods..')
+    today_date = datetime.date(config.now_date)
+    first_day = min(flows)
+    periods = {
+        'years': performance.calendar_periods(first_day, today_date, 12),
+        'quarters': performance.calendar_periods(first_day, today_date, 3),
+        'rolling': performance.rolling_periods(first_day, today_date, 12),
+    }
+    values = daily_valuation.values.copy()
+    values[-1] -= float(exp_tax)
+    return {name: performance.xirr_series(list(flows.keys()), [float(value) for value in flows.values()],
+                                          daily_valuation.days, values, name_periods)
+            for name, name_periods in periods.items()}
+
+
+def calculate_twr(operations_pivot, daily_valuation, exp_tax):
+    """
+    Time-weighted return за весь период и по календарным годам
+    Args:
+        operations_pivot: OperationsPivot операций счета - пополнения и списания по дням
+        daily_valuation: valuation.DailyValuation - стоимость портфеля по дням
+        exp_tax: ожидаемый налог - вычитается из стоимости на сегодня, см. build_account_report()
+
+    Returns: словарь {'total': доходность за период, 'annual': годовая, 'years': {год: доходность}}
+        в процентах, "---" - если не рассчитать; пустой - если пополнений не было
+    """
+    flows = operations_pivot.daily_flows_rub('PayIn', 'PayOut', currencies=supported_currencies)
+    first_payin = min((date for date, value in flows.items() if value > 0), default=None)
+    if first_payin is None:
+        return {}
+    logger.info('calculating TWR..')
+    values = daily_valuation.values.copy()
+    values[-1] -= float(exp_tax)
+    days_flows = performance.daily_flows(daily_valuation.start, len(values), list(flows.keys()),
+                                         [float(value) for value in flows.values()])
+    years = performance.calendar_periods(daily_valuation.start, daily_valuation.end, 12)
+    by_year = performance.twr(values, days_flows, [(start - daily_valuation.start).days
+                                                   for label, start, end in years])
+    total = performance.twr(values, days_flows)[0]
+    # годовая - за время с первого пополнения
+    annual = performance.annualize(total, (daily_valuation.end - first_payin).days + 1)
+
+    def percent(value):
+        return round(float(value) * 100, 2) if math.isfinite(value) else "---"
+
+    return {
+        'total': percent(total),
+        'annual': percent(annual),
+        'years': {int(label): percent(value) for (label, start, end), value in zip(years, by_year)},
+    }
+
+
+def build_account_report(account, cb_rate_matrix=None):
+    """
+    Собирает отчет по одному счету и сохраняет его в Excel.
+    Не использует глобальных переменных - отчеты по разным счетам можно строить параллельно.
+    Args:
+        account: счет из API
+        cb_rate_matrix: RateMatrix для пересчета операций в рубли, если включена
+    """
+    logger.info(account)
+    account_id = account.broker_account_id
+    # from data_parser
+    positions, operations, market_rate_today, currencies = data_parser.get_api_data(account_id)
+    operations_index = OperationsIndex(operations.payload.operations)
+    today_date = datetime.date(config.now_date)
+    investing_period = data_parser.calc_investing_period()
+    investing_period_str = f'{investing_period.years}y {investing_period.months}m {investing_period.days}d'
+    # CB rates for all dates of the account's operations - at once
+    rates_by_date = data_parser.get_exchange_rates_for_dates(
+        [ops.date for ops in operations.payload.operations] + [today_date])
+    rates_today_cb = rates_by_date[today_date]
+
+    # from main
+    cash_rub = get_portfolio_cash_rub(currencies)
+    my_positions = creating_positions_objects(positions, operations_index, market_rate_today,
+                                              rates_by_date, today_date)
+    average_percent = get_average_percent(my_positions, market_rate_today)
+    portfolio_cost_rub_market = get_portfolio_cost_rub_market(my_positions, market_rate_today, cash_rub)
+
+    sum_profile = {}
+    sum_profile['broker_account_type'] = account.broker_account_type.value
+    sum_profile['portfolio_value_rub_cb'] = calculate_cb_value_rub_sum(my_positions, cash_rub)
+    sum_profile['pos_ave_buy_rub'] = calculate_sum_pos_ave_buy_rub(my_positions)
+    sum_profile['exp_tax'] = calculate_sum_exp_tax(my_positions)
+    sum_profile['profit'] = calculate_profit_sum(my_positions)
+    sum_profile['loss'] = calculate_loss_sum(my_positions)
+    sum_profile['profit_tax'] = calculate_profit_tax(sum_profile['profit'])
+    sum_profile['loss_tax'] = calculate_loss_tax(sum_profile['loss'])
+    sum_profile['parts'] = calculate_parts(my_positions, cash_rub)
+
+    my_operations = create_operations_objects(operations, rates_by_date, cb_rate_matrix)
+    # один проход по операциям - суммы по типам, вычет ИИС и потоки для XIRR берутся из него
+    operations_pivot = OperationsPivot(my_operations)
+
+    sum_profile['iis_deduction'] = calculate_iis_deduction(operations_pivot, sum_profile['broker_account_type'])
+
+    # XIRR и TWR считаются от стоимости на сегодня за вычетом ожидаемого налога. Общий XIRR -
+    # от текущей рыночной стоимости, как на листе Portfolio; XIRR по периодам и TWR - от оценки
+    # по дням (цены закрытия, курсы ЦБ), из последнего дня которой вычитается тот же налог:
+    # подстановка рыночной стоимости в ряд по курсам ЦБ дала бы скачок стоимости в последний день
+    xirr_value = calculate_xirr(operations_pivot, (portfolio_cost_rub_market - sum_profile['exp_tax']))
+    daily_valuation = None
+    if config.daily_valuation:
+        # дополнительный расчет: при ошибке отчет строится без XIRR по периодам и TWR
+        try:
+            daily_valuation = calculate_daily_valuation(account_id, operations)
+        except Exception as e:
+            logger.warning(f'daily valuation is not built: {e!r}')
+    xirr_periods = {}
+    if daily_valuation is not None and config.xirr_periods:
+        xirr_periods = calculate_xirr_periods(operations_pivot, daily_valuation, sum_profile['exp_tax'])
+    twr_value = {}
+    if daily_valuation is not None:
+        twr_value = calculate_twr(operations_pivot, daily_valuation, sum_profile['exp_tax'])
+
+    logger.info('calculating operations sums in RUB..')
+    for operation in ['PayIn', 'PayOut', 'Buy', 'BuyCard', 'Sell', 'Coupon', 'Dividend',
+                      'Tax', 'TaxCoupon', 'TaxDividend',
+                      'BrokerCommission', 'ServiceCommission']:
+        sum_profile[operation.lower()] = calculate_operations_sums_rub(operations_pivot, operation)
+
+    logger.info('preparing statistics')
+
+    # PayIn - PayOut
+    payin_payout = sum_profile['payin'] - abs(sum_profile['payout'])
+
+    # EXCEL
+    build_excel_file(account, my_positions, my_operations, rates_today_cb, market_rate_today,
+                     average_percent, portfolio_cost_rub_market, sum_profile,
+                     investing_period_str, cash_rub, payin_payout, xirr_value, tax_rate, xirr_periods,
+                     twr_value)
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Отчет по счетам Тинькофф Инвестиций')
+    verbosity = parser.add_mutually_exclusive_group()
+    verbosity.add_argument('-q', '--quiet', action='store_true', help='выводить только предупреждения')
+    verbosity.add_argument('-d', '--debug', action='store_true', help='отладочный вывод')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='сколько счетов обрабатывать одновременно, по умолчанию - 1')
+    replay = parser.add_mutually_exclusive_group()
+    replay.add_argument('--record', metavar='ARCHIVE',
+                        help='сохранить все ответы API и ЦБ в архив (например, run.pkl.gz)')
+    replay.add_argument('--replay', metavar='ARCHIVE',
+                        help='взять ответы API и ЦБ из архива - без сети и токена')
+    return parser.parse_args()
+
+
+config = Config()
+
+
 if __name__ == '__main__':
 
+    args = parse_arguments()
     logging_level = logging.INFO
 
-    if sys.argv[-1] in ['-q', '--quiet']:
+    if args.quiet:
         logging_level = logging.WARNING
-    elif sys.argv[-1] in ['-d', '--debug']:
+    elif args.debug:
         logging_level = logging.DEBUG
 
     logging.basicConfig(level=logging_level,
-                        format='%(asctime)s [%(levelname)-3s] %(name)s: %(message)s',
+                        format='%(asctime)s [%(levelname)-3s] %(threadName)s %(name)s: %(message)s'
+                        if args.jobs > 1 else '%(asctime)s [%(levelname)-3s] %(name)s: %(message)s',
                         datefmt='%H:%M:%S')
-    logger = logging.getLogger()
+    logger.setLevel(logging_level)
     data_parser.logger.setLevel(logging_level)
+    async_parser.logger.setLevel(logging_level)
+    rate_limiter.logger.setLevel(logging_level)
+    rate_matrix.logger.setLevel(logging_level)
+    valuation.logger.setLevel(logging_level)
+    performance.logger.setLevel(logging_level)
+    recorder.logger.setLevel(logging_level)
+    database.db_logger.setLevel(logging_level)
     excel_builder.logger.setLevel(logging_level)
 
-    config = Config()
     start_time = time.time()
-    tax_rate = 13  # percents
     logger.info('Start')
 
+    if config.cbr_url:
+        data_parser.set_cbr_url(config.cbr_url)
+
+    if args.record or args.replay:
+        # запись и воспроизведение - на пустой временной базе: в архив попадают
+        # все запросы, и результат не зависит от содержимого assets_db.db
+        data_parser.open_database(':memory:')
+        valuation_files = False
+        if args.record:
+            recorder.recorder.start_recording(args.record)
+            # архив сохраняется и при ошибке - чтобы ее можно было воспроизвести
+            atexit.register(recorder.recorder.save)
+        else:
+            recorder.recorder.start_replay(args.replay)
+
+    # CB rates for the whole period - in one request per currency
+    data_parser.load_exchange_rates(config.start_date)
+    cb_rate_matrix = None
+    if config.rate_matrix:
+        cb_rate_matrix = rate_matrix.get_rate_matrix(data_parser.database, supported_currencies,
+                                                     config.start_date, config.now_date)
+
     # get accounts
-    accounts = data_parser.get_accounts()
-    for account in accounts:
-        logger.info(account)
+    accounts = []
+    for account in data_parser.get_accounts():
         account_id = account.broker_account_id
         parse_account = config.get_account_parse_status(account_id)
         if not parse_account:
             account_name = config.get_account_name(account_id)
             logger.warning(f"Account {account_id} ({account_name}) - parsing is OFF")
             continue
-        # from data_parser
-        positions, operations, market_rate_today, currencies = data_parser.get_api_data(account_id)
-        today_date = datetime.date(config.now_date)
-        investing_period = data_parser.calc_investing_period()
-        investing_period_str = f'{investing_period.years}y {investing_period.months}m {investing_period.days}d'
-        rates_today_cb = data_parser.get_exchange_rates_for_date_db(today_date)
-
-        # from main
-        cash_rub = get_portfolio_cash_rub()
-        my_positions = creating_positions_objects()
-        average_percent = get_average_percent()
-        portfolio_cost_rub_market = get_portfolio_cost_rub_market()
-
-        sum_profile = {}
-        sum_profile['broker_account_type'] = account.broker_account_type.value
-        sum_profile['portfolio_value_rub_cb'] = calculate_cb_value_rub_sum()
-        sum_profile['pos_ave_buy_rub'] = calculate_sum_pos_ave_buy_rub()
-        sum_profile['exp_tax'] = calculate_sum_exp_tax()
-        sum_profile['profit'] = calculate_profit_sum()
-        sum_profile['loss'] = calculate_loss_sum()
-        sum_profile['profit_tax'] = calculate_profit_tax()
-        sum_profile['loss_tax'] = calculate_loss_tax()
-        sum_profile['parts'] = calculate_parts()
-
-        my_operations = create_operations_objects()
-
-        sum_profile['iis_deduction'] = calculate_iis_deduction()
-
-        xirr_value = calculate_xirr(my_operations, (portfolio_cost_rub_market - sum_profile['exp_tax']))
-
-        for operation in ['PayIn', 'PayOut', 'Buy', 'BuyCard', 'Sell', 'Coupon', 'Dividend',
-                          'Tax', 'TaxCoupon', 'TaxDividend',
-                          'BrokerCommission', 'ServiceCommission']:
-            logger.info(f'calculating {operation} operations sum in RUB..')
-            sum_profile[operation.lower()] = calculate_operations_sums_rub(operation)
-
-        logger.info('preparing statistics')
-
-        # PayIn - PayOut
-        payin_payout = sum_profile['payin'] - abs(sum_profile['payout'])
-
-        # EXCEL
-        build_excel_file(account, my_positions, my_operations, rates_today_cb, market_rate_today,
-                         average_percent, portfolio_cost_rub_market, sum_profile,
-                         investing_period_str, cash_rub, payin_payout, xirr_value, tax_rate)
-
+        accounts.append(account)
+
+    if args.jobs > 1:
+        # отчеты по счетам строятся параллельно; база и кэши - общие
+        with ThreadPoolExecutor(max_workers=args.jobs, thread_name_prefix='account') as executor:
+            futures = [executor.submit(build_account_report, account, cb_rate_matrix) for account in accounts]
+        for future in futures:
+            future.result()
+    else:
+        for account in accounts:
+            build_account_report(account, cb_rate_matrix)
+
+    if args.replay:
+        logger.info(f'API responses replayed: {recorder.recorder.replayed}')
+    logger.info(f'API connections opened: {api_client.connections.opened}')
+    rate_limiter.limiter.log_stats()
+    data_parser.database.log_cache_stats()
     logger.info(f'done in {time.time() - start_time:.2f} seconds')
@@ -0,0 +1,32 @@
+# Market data shared by the synchronous and concurrent parsers
+# База и отметки о загруженных свечах - общие для data_parser.py и async_parser.py
+from datetime import datetime, timedelta
+
+from database import Database
+
+database = Database()
+# figi -> список периодов, за которые загружены все дневные свечи
+history_loaded = {}
+
+
+def mark_history_loaded(figi, date_from, date_to):
+    # запоминает, что все дневные свечи figi за период уже в базе
+    history_loaded.setdefault(figi, []).append((date_from, date_to))
+
+
+def is_history_loaded(figi, date):
+    return any(date_from <= date < date_to
+               for date_from, date_to in history_loaded.get(figi, []))
+
+
+def missing_candles_from():
+    # с этого дня отсутствие свечи еще не окончательно: свеча за вчера
+    # может появиться позже, поэтому такие дни не запоминаются как дни без торгов
+    today = datetime.now()
+    return datetime(today.year, today.month, today.day) - timedelta(days=1)
+
+
+def candle_row(candle):
+    # свеча API -> (дата, open, high, low, close, volume) для Database.put_candles()
+    date = datetime(candle.time.year, candle.time.month, candle.time.day)
+    return date, candle.o, candle.h, candle.l, candle.c, candle.v
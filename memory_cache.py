@@ -0,0 +1,92 @@
+# In-process cache in front of the SQLite database
+# Повторные запросы одних и тех же данных не доходят до SQLite
+import threading
+import time
+
+from collections import OrderedDict
+
+# Значение-маркер: известно, что данных нет
+MISSING = object()
+
+
+class LRUCache:
+    """Кэш ограниченного размера с вытеснением давно не использованных записей
+
+    Записи хранятся вместе с временем получения данных, поэтому устаревание
+    проверяется так же, как в базе - по max_age при чтении. Маркеры MISSING
+    живут не дольше missing_ttl: запись могла появиться из другого процесса.
+    """
+
+    def __init__(self, name, maxsize=10000, ttl=None, missing_ttl=None):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl  # max_age по умолчанию, в секундах; None - не устаревает
+        self.missing_ttl = missing_ttl  # срок жизни MISSING, в секундах; None - как у остальных
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, max_age=None):
+        """Возвращает значение из кэша
+
+        Args:
+            key: ключ записи
+            max_age (int, optional): допустимый возраст записи в секундах
+
+        Returns:
+            значение, MISSING - если известно, что данных нет,
+            None - если в кэше ничего нет или запись устарела
+        """
+        max_age = self.ttl if max_age is None else max_age
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, timestamp = entry
+            if value is MISSING and self.missing_ttl is not None:
+                max_age = self.missing_ttl if max_age is None else min(max_age, self.missing_ttl)
+            if max_age is not None and time.time() - timestamp > max_age:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value, timestamp=None):
+        """Сохраняет значение
+
+        Args:
+            key: ключ записи
+            value: значение или MISSING
+            timestamp (float, optional): время получения данных, по умолчанию - сейчас
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        with self._lock:
+            self._data[key] = (value, timestamp)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def put_missing(self, key):
+        self.put(key, MISSING)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    @property
+    def hit_rate(self):
+        requests = self.hits + self.misses
+        return self.hits / requests if requests else 0
+
+    def __str__(self):
+        return (f"{self.name}: {len(self)} entries, {self.hits} hits, {self.misses} misses "
+                f"({self.hit_rate:.0%} hit rate), {self.evictions} evictions")
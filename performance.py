@@ -0,0 +1,335 @@
+# Portfolio return calculations on NumPy arrays
+# XIRR: метод Ньютона с точной производной, сразу для набора рядов платежей
+import logging
+
+from collections import namedtuple
+from datetime import date, timedelta
+
+import numpy as np
+import scipy.optimize
+from dateutil.relativedelta import relativedelta
+
+logger = logging.getLogger("Performance")
+logger.setLevel(logging.INFO)
+
+days_per_year = 365.0
+xirr_tolerance = 1e-10  # относительная точность ставки
+xirr_max_iterations = 100
+# интервал поиска ставки, если метод Ньютона не сошелся
+min_rate = -0.999999999999999
+max_rate = 1e10
+
+# XIRR за период: стоимость портфеля на начало и конец, чистые пополнения и ставка
+PeriodXirr = namedtuple('PeriodXirr', 'label start end value_start flows value_end rate')
+
+
+def day_numbers(dates):
+    """Порядковые номера дней (date.toordinal()) - быстрее, чем преобразование в datetime64
+
+    Args:
+        dates (iterable): даты (date или datetime)
+
+    Returns:
+        numpy.ndarray: номера дней
+    """
+    return np.fromiter((day.toordinal() for day in dates), dtype=np.int64)
+
+
+def year_fractions(dates, start=None):
+    """Время от первой даты (или от start) в годах по 365 дней
+
+    Args:
+        dates (iterable): даты (date или datetime)
+        start (date, optional): начало отсчета, по умолчанию - самая ранняя дата
+
+    Returns:
+        numpy.ndarray: доли года
+    """
+    days = day_numbers(dates)
+    if not len(days):
+        return np.empty(0)
+    first = days.min() if start is None else start.toordinal()
+    return (days - first) / days_per_year
+
+
+def xnpv(rate, times, values):
+    """Чистая приведенная стоимость нерегулярных платежей
+
+    Args:
+        rate (float или numpy.ndarray): годовая ставка; для набора рядов - по ставке на ряд
+        times (numpy.ndarray): время платежей в годах, для набора рядов - матрица ряд x платеж
+        values (numpy.ndarray): платежи той же формы
+
+    Returns:
+        float или numpy.ndarray: стоимость
+    """
+    rate = np.asarray(rate, dtype=np.float64)
+    discount = (1.0 + rate[..., None]) ** -times
+    return (values * discount).sum(axis=-1)
+
+
+def _newton(times, values, guess, tolerance, max_iterations):
+    # метод Ньютона одновременно для всех рядов; не сошедшиеся ряды - nan
+    rates = np.array(np.broadcast_to(np.asarray(guess, dtype=np.float64), (len(values),)))
+    active = np.flatnonzero(np.isfinite(rates))
+    rates[~np.isfinite(rates)] = 0.0
+    with np.errstate(all='ignore'):
+        for _ in range(max_iterations):
+            if not len(active):
+                break
+            rate = rates[active][:, None]
+            t, v = times[active], values[active]
+            discounted = v * (1.0 + rate) ** -t
+            npv = discounted.sum(axis=1)
+            # производная: d/dr v * (1 + r)^-t = -t * v * (1 + r)^(-t - 1)
+            derivative = (-t * discounted).sum(axis=1) / (1.0 + rate[:, 0])
+            new = rates[active] - npv / derivative
+            # ставка не может быть -100% и ниже - шаг укорачивается
+            new = np.where(new <= -1.0, (rates[active] - 1.0) / 2, new)
+            failed = ~np.isfinite(new)
+            done = np.abs(new - rates[active]) <= tolerance * np.maximum(1.0, np.abs(new))
+            rates[active] = new
+            rates[active[failed]] = np.nan
+            active = active[~(done | failed)]
+    rates[active] = np.nan
+    return rates
+
+
+def _bracket(times, values):
+    # поиск корня на интервале - если метод Ньютона не сошелся
+    def npv(rate):
+        return float(xnpv(rate, times, values))
+
+    try:
+        high = 1.0
+        while np.sign(npv(min_rate)) == np.sign(npv(high)) and high < max_rate:
+            high *= 10
+        return scipy.optimize.brentq(npv, min_rate, min(high, max_rate), xtol=1e-14, maxiter=1000)
+    except (ValueError, RuntimeError, OverflowError) as e:
+        logger.warning(f"Could not calculate XIRR: {e}")
+        return np.nan
+
+
+def xirr_batch(series, guess=0.1, tolerance=xirr_tolerance, max_iterations=xirr_max_iterations):
+    """XIRR для набора рядов платежей за один вызов
+
+    Args:
+        series (iterable): ряды - пары (даты, платежи)
+        guess (float или iterable): начальное приближение, общее или по ряду
+        tolerance (float): относительная точность ставки
+        max_iterations (int): максимум итераций метода Ньютона
+
+    Returns:
+        numpy.ndarray: годовые ставки (0.1 = 10%); inf - если в ряду нет выплат,
+            -inf - если нет вложений, nan - если ряд пуст или ставка не найдена
+    """
+    series = [(year_fractions(dates), np.asarray(values, dtype=np.float64)) for dates, values in series]
+    length = max([len(values) for times, values in series], default=0)
+    # ряды разной длины дополняются нулевыми платежами
+    times = np.zeros((len(series), length))
+    values = np.zeros((len(series), length))
+    for row, (row_times, row_values) in enumerate(series):
+        times[row, :len(row_times)] = row_times
+        values[row, :len(row_values)] = row_values
+    return xirr_arrays(times, values, guess, tolerance, max_iterations)
+
+
+def xirr_arrays(times, values, guess=0.1, tolerance=xirr_tolerance, max_iterations=xirr_max_iterations):
+    """XIRR по готовым матрицам времени (в годах) и платежей: ряд x платеж
+
+    Returns:
+        numpy.ndarray: годовые ставки, см. xirr_batch()
+    """
+    times = np.atleast_2d(np.asarray(times, dtype=np.float64))
+    values = np.atleast_2d(np.asarray(values, dtype=np.float64))
+    result = np.full(len(values), np.nan)
+    nonzero = values != 0
+    has_in = (values < 0).any(axis=1)
+    has_out = (values > 0).any(axis=1)
+    result[nonzero.any(axis=1) & ~has_in] = np.inf
+    result[nonzero.any(axis=1) & ~has_out] = -np.inf
+    solvable = np.flatnonzero(has_in & has_out)
+    if not len(solvable):
+        return result
+    guess = np.broadcast_to(np.asarray(guess, dtype=np.float64), (len(values),))[solvable]
+    result[solvable] = _newton(times[solvable], values[solvable], guess, tolerance, max_iterations)
+    for row in solvable[np.isnan(result[solvable])]:
+        logger.debug("XIRR - Newton's method did not converge, trying bracketing")
+        result[row] = _bracket(times[row], values[row])
+    return result
+
+
+def xirr(dates, values, guess=0.1):
+    """XIRR одного ряда платежей
+
+    Args:
+        dates (iterable): даты платежей
+        values (iterable): платежи: вложения - со знаком минус, выплаты - плюс
+        guess (float): начальное приближение
+
+    Returns:
+        float: годовая ставка (0.1 = 10%), inf/-inf - если платежи одного знака,
+            None - если платежей нет или ставка не найдена
+    """
+    values = list(values)
+    if not values:
+        return None
+    result = xirr_batch([(dates, values)], guess)[0]
+    return None if np.isnan(result) else float(result)
+
+
+def calendar_periods(first_day, last_day, months=12):
+    """Календарные периоды внутри [first_day, last_day]: годы, кварталы
+
+    Args:
+        first_day (date): первый день
+        last_day (date): последний день
+        months (int): длина периода в месяцах: 12 - год, 3 - квартал
+
+    Returns:
+        list: (название, первый день, последний день); крайние периоды обрезаны по first_day и last_day
+    """
+    periods = []
+    start = date(first_day.year, (first_day.month - 1) // months * months + 1, 1)
+    while start <= last_day:
+        end = start + relativedelta(months=months) - timedelta(days=1)
+        if months == 12:
+            label = str(start.year)
+        elif months == 3:
+            label = f"{start.year} Q{(start.month - 1) // 3 + 1}"
+        else:
+            label = f"{start:%Y-%m}"
+        periods.append((label, max(start, first_day), min(end, last_day)))
+        start += relativedelta(months=months)
+    return periods
+
+
+def rolling_periods(first_day, last_day, months=12):
+    """Скользящие окна длиной months месяцев с шагом в месяц
+
+    Окна заканчиваются в последние дни месяцев и в last_day;
+    окна, начинающиеся раньше first_day, не включаются.
+
+    Returns:
+        list: (название, первый день, последний день)
+    """
+    periods = []
+    end = date(first_day.year, first_day.month, 1) + relativedelta(months=months) - timedelta(days=1)
+    while True:
+        end = min(end, last_day)
+        start = end - relativedelta(months=months) + timedelta(days=1)
+        if start >= first_day:
+            periods.append((f"{end:%Y-%m-%d}", start, end))
+        if end == last_day:
+            return periods
+        end = date(end.year, end.month, 1) + relativedelta(months=2) - timedelta(days=1)
+
+
+def xirr_series(flow_days, flow_values, valuation_days, valuation_values, periods, guess=0.1):
+    """XIRR по набору периодов
+
+    Ряд платежей периода: стоимость портфеля на конец дня перед началом периода - вложение,
+    пополнения и выводы внутри периода, стоимость на конец последнего дня - выплата.
+    Массивы потоков и оценок сортируются один раз, платежи периода - срезы по searchsorted;
+    метод Ньютона для каждого периода начинается со ставки предыдущего.
+
+    Args:
+        flow_days (iterable): даты пополнений и выводов
+        flow_values (iterable): суммы в рублях: пополнения - плюс, выводы - минус
+        valuation_days (iterable): даты оценок стоимости портфеля
+        valuation_values (iterable): стоимость портфеля в рублях на конец дня;
+            между оценками действует последняя, до первой - ноль
+        periods (iterable): (название, первый день, последний день)
+        guess (float): начальное приближение для первого периода
+
+    Returns:
+        list: PeriodXirr по периодам; rate - годовая ставка,
+            None - если в периоде нет ни стоимости, ни потоков
+    """
+    flow_days = day_numbers(flow_days)
+    flow_values = np.asarray(flow_values, dtype=np.float64)
+    order = np.argsort(flow_days, kind='stable')
+    flow_days, flow_values = flow_days[order], flow_values[order]
+    valuation_days = day_numbers(valuation_days)
+    valuation_values = np.asarray(valuation_values, dtype=np.float64)
+    order = np.argsort(valuation_days, kind='stable')
+    valuation_days, valuation_values = valuation_days[order], valuation_values[order]
+
+    def value_on(day):
+        index = np.searchsorted(valuation_days, day, side='right') - 1
+        return float(valuation_values[index]) if index >= 0 else 0.0
+
+    result = []
+    for label, start, end in periods:
+        origin, last = start.toordinal() - 1, end.toordinal()
+        low, high = np.searchsorted(flow_days, [origin + 1, last + 1])
+        value_start, value_end = value_on(origin), value_on(last)
+        flows = flow_values[low:high]
+        times = np.concatenate(([0.0], (flow_days[low:high] - origin) / days_per_year,
+                                [(last - origin) / days_per_year]))
+        values = np.concatenate(([-value_start], -flows, [value_end]))
+        rate = xirr_arrays(times, values, guess)[0]
+        if np.isfinite(rate):
+            guess = rate
+        result.append(PeriodXirr(label, start, end, value_start, float(flows.sum()), value_end,
+                                 None if np.isnan(rate) else float(rate)))
+    return result
+
+
+def daily_flows(start, days, dates, amounts):
+    """Потоки по дням в виде плотного массива
+
+    Args:
+        start (date): первый день
+        days (int): количество дней
+        dates (iterable): даты потоков
+        amounts (iterable): суммы
+
+    Returns:
+        numpy.ndarray: сумма потоков за каждый день; потоки вне периода не учитываются
+    """
+    rows = day_numbers(dates) - start.toordinal()
+    amounts = np.asarray(amounts, dtype=np.float64)
+    inside = (rows >= 0) & (rows < days)
+    flows = np.zeros(days)
+    np.add.at(flows, rows[inside], amounts[inside])
+    return flows
+
+
+def twr(values, flows, starts=(0,)):
+    """Time-weighted return: произведение дневных доходностей, не зависящее от сроков пополнений
+
+    Пополнения и выводы считаются сделанными в начале дня:
+    доходность дня = стоимость на конец дня / (стоимость на конец прошлого дня + поток дня) - 1.
+    Дни без вложенных средств дают нулевую доходность.
+
+    Args:
+        values (numpy.ndarray): стоимость портфеля на конец дня; для набора счетов - матрица счет x день
+        flows (numpy.ndarray): пополнения (плюс) и выводы (минус) за день той же формы
+        starts (iterable): номера первых дней периодов по возрастанию; период идет до начала следующего
+
+    Returns:
+        numpy.ndarray: доходность за каждый период (0.1 = 10%), последняя ось - периоды
+    """
+    values = np.asarray(values, dtype=np.float64)
+    flows = np.asarray(flows, dtype=np.float64)
+    # стоимость на конец прошлого дня; до первого дня - ноль
+    previous = np.concatenate((np.zeros(values.shape[:-1] + (1,)), values[..., :-1]), axis=-1)
+    invested = previous + flows
+    with np.errstate(divide='ignore', invalid='ignore'):
+        growth = np.where(invested > 0, values / invested, 1.0)
+    return np.multiply.reduceat(growth, np.asarray(starts, dtype=np.int64), axis=-1) - 1.0
+
+
+def annualize(returns, days):
+    """Доходность за период -> годовая
+
+    Args:
+        returns (float или numpy.ndarray): доходность за период
+        days (int или numpy.ndarray): длина периода в днях
+
+    Returns:
+        float или numpy.ndarray: годовая доходность
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (1.0 + np.asarray(returns, dtype=np.float64)) ** (days_per_year / np.asarray(days)) - 1.0
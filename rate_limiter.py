@@ -0,0 +1,149 @@
+# Rate limiting for Tinkoff API requests
+# Лимиты запросов OpenAPI v1 считаются отдельно по группам методов
+import asyncio
+import logging
+import random
+import threading
+import time
+
+import tinvest
+
+logger = logging.getLogger("Limiter")
+logger.setLevel(logging.INFO)
+
+# Запросов в минуту по группам методов API v1
+default_quotas = {
+    'market': 240,  # /market/* - свечи, стаканы, поиск инструментов
+    'operations': 120,  # /operations
+    'portfolio': 120,  # /portfolio, /portfolio/currencies, /user/accounts
+}
+
+
+class TokenBucket:
+    """Ведро токенов: не более rate запросов в минуту, пачкой до capacity"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate / 60  # токенов в секунду
+        self.capacity = capacity or max(1, rate // 10)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """Забирает токен (в долг, если токенов нет)
+
+        Returns:
+            float: сколько секунд подождать до выполнения запроса
+        """
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens / self.rate
+
+    def drain(self):
+        # API сообщил о превышении - все токены считаем израсходованными
+        with self._lock:
+            self.tokens = min(self.tokens, 0)
+            self.updated = time.monotonic()
+
+
+class ThrottlingStats:
+    """Сколько раз и как долго ждали из-за ограничений API"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.scheduled_wait = 0.0  # ожидание свободного токена
+        self.throttled = 0  # получено ответов 429
+        self.backoff_wait = 0.0  # пауза после ответа 429
+
+    def add(self, requests=0, scheduled_wait=0.0, throttled=0, backoff_wait=0.0):
+        with self._lock:
+            self.requests += requests
+            self.scheduled_wait += scheduled_wait
+            self.throttled += throttled
+            self.backoff_wait += backoff_wait
+
+    def __str__(self):
+        return (f"{self.requests} requests, waited {self.scheduled_wait:.2f}s for quota, "
+                f"{self.throttled} throttled responses, {self.backoff_wait:.2f}s backoff")
+
+
+class RateLimiter:
+    """Планирует запросы к API в пределах лимитов по группам методов.
+    При ответе 429 повторяет запрос с экспоненциальной паузой и случайным разбросом.
+    """
+
+    def __init__(self, quotas=None, base_delay=0.5, max_delay=30.0, max_retries=10):
+        quotas = quotas or default_quotas
+        self.buckets = {endpoint: TokenBucket(rate) for endpoint, rate in quotas.items()}
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_retries = max_retries
+        self.stats = {endpoint: ThrottlingStats() for endpoint in quotas.keys()}
+
+    def _backoff(self, endpoint, attempt):
+        if attempt >= self.max_retries:
+            logger.error(f"API limit for '{endpoint}' still exceeded after {attempt} retries")
+            return None
+        self.buckets[endpoint].drain()
+        # "full jitter" - случайная пауза до экспоненциально растущего предела
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        logger.warning(f"Превышена частота запросов API ({endpoint}). "
+                       f"Пауза {delay:.2f} с.")
+        self.stats[endpoint].add(throttled=1, backoff_wait=delay)
+        return delay
+
+    def call(self, endpoint, method, *args, **kwargs):
+        """Выполняет запрос к API с соблюдением лимитов
+
+        Args:
+            endpoint (str): группа методов API - ключ из quotas
+            method (callable): метод клиента tinvest
+
+        Returns:
+            результат method(*args, **kwargs)
+        """
+        attempt = 0
+        while True:
+            wait = self.buckets[endpoint].reserve()
+            self.stats[endpoint].add(requests=1, scheduled_wait=wait)
+            if wait:
+                time.sleep(wait)
+            try:
+                return method(*args, **kwargs)
+            except tinvest.exceptions.TooManyRequestsError:
+                delay = self._backoff(endpoint, attempt)
+                if delay is None:
+                    raise
+            time.sleep(delay)
+            attempt += 1
+
+    async def call_async(self, endpoint, method, *args, **kwargs):
+        """То же, что call(), для корутин tinvest.AsyncClient"""
+        attempt = 0
+        while True:
+            wait = self.buckets[endpoint].reserve()
+            self.stats[endpoint].add(requests=1, scheduled_wait=wait)
+            if wait:
+                await asyncio.sleep(wait)
+            try:
+                return await method(*args, **kwargs)
+            except tinvest.exceptions.TooManyRequestsError:
+                delay = self._backoff(endpoint, attempt)
+                if delay is None:
+                    raise
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    def log_stats(self):
+        for endpoint, stats in self.stats.items():
+            if stats.requests:
+                logger.info(f"API '{endpoint}': {stats}")
+
+
+limiter = RateLimiter()
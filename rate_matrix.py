@@ -0,0 +1,195 @@
+# Dense matrix of CB exchange rates: day x currency
+# Пересчет в рубли целых столбцов платежей одной векторной операцией в int64
+import json
+import logging
+import os
+
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+import numpy as np
+
+logger = logging.getLogger("RateMatrix")
+logger.setLevel(logging.INFO)
+
+matrix_file_name = "rates_matrix.npy"
+# курсы ищутся с запасом до начала периода - праздники в начале года
+lookback = timedelta(days=30)
+# точность в знаках после запятой: платежи - копейки, курсы ЦБ - 4 знака;
+# произведение в целых числах с этими масштабами точное
+payment_digits = 2
+rate_digits = 4
+
+
+def _day(date):
+    return np.datetime64(datetime(date.year, date.month, date.day).date(), 'D')
+
+
+def _scaled(values, scale):
+    """Значения float в целых единицах масштаба
+
+    Args:
+        values (numpy.ndarray): значения
+        scale (int): масштаб
+
+    Returns:
+        tuple: целые значения (numpy.ndarray int64) и маска точно представимых
+    """
+    scaled = values * scale
+    rounded = np.rint(scaled)
+    exact = np.isfinite(scaled) & (np.abs(scaled - rounded) < 1e-3) & (np.abs(rounded) < 2.0 ** 62)
+    return np.where(exact, rounded, 0).astype(np.int64), exact
+
+
+class RateMatrix:
+    """Курсы ЦБ: строка - день начиная со start, столбец - валюта.
+    Дни без публикации заполнены последним известным курсом.
+    """
+
+    def __init__(self, start, currencies, values, rates_version=None):
+        self.start = _day(start)
+        self.currencies = list(currencies)
+        self.columns = {currency: column for column, currency in enumerate(self.currencies)}
+        self.values = values
+        self.rates_version = rates_version  # версия таблицы rates на момент построения
+
+    @property
+    def end(self):
+        return self.start + len(self.values) - 1
+
+    def covers(self, date_from, date_to, currencies):
+        return (self.start <= _day(date_from) and _day(date_to) <= self.end
+                and set(currencies) <= set(self.currencies))
+
+    def day_index(self, dates):
+        """Номера строк матрицы для дат
+
+        Args:
+            dates (iterable): даты (date или datetime)
+
+        Returns:
+            numpy.ndarray: номера строк
+        """
+        days = np.array([_day(date) for date in dates], dtype='datetime64[D]')
+        index = (days - self.start).astype(np.int64)
+        if len(index) and (index.min() < 0 or index.max() >= len(self.values)):
+            raise KeyError(f"Dates outside rate matrix {self.start} - {self.end}")
+        return index
+
+    def rates(self, dates, currencies):
+        """Курсы валют на даты; nan - для неизвестной валюты
+
+        Args:
+            dates (iterable): даты
+            currencies (iterable): коды валют, по одному на дату
+
+        Returns:
+            numpy.ndarray: курсы
+        """
+        rows = self.day_index(dates)
+        columns = np.array([self.columns.get(currency, -1) for currency in currencies], dtype=np.int64)
+        if not len(rows):
+            return np.empty(0)
+        return np.where(columns >= 0, self.values[rows, np.maximum(columns, 0)], np.nan)
+
+    def convert(self, amounts, currencies, dates):
+        """Пересчитывает суммы в рубли по курсу ЦБ на дату
+
+        Args:
+            amounts (iterable): суммы в валюте
+            currencies (iterable): валюты сумм
+            dates (iterable): даты
+
+        Returns:
+            list: суммы в рублях (Decimal), None - если курс неизвестен
+                или сумма не пересчитывается точно
+        """
+        # суммы и курсы переводятся в целые копейки и десятитысячные доли,
+        # перемножаются в int64 без округлений и один раз переводятся в Decimal
+        amounts = np.array([float(amount) for amount in amounts], dtype=np.float64)
+        rates = self.rates(dates, currencies)
+        if not len(rates):
+            return []
+        cents, exact_amounts = _scaled(amounts, 10 ** payment_digits)
+        rate_units, exact_rates = _scaled(rates, 10 ** rate_digits)
+        # суммы с долями копеек, курсы с большей точностью и риск переполнения
+        # int64 - не пересчитываются (None), для них остается пересчет в Decimal
+        exact = exact_amounts & exact_rates & \
+            (np.abs(cents.astype(np.float64) * rate_units) < 2.0 ** 62)
+        products = np.where(exact, cents * rate_units, 0).tolist()
+        return [Decimal(product).scaleb(-(payment_digits + rate_digits)) if is_exact else None
+                for product, is_exact in zip(products, exact.tolist())]
+
+    def save(self, file_name=matrix_file_name):
+        np.save(file_name, np.ascontiguousarray(self.values))
+        with open(file_name + '.json', 'w') as meta_file:
+            json.dump({'start': str(self.start),
+                       'currencies': self.currencies,
+                       'rates_version': self.rates_version}, meta_file)
+
+    @classmethod
+    def load(cls, file_name=matrix_file_name):
+        """Открывает сохраненную матрицу без чтения в память (memory map)
+
+        Returns:
+            RateMatrix: матрица или None, если файла нет
+        """
+        if not os.path.isfile(file_name) or not os.path.isfile(file_name + '.json'):
+            return None
+        try:
+            with open(file_name + '.json') as meta_file:
+                meta = json.load(meta_file)
+            values = np.load(file_name, mmap_mode='r')
+        except (OSError, ValueError) as e:
+            logger.warning(f"Rate matrix {file_name} is broken: {e!r}")
+            return None
+        return cls(datetime.strptime(meta['start'], "%Y-%m-%d"), meta['currencies'], values,
+                   meta.get('rates_version'))
+
+
+def build(database, currencies, date_from, date_to):
+    """Строит матрицу курсов из таблицы rates
+
+    Args:
+        database (Database): база с курсами
+        currencies (iterable): коды валют
+        date_from (datetime): первый день
+        date_to (datetime): последний день (включительно)
+
+    Returns:
+        RateMatrix: матрица, nan - курс не известен
+    """
+    currencies = list(currencies)
+    first = _day(date_from - lookback)
+    days = (_day(date_to) - first).astype(np.int64) + 1
+    values = np.full((days, len(currencies)), np.nan)
+    for column, currency in enumerate(currencies):
+        history = database.get_exchange_rate_history(currency, date_from - lookback, date_to)
+        if not history:
+            continue
+        rows = (np.array([date for date, rate in history], dtype='datetime64[D]') - first).astype(np.int64)
+        values[rows, column] = [float(rate) for date, rate in history]
+    # последний известный курс - на дни без публикации
+    known = np.where(np.isnan(values), 0, np.arange(days)[:, None])
+    np.maximum.accumulate(known, axis=0, out=known)
+    values = values[known, np.arange(len(currencies))]
+    offset = (_day(date_from) - first).astype(np.int64)
+    return RateMatrix(date_from, currencies, values[offset:], database.get_rates_version())
+
+
+def get_rate_matrix(database, currencies, date_from, date_to, file_name=matrix_file_name):
+    """Возвращает матрицу курсов за период: сохраненную или построенную заново,
+    если курсы в базе изменились или период не покрыт
+
+    Returns:
+        RateMatrix: матрица, открытая через memory map
+    """
+    matrix = RateMatrix.load(file_name)
+    if matrix and matrix.covers(date_from, date_to, currencies) \
+            and matrix.rates_version == database.get_rates_version():
+        logger.debug(f"Using saved rate matrix {file_name}")
+        return matrix
+    logger.info('building rate matrix..')
+    matrix = build(database, currencies, date_from, date_to)
+    matrix.save(file_name)
+    return RateMatrix.load(file_name)
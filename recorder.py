@@ -0,0 +1,191 @@
+# Record and replay of Tinkoff API and CB responses
+# Все запросы data_parser.py и async_parser.py проходят через recorder.call():
+# в режиме записи ответы сохраняются в сжатый архив, в режиме воспроизведения
+# берутся из архива - без токена, сети и лимитов API
+import gzip
+import inspect
+import logging
+import pickle
+import threading
+
+from collections import defaultdict
+from datetime import date, datetime
+from decimal import Decimal
+from enum import Enum
+
+from rate_limiter import limiter
+
+logger = logging.getLogger("Recorder")
+logger.setLevel(logging.INFO)
+
+archive_version = 1
+
+
+class ReplayError(LookupError):
+    """В архиве нет ответа на запрос"""
+
+
+def _normalize(value, drop_dates=False):
+    # значение аргумента -> неизменяемое представление для ключа архива
+    if isinstance(value, (datetime, date)):
+        return None if drop_dates else value.isoformat()
+    if isinstance(value, Enum):
+        return value.value
+    if isinstance(value, Decimal):
+        return str(value)
+    if isinstance(value, (list, tuple)):
+        return tuple(_normalize(item, drop_dates) for item in value)
+    return value if isinstance(value, (str, int, float, bool, type(None))) else repr(value)
+
+
+def request_key(method, args, kwargs, drop_dates=False):
+    """Ключ запроса: имя метода и его аргументы по именам
+
+    Args:
+        method (callable): метод клиента tinvest или класс pycbrf
+        args (tuple): позиционные аргументы
+        kwargs (dict): именованные аргументы
+        drop_dates (bool): не учитывать даты - для поиска того же запроса,
+            сделанного в другой день
+
+    Returns:
+        tuple: ключ
+    """
+    try:
+        arguments = inspect.signature(method).bind(*args, **kwargs).arguments
+    except (TypeError, ValueError):
+        arguments = dict(enumerate(args), **kwargs)
+    return (method.__name__,) + tuple((str(name), _normalize(value, drop_dates))
+                                      for name, value in arguments.items())
+
+
+class Recorder:
+    """Запись и воспроизведение ответов внешних API"""
+
+    def __init__(self):
+        self.mode = None  # None, 'record' или 'replay'
+        self.file_name = None
+        # ключ -> ответы по порядку: (исключение?, pickle ответа)
+        self.responses = defaultdict(list)
+        self.loose_keys = {}  # полный ключ -> ключ без дат, заполняется при записи
+        self.loose = defaultdict(list)  # ключ без дат -> полные ключи, при воспроизведении
+        self.served = defaultdict(int)  # ключ -> сколько ответов уже выдано
+        self.replayed = 0
+        self._lock = threading.Lock()
+
+    def start_recording(self, file_name):
+        self.mode = 'record'
+        self.file_name = file_name
+        self.responses.clear()
+        self.loose_keys.clear()
+        logger.info(f"Recording API responses to {file_name}")
+
+    def start_replay(self, file_name):
+        with gzip.open(file_name, 'rb') as archive:
+            data = pickle.load(archive)
+        if data.get('version') != archive_version:
+            raise ValueError(f"Unsupported archive version {data.get('version')} in {file_name}")
+        self.mode = 'replay'
+        self.file_name = file_name
+        self.responses = defaultdict(list, data['responses'])
+        self.loose.clear()
+        for key, loose_key in data['loose'].items():
+            self.loose[loose_key].append(key)
+        self.served.clear()
+        logger.info(f"Replaying {sum(map(len, self.responses.values()))} API responses "
+                    f"recorded {data['recorded']:%Y-%m-%d %H:%M} from {file_name}")
+
+    def save(self):
+        if self.mode != 'record':
+            return
+        with self._lock:
+            data = {
+                'version': archive_version,
+                'recorded': datetime.now(),
+                'responses': dict(self.responses),
+                'loose': self.loose_keys,
+            }
+            with gzip.open(self.file_name, 'wb', compresslevel=6) as archive:
+                pickle.dump(data, archive, protocol=pickle.HIGHEST_PROTOCOL)
+        logger.info(f"{sum(map(len, self.responses.values()))} API responses saved to {self.file_name}")
+
+    def _store(self, key, loose_key, failed, result):
+        try:
+            data = pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            # исключения клиента бывают с непереносимыми полями - сохраняется текст
+            data = pickle.dumps(RuntimeError(repr(result)))
+        with self._lock:
+            self.responses[key].append((failed, data))
+            self.loose_keys[key] = loose_key
+
+    def _replay(self, method, args, kwargs):
+        key = request_key(method, args, kwargs)
+        with self._lock:
+            if key not in self.responses:
+                # запрос с другими датами (запись сделана в другой день):
+                # берется первый по порядку записи запрос с теми же остальными аргументами
+                candidates = self.loose.get(request_key(method, args, kwargs, drop_dates=True), [])
+                unused = [candidate for candidate in candidates
+                          if self.served[candidate] < len(self.responses[candidate])]
+                if not candidates:
+                    raise ReplayError(f"No recorded response for {key}")
+                key = unused[0] if unused else candidates[-1]
+            responses = self.responses[key]
+            # повторные запросы получают ответы по порядку, после последнего - последний
+            failed, data = responses[min(self.served[key], len(responses) - 1)]
+            self.served[key] += 1
+            self.replayed += 1
+        result = pickle.loads(data)  # новая копия - ответ можно изменять
+        if failed:
+            raise result
+        return result
+
+    def call(self, endpoint, method, *args, **kwargs):
+        """Выполняет запрос к API, записывая или воспроизводя ответ
+
+        Args:
+            endpoint (str): группа методов API для limiter, None - без ограничений
+            method (callable): метод клиента tinvest или класс pycbrf
+
+        Returns:
+            результат method(*args, **kwargs)
+        """
+        if self.mode == 'replay':
+            return self._replay(method, args, kwargs)
+        if self.mode is None:
+            return self._call(endpoint, method, *args, **kwargs)
+        key = request_key(method, args, kwargs)
+        loose_key = request_key(method, args, kwargs, drop_dates=True)
+        try:
+            result = self._call(endpoint, method, *args, **kwargs)
+        except Exception as e:
+            self._store(key, loose_key, True, e)
+            raise
+        self._store(key, loose_key, False, result)
+        return result
+
+    async def call_async(self, endpoint, method, *args, **kwargs):
+        """То же, что call(), для корутин tinvest.AsyncClient"""
+        if self.mode == 'replay':
+            return self._replay(method, args, kwargs)
+        if self.mode is None:
+            return await limiter.call_async(endpoint, method, *args, **kwargs)
+        key = request_key(method, args, kwargs)
+        loose_key = request_key(method, args, kwargs, drop_dates=True)
+        try:
+            result = await limiter.call_async(endpoint, method, *args, **kwargs)
+        except Exception as e:
+            self._store(key, loose_key, True, e)
+            raise
+        self._store(key, loose_key, False, result)
+        return result
+
+    @staticmethod
+    def _call(endpoint, method, *args, **kwargs):
+        if endpoint is None:
+            return method(*args, **kwargs)
+        return limiter.call(endpoint, method, *args, **kwargs)
+
+
+recorder = Recorder()
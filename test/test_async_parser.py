@@ -0,0 +1,83 @@
+import asyncio
+import unittest
+from datetime import datetime, timezone
+from unittest import mock
+
+import tinvest
+
+import async_parser
+
+
+class FakeAsyncClient:
+    # первый запрос за второй квартал завершается таймаутом
+    requests = []
+
+    def __init__(self, limit=None):
+        pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    async def get_operations(self, from_, to, broker_account_id=None):
+        self.requests.append(from_)
+        if from_.month == 4 and self.requests.count(from_) == 1:
+            raise asyncio.TimeoutError
+        operation = tinvest.Operation(id=f'{from_:%m}', date=from_, status='Done', currency='RUB', payment=1,
+                                      isMarginCall=False, operationType='PayIn')
+        return tinvest.OperationsResponse(payload=tinvest.Operations(operations=[operation]),
+                                          trackingId='test', status='Ok')
+
+
+class TestLoadOperations(unittest.TestCase):
+
+    def test_operation_ranges(self):
+        ranges = list(async_parser._operation_ranges(datetime(2021, 1, 15), datetime(2021, 8, 1)))
+        self.assertEqual(ranges, [(datetime(2021, 1, 15), datetime(2021, 4, 15)),
+                                  (datetime(2021, 4, 15), datetime(2021, 7, 15)),
+                                  (datetime(2021, 7, 15), datetime(2021, 8, 1))])
+
+    def test_failed_range_is_retried_alone(self):
+        FakeAsyncClient.requests = []
+        loaded = {}
+        with mock.patch('async_parser.api_client.make_async_client', FakeAsyncClient), \
+                mock.patch('async_parser.operations_retry_delay', 0):
+            failed = async_parser.load_operations(
+                'TSTACCOUNT', datetime(2021, 1, 1, tzinfo=timezone.utc), datetime(2021, 12, 31, tzinfo=timezone.utc),
+                lambda range_from, range_to, operations: loaded.update({range_from.month: operations}))
+        self.assertEqual(failed, [])
+        self.assertEqual(sorted(loaded), [1, 4, 7, 10])
+        self.assertEqual(loaded[4][0].id, '04')
+        # повторен только период с ошибкой
+        self.assertEqual(len(FakeAsyncClient.requests), 5)
+
+    def test_failed_range_is_reported(self):
+        with mock.patch('async_parser.api_client.make_async_client', FakeAsyncClient), \
+                mock.patch('async_parser.operations_retries', 0):
+            FakeAsyncClient.requests = []
+            failed = async_parser.load_operations(
+                'TSTACCOUNT', datetime(2021, 1, 1, tzinfo=timezone.utc), datetime(2021, 6, 1, tzinfo=timezone.utc),
+                lambda range_from, range_to, operations: None)
+        self.assertEqual(failed, [(datetime(2021, 4, 1, tzinfo=timezone.utc),
+                                   datetime(2021, 6, 1, tzinfo=timezone.utc))])
+
+    def test_unexpected_error_is_not_retried(self):
+        class BrokenClient(FakeAsyncClient):
+            async def get_operations(self, from_, to, broker_account_id=None):
+                self.requests.append(from_)
+                raise ValueError('bad response')
+
+        BrokenClient.requests = []
+        with mock.patch('async_parser.api_client.make_async_client', BrokenClient), \
+                mock.patch('async_parser.operations_retry_delay', 0):
+            with self.assertRaises(ValueError):
+                async_parser.load_operations(
+                    'TSTACCOUNT', datetime(2021, 1, 1, tzinfo=timezone.utc),
+                    datetime(2021, 2, 1, tzinfo=timezone.utc), lambda range_from, range_to, operations: None)
+        self.assertEqual(len(BrokenClient.requests), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
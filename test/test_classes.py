@@ -0,0 +1,163 @@
+import random
+import unittest
+
+from datetime import datetime
+from decimal import Decimal
+
+from tinvest.schemas import OperationTypeWithCommission
+
+from classes import FifoLedger, OperationsIndex, OperationsPivot, PortfolioOperation
+
+
+def reference_average(operations):
+    # прежний расчет: список из отдельных бумаг
+    item_list = []
+    for op_type, quantity, price in operations:
+        if op_type == 'Buy':
+            item_list += [price] * quantity
+        else:
+            del item_list[:quantity]
+    if len(item_list) == 0:
+        return 0
+    return sum(item_list) / len(item_list)
+
+
+class TestFifoLedger(unittest.TestCase):
+
+    def apply(self, operations):
+        ledger = FifoLedger()
+        for op_type, quantity, price in operations:
+            if op_type == 'Buy':
+                ledger.buy(quantity, price, datetime(2021, 1, 1))
+            else:
+                ledger.sell(quantity)
+        return ledger
+
+    def test_empty_ledger(self):
+        ledger = FifoLedger()
+        self.assertEqual(ledger.average_price, 0)
+        self.assertEqual(ledger.sell(10), [])
+        self.assertEqual(ledger.quantity, 0)
+
+    def test_partial_sell(self):
+        ledger = self.apply([('Buy', 10, Decimal('100')),
+                             ('Buy', 10, Decimal('200')),
+                             ('Sell', 15, None)])
+        self.assertEqual(ledger.quantity, 5)
+        self.assertEqual(ledger.average_price, Decimal('200'))
+        self.assertEqual(len(ledger.lots), 1)
+
+    def test_sold_lots(self):
+        ledger = self.apply([('Buy', 10, Decimal('100')),
+                             ('Buy', 10, Decimal('200'))])
+        sold = ledger.sell(12)
+        self.assertEqual([(lot.quantity, lot.price) for lot in sold],
+                         [(10, Decimal('100')), (2, Decimal('200'))])
+        self.assertEqual(ledger.lots[0].quantity, 8)
+
+    def test_oversell(self):
+        ledger = self.apply([('Buy', 3, Decimal('100')),
+                             ('Sell', 5, None)])
+        self.assertEqual(ledger.quantity, 0)
+        self.assertEqual(ledger.average_price, 0)
+
+    def test_same_as_item_list(self):
+        # сверяем с результатом прежнего алгоритма на случайных операциях
+        rnd = random.Random(20211107)
+        for _ in range(50):
+            operations = []
+            for _ in range(rnd.randint(1, 40)):
+                if rnd.random() < 0.6:
+                    price = Decimal(rnd.randint(1, 100000)) / 100
+                    operations.append(('Buy', rnd.randint(1, 500), price))
+                else:
+                    operations.append(('Sell', rnd.randint(1, 700), None))
+            ledger = self.apply(operations)
+            self.assertAlmostEqual(ledger.average_price, reference_average(operations),
+                                   places=10)
+
+
+class TestOperationsIndex(unittest.TestCase):
+
+    @staticmethod
+    def operation(op_type, figi, day):
+        return PortfolioOperation(op_type=op_type, op_date=datetime(2021, 1, day),
+                                  op_currency='RUB', op_payment=Decimal(day), op_ticker='TST',
+                                  op_payment_rub=Decimal(day), op_figi=figi, op_status='Done')
+
+    def setUp(self):
+        # как в API - сначала новые операции
+        self.operations = [
+            self.operation(OperationTypeWithCommission.sell, 'FIGI1', 5),
+            self.operation(OperationTypeWithCommission.buy, 'FIGI2', 4),
+            self.operation(OperationTypeWithCommission.broker_commission, 'FIGI1', 3),
+            self.operation(OperationTypeWithCommission.buy, 'FIGI1', 2),
+            self.operation(OperationTypeWithCommission.pay_in, None, 1),
+        ]
+        self.index = OperationsIndex(self.operations, figi_attr='op_figi', type_attr='op_type')
+
+    def test_by_figi(self):
+        self.assertEqual(self.index.by_figi('FIGI1'),
+                         [self.operations[0], self.operations[2], self.operations[3]])
+        self.assertEqual(self.index.by_figi('NONE'), [])
+
+    def test_by_figi_keeps_order(self):
+        self.assertEqual(self.index.by_figi('FIGI2', 'FIGI1', op_types=('Buy', 'Sell')),
+                         [self.operations[0], self.operations[1], self.operations[3]])
+
+    def test_by_type(self):
+        self.assertEqual(self.index.by_type('Buy'), [self.operations[1], self.operations[3]])
+        self.assertEqual(self.index.by_type('PayIn'), [self.operations[4]])
+        self.assertEqual(self.index.by_type('Coupon'), [])
+
+    def test_figis(self):
+        self.assertEqual(sorted(self.index.figis), ['FIGI1', 'FIGI2'])
+
+
+class TestOperationsPivot(unittest.TestCase):
+
+    @staticmethod
+    def operation(op_type, date, payment, currency='RUB', rate=1, figi=None):
+        return PortfolioOperation(op_type=op_type, op_date=date, op_currency=currency,
+                                  op_payment=Decimal(payment), op_ticker='TST',
+                                  op_payment_rub=Decimal(payment) * rate, op_figi=figi, op_status='Done')
+
+    def setUp(self):
+        self.operations = [
+            self.operation(OperationTypeWithCommission.pay_in, datetime(2020, 12, 30, 12), 1000),
+            self.operation('PayIn', datetime(2021, 1, 5, 10), 500),
+            self.operation('PayIn', datetime(2021, 1, 5, 18), 300),
+            self.operation('PayOut', datetime(2021, 1, 5, 19), -200),
+            self.operation('PayIn', datetime(2021, 2, 1), 10, currency='USD', rate=75),
+            self.operation('Buy', datetime(2021, 2, 2), -20, currency='USD', rate=75, figi='FIGI1'),
+            self.operation('Buy', datetime(2021, 2, 3), -100, figi='FIGI2'),
+            self.operation('Buy', datetime(2021, 2, 4), 0, figi='FIGI2'),
+            self.operation('Dividend', datetime(2021, 3, 1), 7, currency='XXX', rate=0, figi='FIGI2'),
+        ]
+        self.pivot = OperationsPivot(self.operations)
+
+    def test_totals_match_full_scan(self):
+        for op_type in ('PayIn', 'PayOut', 'Buy', 'Dividend', 'Coupon'):
+            expected = sum((op.op_payment_rub for op in self.operations
+                            if op.op_type == op_type and op.op_currency in ('RUB', 'USD')), Decimal(0))
+            self.assertEqual(self.pivot.total_rub(op_type, currencies=('RUB', 'USD')), expected)
+        self.assertEqual(self.pivot.total_rub('PayIn', years=(2021,)), Decimal(1550))
+        self.assertEqual(self.pivot.currencies('Dividend'), ['XXX'])
+        # нулевые платежи не учитываются
+        self.assertEqual(sum(cell[2] for cell in self.pivot.cells.values()), 8)
+
+    def test_by_year(self):
+        self.assertEqual(self.pivot.by_year('PayIn', 'RUB'), {2020: Decimal(1000), 2021: Decimal(800)})
+        self.assertEqual(self.pivot.by_year('PayIn', 'USD'), {2021: Decimal(10)})
+
+    def test_daily_flows(self):
+        flows = self.pivot.daily_flows_rub('PayIn', 'PayOut', currencies=('RUB',))
+        self.assertEqual(flows, {datetime(2020, 12, 30).date(): Decimal(1000),
+                                 datetime(2021, 1, 5).date(): Decimal(600)})
+        self.assertEqual(list(self.pivot.daily_flows_rub('PayIn')),
+                         [datetime(2020, 12, 30).date(), datetime(2021, 1, 5).date(),
+                          datetime(2021, 2, 1).date()])
+
+
+if __name__ == '__main__':
+    unittest.main()
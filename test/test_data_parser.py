@@ -0,0 +1,237 @@
+import os
+import unittest
+from datetime import datetime, timedelta
+from decimal import Decimal
+from unittest import mock
+
+import tinvest
+
+import async_parser
+import data_parser
+
+dynamic_xml = """<?xml version="1.0" encoding="windows-1251"?>
+<ValCurs ID="R01235" DateRange1="01.01.2021" DateRange2="13.01.2021" name="Foreign Currency Market Dynamic">
+<Record Date="31.12.2020" Id="R01235"><Nominal>1</Nominal><Value>73,8757</Value></Record>
+<Record Date="12.01.2021" Id="R01235"><Nominal>1</Nominal><Value>74,5157</Value></Record>
+<Record Date="13.01.2021" Id="R01235"><Nominal>10</Nominal><Value>736,3730</Value></Record>
+</ValCurs>
+""".encode('windows-1251')
+
+
+class FakeDynamic:
+    parse = staticmethod(data_parser.ExchangeRatesDynamic._parse)
+
+    def __init__(self, cbr_id, date_from, date_to):
+        self.rates = self.parse(dynamic_xml)
+
+
+class TestExchangeRatesRange(unittest.TestCase):
+    db_file_name = "assets_parser_test_db.db"
+
+    @classmethod
+    def setUpClass(self):
+        data_parser.database.open_database_connection(self.db_file_name)
+
+    @classmethod
+    def tearDownClass(self):
+        data_parser.database.close_database_connection()
+        os.remove(self.db_file_name)
+
+    def test_parse_dynamic(self):
+        rates = data_parser.ExchangeRatesDynamic._parse(dynamic_xml)
+        self.assertEqual(rates[datetime(2020, 12, 31)], Decimal('73.8757'))
+        self.assertEqual(rates[datetime(2021, 1, 13)], Decimal('73.6373'))
+
+    @mock.patch('data_parser.ExchangeRatesDynamic', FakeDynamic)
+    def test_load_range_fills_holidays(self):
+        data_parser.load_exchange_rates(datetime(2021, 1, 1), datetime(2021, 1, 13))
+        database = data_parser.database
+        # праздники - действует курс, установленный 31 декабря
+        self.assertEqual(database.get_exchange_rate(datetime(2021, 1, 1), 'USD'), Decimal('73.8757'))
+        self.assertEqual(database.get_exchange_rate(datetime(2021, 1, 11), 'USD'), Decimal('73.8757'))
+        self.assertEqual(database.get_exchange_rate(datetime(2021, 1, 12), 'USD'), Decimal('74.5157'))
+        self.assertEqual(database.get_exchange_rate(datetime(2021, 1, 13), 'RUB'), Decimal(1))
+        self.assertIsNone(database.get_exchange_rate(datetime(2021, 1, 14), 'USD'))
+
+    @mock.patch('data_parser.ExchangeRatesDynamic', FakeDynamic)
+    def test_rates_for_dates(self):
+        dates = [datetime(2021, 1, 2, 15, 30), datetime(2021, 1, 12).date()]
+        with mock.patch('data_parser.get_exchange_rates_for_date_db') as per_date:
+            rates = data_parser.get_exchange_rates_for_dates(dates)
+        per_date.assert_not_called()
+        self.assertEqual(set(rates.keys()), {datetime(2021, 1, 2).date(), datetime(2021, 1, 12).date()})
+        self.assertEqual(rates[datetime(2021, 1, 12).date()]['USD'], Decimal('74.5157'))
+        self.assertEqual(rates[datetime(2021, 1, 2).date()]['RUB'], Decimal(1))
+
+    def test_nothing_to_load(self):
+        data_parser.database.put_exchange_rates(
+            [(datetime(2019, 5, 5), currency, Decimal(1)) for currency in data_parser.supported_currencies])
+        with mock.patch('data_parser.ExchangeRatesDynamic') as dynamic:
+            data_parser.load_exchange_rates(datetime(2019, 5, 5), datetime(2019, 5, 5))
+        dynamic.assert_not_called()
+
+
+class TestSeededRates(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(self):
+        # база заполняется курсами из rates_by_date.csv
+        data_parser.open_database(':memory:')
+
+    @classmethod
+    def tearDownClass(self):
+        data_parser.database.close_database_connection()
+
+    def test_seeded_currencies_are_not_requested(self):
+        usd = data_parser.database.get_exchange_rate(datetime(2020, 3, 2), 'USD')
+        self.assertIsNotNone(usd)
+        with mock.patch('data_parser.ExchangeRatesDynamic', return_value=mock.Mock(rates={})) as dynamic:
+            data_parser.load_exchange_rates(datetime(2019, 1, 1), datetime(2021, 8, 1))
+        # в файле нет только франка
+        self.assertEqual([call.args[0] for call in dynamic.call_args_list], ['R01775'])
+        self.assertEqual(dynamic.call_args.args[1], datetime(2018, 12, 18))
+        self.assertEqual(data_parser.database.get_exchange_rate(datetime(2020, 3, 2), 'USD'), usd)
+
+
+class FakeRates:
+    # ответ ЦБ на запрос курсов на воскресенье - курсы, установленные в субботу
+    date_received = datetime(2021, 3, 13)
+
+    def __getitem__(self, currency):
+        return mock.Mock(value=Decimal('74.5') if currency != 'RUB' else Decimal(1))
+
+
+class TestExchangeRateNoPublication(unittest.TestCase):
+    db_file_name = "assets_parser_test_db.db"
+
+    @classmethod
+    def setUpClass(self):
+        data_parser.database.open_database_connection(self.db_file_name)
+
+    @classmethod
+    def tearDownClass(self):
+        data_parser.database.close_database_connection()
+        os.remove(self.db_file_name)
+
+    def test_weekend_rate_is_cached(self):
+        sunday = datetime(2021, 3, 14)
+        with mock.patch('data_parser.get_exchange_rate', return_value=FakeRates()) as cb:
+            self.assertEqual(data_parser.get_exchange_rate_db(sunday, 'USD'), Decimal('74.5'))
+            self.assertEqual(data_parser.get_exchange_rate_db(sunday, 'EUR'), Decimal('74.5'))
+            self.assertEqual(data_parser.get_exchange_rate_db(sunday.date(), 'USD'), Decimal('74.5'))
+        cb.assert_called_once()
+        self.assertTrue(data_parser.database.is_rate_missing(sunday, 'USD'))
+        self.assertEqual(data_parser.database.get_exchange_rate(datetime(2021, 3, 13), 'USD'),
+                         Decimal('74.5'))
+
+
+class TestHistoryPrice(unittest.TestCase):
+    db_file_name = "assets_parser_test_db.db"
+    figi = "TSTHISTORY"
+
+    @classmethod
+    def setUpClass(self):
+        data_parser.database.open_database_connection(self.db_file_name)
+
+    @classmethod
+    def tearDownClass(self):
+        data_parser.database.close_database_connection()
+        os.remove(self.db_file_name)
+
+    def get_price(self, date):
+        response = mock.Mock(payload=mock.Mock(candles=[]))
+        with mock.patch('data_parser.recorder.call', return_value=response), \
+                mock.patch('data_parser.api_client.get_sync_client'), \
+                mock.patch('data_parser.get_instrument_by_figi'):
+            return data_parser.get_figi_history_price(self.figi, date)
+
+    def test_empty_candles(self):
+        old_day = datetime(2021, 3, 8)
+        self.assertIsNone(self.get_price(old_day))
+        self.assertTrue(data_parser.database.is_candle_missing(old_day, self.figi))
+        # свеча за вчера еще может быть не опубликована - день не запоминается
+        yesterday = datetime.now() - timedelta(days=1)
+        self.assertIsNone(self.get_price(yesterday))
+        self.assertFalse(data_parser.database.is_candle_missing(yesterday, self.figi))
+
+    def test_today_is_market_price(self):
+        with mock.patch('data_parser.get_current_market_price', return_value=Decimal('10')) as market:
+            self.assertEqual(data_parser.get_figi_history_price(self.figi, datetime.now()), Decimal('10'))
+        market.assert_called_once_with(self.figi)
+
+
+def make_operation(op_id, date, status='Done', payment='-100'):
+    return tinvest.Operation(id=op_id, date=date, status=status, currency='RUB', payment=Decimal(payment),
+                             isMarginCall=False, operationType='Buy', figi='BBG000000001', quantityExecuted=1)
+
+
+class FakeOperationsClient:
+    # отдает операции счета за период, как API
+    def __init__(self, operations):
+        self.operations = operations
+        self.requests = []  # начала загрузок
+
+    def get_operations(self, from_, to, broker_account_id):
+        operations = sorted((op for op in self.operations if from_ <= op.date < to.astimezone()),
+                            key=lambda op: op.date, reverse=True)
+        return tinvest.OperationsResponse(payload=tinvest.Operations(operations=operations),
+                                          trackingId='test', status='Ok')
+
+
+class TestOperationsSync(unittest.TestCase):
+    db_file_name = "assets_parser_test_db.db"
+    account_id = "TSTACCOUNT"
+
+    @classmethod
+    def setUpClass(self):
+        data_parser.database.open_database_connection(self.db_file_name)
+
+    @classmethod
+    def tearDownClass(self):
+        data_parser.database.close_database_connection()
+        os.remove(self.db_file_name)
+
+    def get_operations(self, client, now):
+        def load_operations(broker_account_id, date_from, date_to, on_range):
+            client.requests.append(date_from)
+            for range_from, range_to in async_parser._operation_ranges(date_from, date_to):
+                on_range(range_from, range_to,
+                         client.get_operations(range_from, range_to, broker_account_id).payload.operations)
+            return []
+
+        with mock.patch('data_parser.async_parser.load_operations', load_operations), \
+                mock.patch.object(type(data_parser.config), 'now_date', new_callable=mock.PropertyMock,
+                                  return_value=now):
+            return data_parser.get_operations(self.account_id)
+
+    def test_incremental_sync(self):
+        start_date = data_parser.config.start_date
+        client = FakeOperationsClient([
+            make_operation('1', start_date + timedelta(days=10)),
+            make_operation('2', start_date + timedelta(days=40)),
+            make_operation('3', start_date + timedelta(days=50), status='Progress'),
+            make_operation('4', start_date + timedelta(days=60)),
+        ])
+        now = (start_date + timedelta(days=70)).replace(tzinfo=None)
+        response = self.get_operations(client, now)
+        self.assertEqual([op.id for op in response.payload.operations], ['4', '3', '2', '1'])
+        self.assertEqual(client.requests, [start_date])
+
+        # операция 3 завершилась, операция 1 из API больше не видна - но она до окна загрузки
+        client.operations[2] = make_operation('3', start_date + timedelta(days=50), payment='-99.5')
+        del client.operations[0]
+        client.operations.append(make_operation('5', start_date + timedelta(days=75)))
+        response = self.get_operations(client, now + timedelta(days=10))
+        overlap = timedelta(days=data_parser.config.operations_overlap_days)
+        self.assertEqual(client.requests[1], start_date + timedelta(days=50) - overlap)
+        self.assertEqual([op.id for op in response.payload.operations], ['5', '4', '3', '2', '1'])
+        self.assertEqual(response.payload.operations[2].payment, Decimal('-99.5'))
+        self.assertEqual(response.payload.operations[2].status, tinvest.OperationStatus.done)
+
+        # все завершено - следующая загрузка от последней операции
+        self.get_operations(client, now + timedelta(days=20))
+        self.assertEqual(client.requests[2], start_date + timedelta(days=75) - overlap)
+
+
+if __name__ == '__main__':
+    unittest.main()
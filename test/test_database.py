@@ -1,11 +1,16 @@
 from decimal import Decimal
 import unittest
+from unittest import mock
+import database
 from database import Database
 import time
 import os
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
-from datetime import datetime
-from tinvest.schemas import SearchMarketInstrument
+from datetime import datetime, timezone
+from tinvest.schemas import Operation, SearchMarketInstrument
 
 
 class TestDatabaseFunctionality(unittest.TestCase):
@@ -66,6 +71,232 @@ class TestDatabaseFunctionality(unittest.TestCase):
         self.assertIsNone(self.database.get_exchange_rate(date=test_date, currency="TST"))
         self.assertIsNone(self.database.get_exchange_rate(currency="TST"))
 
+    def test_rates_latest_rate(self):
+        self.database.put_exchange_rate(date=datetime(2015, 3, 6), currency="TSTL", rate="5.5")
+        self.database.put_exchange_rate(date=datetime(2015, 3, 7), currency="TSTL", rate="6.5")
+        self.assertEqual(self.database.get_latest_exchange_rate(datetime(2015, 3, 9), "TSTL"),
+                         Decimal("6.5"))
+        self.assertEqual(self.database.get_latest_exchange_rate(datetime(2015, 3, 6), "TSTL"),
+                         Decimal("5.5"))
+        self.assertIsNone(self.database.get_latest_exchange_rate(datetime(2015, 3, 5), "TSTL"))
+
+    def test_rates_missing(self):
+        test_date = datetime(2015, 3, 8)
+        self.assertFalse(self.database.is_rate_missing(test_date, "TSTL"))
+        self.assertTrue(self.database.put_missing_rate(test_date, "TSTL"))
+        self.assertTrue(self.database.is_rate_missing(test_date, "TSTL"))
+        self.assertFalse(self.database.is_rate_missing(test_date, "USD"))
+
+    def test_rates_for_dates(self):
+        self.database.put_exchange_rates([(datetime(2014, 1, 30), "TSTA", "1.5"),
+                                          (datetime(2014, 1, 31), "TSTA", "2.5"),
+                                          (datetime(2014, 1, 31), "TSTB", "3.5")])
+        self.database.put_missing_rate(datetime(2014, 2, 2), "TSTA")
+        dates = [datetime(2014, 1, 30).date(), datetime(2014, 1, 31), datetime(2014, 2, 2),
+                 datetime(2014, 2, 3)]
+        rates = self.database.get_exchange_rates_for_dates(dates, ["TSTA", "TSTB"])
+        self.assertEqual(rates, {
+            datetime(2014, 1, 30).date(): {"TSTA": Decimal("1.5")},
+            datetime(2014, 1, 31): {"TSTA": Decimal("2.5"), "TSTB": Decimal("3.5")},
+            # нет публикации - последний известный курс
+            datetime(2014, 2, 2): {"TSTA": Decimal("2.5")},
+        })
+        self.assertEqual(self.database.get_exchange_rates_for_dates([], ["TSTA"]), {})
+
+    def test_wal_mode(self):
+        journal_mode = self.database.cursor.execute("PRAGMA journal_mode;").fetchone()[0]
+        self.assertEqual(journal_mode, "wal")
+
+    def test_batch_write(self):
+        test_date = datetime(2012, 2, 3)
+        other = sqlite3.connect(self.db_file_name)
+        sql_s = "SELECT rate FROM rates WHERE date = '2012-02-03' AND currency = 'TSTE';"
+        with self.database.batch():
+            self.database.put_exchange_rate(test_date, "TSTE", "1.25")
+            with self.database.batch():
+                self.database.put_missing_rate(test_date, "TSTF")
+            # до выхода из внешнего блока другим соединениям записи не видны
+            self.assertIsNone(other.execute(sql_s).fetchone())
+            # а внутри своего соединения - видны
+            self.assertEqual(self.database.get_exchange_rates_for_dates([test_date], ["TSTE"]),
+                             {test_date: {"TSTE": Decimal("1.25")}})
+        self.assertEqual(other.execute(sql_s).fetchone(), ("1.25",))
+        self.assertTrue(self.database.is_rate_missing(test_date, "TSTF"))
+        other.close()
+
+    def test_batch_keeps_no_open_transaction(self):
+        # чтение внутри блока не оставляет открытой транзакцию записи
+        with self.database.batch():
+            self.database.put_exchange_rate(datetime(2012, 2, 4), "TSTE", "1.5")
+            self.database.caches['rates'].clear()
+            self.assertEqual(self.database.get_exchange_rate(datetime(2012, 2, 4), "TSTE"), Decimal("1.5"))
+            self.assertFalse(self.database.sqlite_connection.in_transaction)
+        # большая пачка фиксируется частями
+        with mock.patch('database.batch_flush_size', 2), self.database.batch():
+            for day in range(1, 4):
+                self.database.put_exchange_rate(datetime(2012, 3, day), "TSTE", "2")
+            self.assertFalse(self.database.sqlite_connection.in_transaction)
+            self.assertEqual(self.database._batch.count, 1)
+
+    def test_batch_error_discards_rows(self):
+        test_date = datetime(2012, 2, 5)
+        with self.assertRaises(ValueError):
+            with self.database.batch():
+                self.database.put_exchange_rate(test_date, "TSTE", "1.75")
+                raise ValueError
+        self.assertEqual(self.database._batch.pending, [])
+        # строка не попадает в следующую транзакцию
+        with self.database.batch():
+            self.database.put_missing_rate(test_date, "TSTF")
+        self.assertIsNone(self.database.get_exchange_rate(test_date, "TSTE"))
+
+    def test_replace_operations_in_batch(self):
+        # замена операций не фиксирует внешний batch() раньше времени
+        operation = Operation(id="TSTOP1", date=datetime(2012, 4, 2, tzinfo=timezone.utc), status="Done",
+                              currency="RUB", payment=Decimal("-10"), isMarginCall=False, operationType="Buy")
+        date_from, date_to = datetime(2012, 4, 1, tzinfo=timezone.utc), datetime(2012, 5, 1, tzinfo=timezone.utc)
+        other = sqlite3.connect(self.db_file_name)
+        sql_s = "SELECT COUNT(*) FROM operations WHERE account_id = 'TSTACC';"
+        with self.database.batch():
+            self.database.put_exchange_rate(datetime(2012, 4, 2), "TSTE", "3")
+            self.assertTrue(self.database.replace_operations("TSTACC", date_from, [operation], date_to))
+            self.assertEqual(other.execute(sql_s).fetchone(), (0,))
+            self.assertEqual(len(self.database.get_operations("TSTACC", date_from, date_to)), 1)
+        self.assertEqual(other.execute(sql_s).fetchone(), (1,))
+        # операция исчезла из API - исчезает и из базы
+        self.assertTrue(self.database.replace_operations("TSTACC", date_from, [], date_to))
+        self.assertEqual(other.execute(sql_s).fetchone(), (0,))
+        other.close()
+
+    def test_candles(self):
+        test_date = datetime(2012, 5, 4)
+        self.assertIsNone(self.database.get_candle_price(test_date, self.test_figi))
+        self.assertFalse(self.database.is_candle_missing(test_date, self.test_figi))
+        self.assertTrue(self.database.put_candle_price(test_date, self.test_figi, Decimal("123.455")))
+        self.assertTrue(self.database.put_missing_candle(test_date, self.test_figi2))
+        self.database.caches['candles'].clear()
+        self.assertEqual(self.database.get_candle_price(test_date, self.test_figi), Decimal("123.455"))
+        self.assertIsNone(self.database.get_candle_price(test_date, self.test_figi2))
+        self.assertTrue(self.database.is_candle_missing(test_date, self.test_figi2))
+        # цены активов не попадают в таблицу курсов
+        self.assertIsNone(self.database.get_exchange_rate(test_date, self.test_figi))
+
+    def test_missing_entries_expire(self):
+        # другой процесс дописал свечу, которой не было при первом чтении
+        test_date = datetime(2012, 5, 7)
+        self.assertIsNone(self.database.get_candle_price(test_date, self.test_figi))
+        other = sqlite3.connect(self.db_file_name)
+        other.execute("INSERT INTO candles (figi, date, price) VALUES (?, '2012-05-07', 7.5);", (self.test_figi,))
+        other.commit()
+        other.close()
+        self.assertIsNone(self.database.get_candle_price(test_date, self.test_figi))
+        self.database.caches['candles'].missing_ttl = -1
+        self.assertEqual(self.database.get_candle_price(test_date, self.test_figi), Decimal("7.5"))
+        self.database.caches['candles'].missing_ttl = database.missing_ttl
+
+    def test_candles_ohlcv(self):
+        figi = "TSTFIGIC"
+        self.assertTrue(self.database.put_candles(figi, [
+            (datetime(2012, 6, 1), Decimal("10.5"), Decimal("12"), Decimal("10"), Decimal("11.5"), 100),
+            (datetime(2012, 6, 4), Decimal("11.5"), Decimal("11.5"), Decimal("9"), Decimal("9.5"), 250),
+        ]))
+        self.database.put_missing_candle(datetime(2012, 6, 5), figi)
+        candles = self.database.get_candles(figi, datetime(2012, 6, 1), datetime(2012, 6, 30))
+        self.assertEqual(candles.dtype, database.candle_dtype)
+        self.assertEqual(list(candles['date'].astype(str)), ["2012-06-01", "2012-06-04"])
+        self.assertEqual(list(candles['close']), [11.5, 9.5])
+        self.assertEqual(list(candles['volume']), [100, 250])
+        # граница периода включается
+        self.assertEqual(len(self.database.get_candles(figi, datetime(2012, 6, 4), datetime(2012, 6, 4))), 1)
+        self.assertEqual(len(self.database.get_candles(figi, datetime(2013, 1, 1), datetime(2013, 2, 1))), 0)
+        # середина дня - цена актива
+        self.assertEqual(self.database.get_candle_price(datetime(2012, 6, 1), figi), Decimal("11"))
+        # запись одной цены не стирает свечу
+        self.database.put_candle_price(datetime(2012, 6, 1), figi, Decimal("11.25"))
+        candles = self.database.get_candles(figi, datetime(2012, 6, 1), datetime(2012, 6, 1))
+        self.assertEqual((candles['close'][0], candles['volume'][0]), (11.5, 100))
+        self.assertEqual(self.database.get_candle_price(datetime(2012, 6, 1), figi), Decimal("11.25"))
+
+    def test_threads(self):
+        # потоки пишут пачками и читают свои и чужие записи через общее соединение
+        def worker(number):
+            currency = f"TH{number}"
+            with self.database.batch():
+                for day in range(1, 29):
+                    self.database.put_exchange_rate(datetime(2011, 2, day), currency, f"{number}.{day}")
+                self.database.caches['rates'].clear()
+                rates = self.database.get_exchange_rates_for_dates([datetime(2011, 2, 28)], [currency])
+            return rates[datetime(2011, 2, 28)][currency]
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            results = list(executor.map(worker, range(8)))
+        self.assertEqual(results, [Decimal(f"{number}.28") for number in range(8)])
+        self.assertEqual(len(self.database.get_exchange_rate_dates("TH7", datetime(2011, 2, 1),
+                                                                   datetime(2011, 2, 28))), 28)
+
+    def test_threads_are_isolated(self):
+        # ошибка в пачке одного потока не отменяет записи другого
+        barrier = threading.Barrier(2, timeout=10)
+
+        def failing():
+            with self.database.batch():
+                self.database.put_exchange_rate(datetime(2011, 3, 1), "THF", "1")
+                self.database.put_candle_price(datetime(2011, 3, 1), None, 1)  # figi NOT NULL
+                barrier.wait()
+            barrier.wait()
+
+        def working():
+            with self.database.batch():
+                self.database.put_exchange_rate(datetime(2011, 3, 1), "THW", "2")
+                self.database.get_exchange_rates_for_dates([datetime(2011, 3, 1)], ["THW"])
+                barrier.wait()
+                # здесь другой поток уже откатил свою пачку
+                barrier.wait()
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            for future in [executor.submit(failing), executor.submit(working)]:
+                future.result()
+        self.database.caches['rates'].clear()
+        self.assertEqual(self.database.get_exchange_rate(datetime(2011, 3, 1), "THW"), Decimal("2"))
+        self.assertIsNone(self.database.get_exchange_rate(datetime(2011, 3, 1), "THF"))
+        self.assertFalse(self.database.sqlite_connection.in_transaction)
+
+    def test_rates_cache(self):
+        test_date = datetime(2013, 4, 5)
+        cache = self.database.caches['rates']
+        self.database.put_exchange_rate(test_date, "TSTC", "7.25")
+        hits = cache.hits
+        self.assertEqual(self.database.get_exchange_rate(test_date, "TSTC"), Decimal("7.25"))
+        self.assertEqual(cache.hits, hits + 1)
+        # отсутствие курса тоже запоминается
+        misses = cache.misses
+        self.assertIsNone(self.database.get_exchange_rate(test_date, "TSTD"))
+        self.assertIsNone(self.database.get_exchange_rate(test_date, "TSTD"))
+        self.assertEqual((cache.hits, cache.misses), (hits + 2, misses + 1))
+        # пока не будет записан
+        self.database.put_exchange_rate(test_date, "TSTD", "8.5")
+        self.assertEqual(self.database.get_exchange_rate(test_date, "TSTD"), Decimal("8.5"))
+
+    def test_rates_csv_import_export(self):
+        csv_name = "rates_test.csv"
+        export_name = "rates_test_export.csv"
+        with open(csv_name, 'w', newline='') as csv_file:
+            csv_file.write("2010-01-02,30.1851,43.4605,1\r\n2010-01-03,30.1851,43.4605,1\r\n")
+        try:
+            self.assertEqual(self.database.import_rates_csv(csv_name), 6)
+            self.assertEqual(self.database.get_exchange_rate(datetime(2010, 1, 3), "EUR"),
+                             Decimal("43.4605"))
+            self.assertEqual(self.database.get_exchange_rate(datetime(2010, 1, 2), "RUB"), 1)
+            self.assertGreaterEqual(self.database.export_rates_csv(export_name), 2)
+            with open(export_name, newline='') as csv_file:
+                exported = csv_file.read()
+            self.assertIn("2010-01-02,30.1851,43.4605,1\r\n2010-01-03,30.1851,43.4605,1\r\n",
+                          exported)
+        finally:
+            os.remove(csv_name)
+            if os.path.isfile(export_name):
+                os.remove(export_name)
+
     def test_instrument_put(self):
         with self.assertRaises(TypeError):
             self.database.put_instrument()
@@ -146,5 +377,50 @@ class TestDatabaseFunctionality(unittest.TestCase):
         pass
 
 
+class TestDatabaseMigrations(unittest.TestCase):
+    db_file_name = "assets_migration_test_db.db"
+    figi = "BBG000000001"
+
+    @classmethod
+    def setUpClass(self):
+        # база в формате версий без schema_version: цены активов - в rates
+        connection = sqlite3.connect(self.db_file_name)
+        connection.execute("""CREATE TABLE rates (date TEXT, currency TEXT, rate TEXT,
+            PRIMARY KEY (date, currency)) WITHOUT ROWID;""")
+        connection.execute("""CREATE TABLE rates_missing (date TEXT, currency TEXT,
+            PRIMARY KEY (date, currency)) WITHOUT ROWID;""")
+        connection.executemany("INSERT INTO rates VALUES (?, ?, ?);",
+                               [("2020-01-09", "USD", "61.9057"),
+                                ("2020-01-09", self.figi, "105.5")])
+        connection.executemany("INSERT INTO rates_missing VALUES (?, ?);",
+                               [("2020-01-05", "USD"), ("2020-01-06", self.figi)])
+        connection.commit()
+        connection.close()
+        self.database = Database(self.db_file_name)
+
+    @classmethod
+    def tearDownClass(self):
+        self.database.close_database_connection()
+        os.remove(self.db_file_name)
+
+    def test_schema_version(self):
+        version = self.database.cursor.execute("SELECT MAX(version) FROM schema_version;").fetchone()[0]
+        self.assertEqual(version, len(database.migrations))
+
+    def test_candles_moved_out_of_rates(self):
+        self.assertEqual(self.database.get_candle_price(datetime(2020, 1, 9), self.figi), Decimal("105.5"))
+        self.assertTrue(self.database.is_candle_missing(datetime(2020, 1, 6), self.figi))
+        self.assertIsNone(self.database.get_exchange_rate(datetime(2020, 1, 9), self.figi))
+        self.assertFalse(self.database.is_rate_missing(datetime(2020, 1, 6), self.figi))
+        # курсы валют остались на месте
+        self.assertEqual(self.database.get_exchange_rate(datetime(2020, 1, 9), "USD"), Decimal("61.9057"))
+        self.assertTrue(self.database.is_rate_missing(datetime(2020, 1, 5), "USD"))
+
+    def test_reopen_is_idempotent(self):
+        self.database.open_database_connection(self.db_file_name)
+        versions = self.database.cursor.execute("SELECT COUNT(*) FROM schema_version;").fetchone()[0]
+        self.assertEqual(versions, len(database.migrations))
+
+
 if __name__ == '__main__':
     unittest.main()
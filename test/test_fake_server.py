@@ -0,0 +1,110 @@
+import unittest
+
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+
+import requests
+import tinvest
+from pycbrf.toolbox import ExchangeRates
+
+import api_client
+import data_parser
+from fake_server import SyntheticBroker, start_server
+
+
+class TestFakeServer(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.broker = SyntheticBroker(accounts=3, positions=10, operations=300,
+                                     start=datetime.now() - timedelta(days=400))
+        cls.server = start_server(cls.broker)
+        cls.client = api_client.SyncClient('fake-token', base_url=cls.server.url + '/openapi/')
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def test_accounts_and_portfolio(self):
+        accounts = self.client.get_accounts().payload.accounts
+        self.assertEqual(len(accounts), 3)
+        self.assertEqual(accounts[2].broker_account_type, tinvest.BrokerAccountType.tinkoff_iis)
+        account_id = accounts[0].broker_account_id
+        positions = self.client.get_portfolio(broker_account_id=account_id).payload.positions
+        self.assertEqual(len(positions), 10)
+        currencies = self.client.get_portfolio_currencies(broker_account_id=account_id).payload.currencies
+        self.assertIn('RUB', [currency.currency for currency in currencies])
+
+        # баланс позиций сходится с операциями покупки и продажи
+        start = datetime(2000, 1, 1, tzinfo=timezone.utc)
+        operations = self.client.get_operations(from_=start, to=datetime.now(timezone.utc),
+                                                broker_account_id=account_id).payload.operations
+        self.assertEqual(len(operations), 300)
+        held = defaultdict(int)
+        for operation in operations:
+            if operation.operation_type == tinvest.OperationTypeWithCommission.buy:
+                held[operation.figi] += operation.quantity_executed
+            elif operation.operation_type == tinvest.OperationTypeWithCommission.sell:
+                held[operation.figi] -= operation.quantity_executed
+        self.assertEqual({pos.figi: int(pos.balance) for pos in positions},
+                         {figi: balance for figi, balance in held.items() if balance})
+
+    def test_operations_period(self):
+        account_id = self.broker.accounts[1]['brokerAccountId']
+        date_from = datetime.now(timezone.utc) - timedelta(days=200)
+        date_to = date_from + timedelta(days=90)
+        operations = self.client.get_operations(from_=date_from, to=date_to,
+                                                broker_account_id=account_id).payload.operations
+        self.assertTrue(operations)
+        self.assertTrue(all(date_from <= operation.date < date_to for operation in operations))
+
+    def test_market(self):
+        figi = self.broker.portfolios[self.broker.accounts[0]['brokerAccountId']][0]['figi']
+        instrument = self.client.get_market_search_by_figi(figi).payload
+        self.assertEqual(instrument.figi, figi)
+        book = self.client.get_market_orderbook(figi, 0).payload
+        self.assertGreater(book.last_price, 0)
+        date_from = datetime.combine(datetime.now().date() - timedelta(days=30), datetime.min.time())
+        candles = self.client.get_market_candles(figi, date_from, date_from + timedelta(days=14),
+                                                 tinvest.CandleResolution.day).payload.candles
+        self.assertEqual(len(candles), 10)  # только рабочие дни
+        self.assertEqual(candles[0].o, self.broker.price(figi, candles[0].time.replace(hour=0, tzinfo=None)))
+        with self.assertRaises(tinvest.BadRequestError):
+            self.client.get_market_search_by_figi('UNKNOWN')
+
+    def test_cbr(self):
+        day = datetime.now() - timedelta(days=10)
+        response = requests.get(f"{self.server.url}/cbr/XML_daily.asp?date_req={day:%d/%m/%Y}")
+        rates = ExchangeRates._parse(response.content)
+        self.assertEqual({rate.code: rate.rate for rate in rates['rates']}['USD'], self.broker.rate('USD', day))
+        response = requests.get(f"{self.server.url}/cbr/XML_dynamic.asp?date_req1=01/03/2021"
+                                f"&date_req2=31/03/2021&VAL_NM_RQ=R01239")
+        rates = data_parser.ExchangeRatesDynamic._parse(response.content)
+        self.assertEqual(len(rates), 23)
+        self.assertEqual(rates[datetime(2021, 3, 1)], self.broker.rate('EUR', datetime(2021, 3, 1)))
+
+    def test_cbr_url(self):
+        day = datetime.now() - timedelta(days=10)
+        default_url = data_parser.cbr_url
+        data_parser.set_cbr_url(f"{self.server.url}/cbr/")
+        try:
+            rates = data_parser.ExchangeRates(day)
+        finally:
+            data_parser.set_cbr_url(default_url)
+        self.assertEqual(rates['USD'].rate, self.broker.rate('USD', day))
+        # константа pycbrf не меняется
+        self.assertEqual(data_parser.cbr_url, 'http://www.cbr.ru/scripts/')
+
+    def test_throttling(self):
+        self.server.throttle = 1
+        try:
+            with self.assertRaises(tinvest.TooManyRequestsError):
+                self.client.get_accounts()
+        finally:
+            self.server.throttle = 0
+        self.assertGreater(self.server.requests['429'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+import time
+import unittest
+
+from memory_cache import LRUCache, MISSING
+
+
+class TestLRUCache(unittest.TestCase):
+
+    def test_hit_and_miss(self):
+        cache = LRUCache('test', maxsize=10)
+        self.assertIsNone(cache.get('a'))
+        cache.put('a', 1)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        self.assertEqual(cache.hit_rate, 0.5)
+
+    def test_eviction_of_least_recently_used(self):
+        cache = LRUCache('test', maxsize=2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.get('a')  # 'b' теперь использовался давнее всех
+        cache.put('c', 3)
+        self.assertEqual(cache.evictions, 1)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+
+    def test_max_age(self):
+        cache = LRUCache('test', ttl=10)
+        cache.put('old', 1, timestamp=time.time() - 60)
+        cache.put('new', 2)
+        self.assertIsNone(cache.get('old'))
+        self.assertEqual(cache.get('old', max_age=120), 1)
+        self.assertEqual(cache.get('new'), 2)
+        self.assertIsNone(cache.get('new', max_age=-1))
+
+    def test_known_missing(self):
+        cache = LRUCache('test')
+        cache.put_missing('a')
+        self.assertIs(cache.get('a'), MISSING)
+        self.assertEqual(cache.hits, 1)
+
+    def test_missing_ttl(self):
+        cache = LRUCache('test', missing_ttl=5)
+        cache.put('old', MISSING, timestamp=time.time() - 60)
+        cache.put('value', 1, timestamp=time.time() - 60)
+        cache.put_missing('new')
+        # маркер отсутствия устаревает, обычное значение - нет
+        self.assertIsNone(cache.get('old'))
+        self.assertIsNone(cache.get('old', max_age=120))
+        self.assertEqual(cache.get('value'), 1)
+        self.assertIs(cache.get('new'), MISSING)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,208 @@
+import random
+import unittest
+
+from datetime import date, datetime, timedelta, timezone
+from decimal import Decimal
+from unittest import mock
+
+import numpy as np
+import scipy.optimize
+
+import main
+import performance
+from valuation import DailyValuation
+
+
+def reference_xirr(flows):
+    # расчет "в лоб": корень xnpv на интервале, даты - в днях от первой
+    t0 = min(flows)
+
+    def npv(rate):
+        return sum(value / (1.0 + rate) ** ((day - t0).days / 365.0) for day, value in flows.items())
+
+    return scipy.optimize.brentq(npv, -0.99, 100, xtol=1e-14)
+
+
+def random_flows(rng, count):
+    start = date(2018, 1, 1)
+    flows = {start: -rng.randrange(10000, 100000)}
+    for day in rng.sample(range(1, 1500), count):
+        flows[start + timedelta(days=day)] = -rng.randrange(0, 50000)
+    flows[start + timedelta(days=1500)] = int(-sum(flows.values()) * rng.uniform(0.8, 1.6))
+    return flows
+
+
+class TestXirr(unittest.TestCase):
+
+    def test_known_value(self):
+        self.assertAlmostEqual(performance.xirr([date(2021, 1, 1), date(2022, 1, 1)], [-1000, 1100]), 0.1,
+                               places=10)
+        # время платежа - только день, часы и часовой пояс не учитываются
+        dates = [datetime(2021, 1, 1, 23, tzinfo=timezone.utc), datetime(2022, 1, 1, 1)]
+        self.assertAlmostEqual(performance.xirr(dates, [-1000, 1100]), 0.1, places=10)
+
+    def test_same_as_reference(self):
+        rng = random.Random(3)
+        for _ in range(20):
+            flows = random_flows(rng, rng.randrange(1, 60))
+            self.assertAlmostEqual(performance.xirr(list(flows), list(flows.values())),
+                                   reference_xirr(flows), places=9)
+
+    def test_batch(self):
+        rng = random.Random(5)
+        series = [random_flows(rng, rng.randrange(1, 40)) for _ in range(30)]
+        batch = performance.xirr_batch([(list(flows), list(flows.values())) for flows in series])
+        single = [performance.xirr(list(flows), list(flows.values())) for flows in series]
+        np.testing.assert_allclose(batch, single, rtol=1e-9)
+        # начальное приближение по ряду - например, ставка соседнего периода
+        warm = performance.xirr_batch([(list(flows), list(flows.values())) for flows in series], guess=batch)
+        np.testing.assert_allclose(warm, batch, rtol=1e-9)
+
+    def test_special_cases(self):
+        dates = [date(2021, 1, 1), date(2021, 6, 1)]
+        result = performance.xirr_batch([(dates, [100, 200]), (dates, [-100, -200]), ([], []),
+                                         (dates, [-100, 90])])
+        self.assertEqual(result[0], np.inf)
+        self.assertEqual(result[1], -np.inf)
+        self.assertTrue(np.isnan(result[2]))
+        self.assertLess(result[3], 0)
+        self.assertIsNone(performance.xirr([], []))
+
+    def test_bracketing_fallback(self):
+        # метод Ньютона не успевает сойтись - ставка находится поиском на интервале
+        flows = random_flows(random.Random(7), 10)
+        result = performance.xirr_batch([(list(flows), list(flows.values()))], max_iterations=1)
+        self.assertAlmostEqual(result[0], reference_xirr(flows), places=9)
+
+    def test_main_xirr(self):
+        flows = random_flows(random.Random(11), 25)
+        self.assertAlmostEqual(main.xirr(flows), reference_xirr(flows), places=9)
+        self.assertIsNone(main.xirr({}))
+
+
+class TestXirrSeries(unittest.TestCase):
+
+    def test_calendar_periods(self):
+        years = performance.calendar_periods(date(2019, 5, 10), date(2021, 8, 13))
+        self.assertEqual(years, [('2019', date(2019, 5, 10), date(2019, 12, 31)),
+                                 ('2020', date(2020, 1, 1), date(2020, 12, 31)),
+                                 ('2021', date(2021, 1, 1), date(2021, 8, 13))])
+        quarters = performance.calendar_periods(date(2019, 5, 10), date(2020, 2, 13), 3)
+        self.assertEqual([label for label, start, end in quarters], ['2019 Q2', '2019 Q3', '2019 Q4', '2020 Q1'])
+        self.assertEqual(quarters[2][1:], (date(2019, 10, 1), date(2019, 12, 31)))
+
+    def test_rolling_periods(self):
+        periods = performance.rolling_periods(date(2019, 5, 10), date(2021, 8, 13))
+        # окна - только целиком после первого дня, последнее - до сегодня
+        self.assertEqual(periods[0], ('2020-05-31', date(2019, 6, 1), date(2020, 5, 31)))
+        self.assertEqual(periods[-2], ('2021-07-31', date(2020, 8, 1), date(2021, 7, 31)))
+        self.assertEqual(periods[-1], ('2021-08-13', date(2020, 8, 14), date(2021, 8, 13)))
+        self.assertEqual(len(periods), 16)
+        self.assertEqual(performance.rolling_periods(date(2021, 1, 5), date(2021, 8, 13)), [])
+
+    def test_series(self):
+        rng = random.Random(13)
+        start = date(2018, 1, 1)
+        flow_days = sorted(start + timedelta(days=day) for day in rng.sample(range(1, 1000), 40))
+        flow_values = [rng.randrange(-20000, 50000) for _ in flow_days]
+        valuation_days = [start + timedelta(days=day) for day in range(0, 1100, 7)]
+        valuation_values = [rng.uniform(100000, 200000) for _ in valuation_days]
+        periods = performance.calendar_periods(date(2018, 1, 1), date(2020, 12, 31), 3)
+        # порядок потоков на входе не важен
+        series = performance.xirr_series(flow_days[::-1], flow_values[::-1],
+                                         valuation_days, valuation_values, periods)
+        self.assertEqual(len(series), 12)
+        for period in series:
+            # тот же ряд платежей, собранный вручную
+            before = max((day for day in valuation_days if day < period.start), default=None)
+            value_start = valuation_values[valuation_days.index(before)] if before else 0.0
+            value_end = valuation_values[max(index for index, day in enumerate(valuation_days)
+                                             if day <= period.end)]
+            flows = {period.start - timedelta(days=1): -value_start}
+            for day, value in zip(flow_days, flow_values):
+                if period.start <= day <= period.end:
+                    flows[day] = flows.get(day, 0) - value
+            flows[period.end] = flows.get(period.end, 0) + value_end
+            self.assertAlmostEqual(period.value_start, value_start)
+            self.assertAlmostEqual(period.value_end, value_end)
+            self.assertAlmostEqual(period.flows, -sum(flows.values()) - value_start + value_end)
+            self.assertAlmostEqual(period.rate, performance.xirr(list(flows), list(flows.values())), places=8)
+
+    def test_empty_period(self):
+        series = performance.xirr_series([date(2021, 5, 1)], [1000], [date(2021, 5, 1), date(2021, 8, 1)],
+                                         [1000, 0],
+                                         performance.calendar_periods(date(2021, 1, 1), date(2021, 9, 30), 3))
+        self.assertIsNone(series[0].rate)  # ни стоимости, ни потоков
+        self.assertAlmostEqual(series[1].rate, 0.0)
+        self.assertEqual(series[2].rate, -np.inf)  # вложенное не вернулось
+
+
+class TestTwr(unittest.TestCase):
+
+    def test_known_value(self):
+        values = [0, 100, 110, 220, 198]
+        flows = [0, 100, 0, 100, 0]
+        # пополнение - в начале дня: 110 / 100 * 220 / (110 + 100) * 198 / 220
+        self.assertAlmostEqual(performance.twr(values, flows)[0], 1.1 * 220 / 210 * 0.9 - 1, places=12)
+        np.testing.assert_allclose(performance.twr(values, flows, [0, 3]), [0.1, 220 / 210 * 0.9 - 1])
+
+    def test_independent_of_flows(self):
+        # одна и та же дневная доходность при любых пополнениях и выводах
+        rng = np.random.default_rng(17)
+        growth = 1 + rng.normal(0.0003, 0.01, 1000)
+        flows = np.where(rng.random(1000) < 0.05, rng.uniform(-5000, 20000, 1000), 0.0)
+        flows[0] = 100000
+        values = np.zeros(1000)
+        for day in range(1000):
+            values[day] = ((values[day - 1] if day else 0.0) + flows[day]) * growth[day]
+        self.assertAlmostEqual(performance.twr(values, flows)[0], np.prod(growth) - 1, places=9)
+
+    def test_batch(self):
+        rng = np.random.default_rng(19)
+        values = rng.uniform(1e5, 2e5, (30, 3653))
+        flows = rng.normal(0, 1000, (30, 3653))
+        starts = np.arange(0, 3653, 365)
+        batch = performance.twr(values, flows, starts)
+        self.assertEqual(batch.shape, (30, len(starts)))
+        np.testing.assert_allclose(batch[7], performance.twr(values[7], flows[7], starts))
+        # доходности по годам складываются в доходность за весь период
+        np.testing.assert_allclose(np.prod(1 + batch, axis=1) - 1, performance.twr(values, flows)[:, 0])
+
+    def test_daily_flows(self):
+        flows = performance.daily_flows(date(2021, 1, 1), 5, [date(2021, 1, 2), date(2020, 12, 31),
+                                                              date(2021, 1, 2), date(2021, 1, 5)],
+                                        [100, 1, -30, 7])
+        self.assertEqual(flows.tolist(), [0, 70, 0, 0, 7])
+
+    def test_annualize(self):
+        self.assertAlmostEqual(performance.annualize(0.21, 730), 0.1)
+        self.assertAlmostEqual(performance.annualize(0.1, 365), 0.1)
+
+    def test_main_xirr_periods(self):
+        start = date(2020, 12, 30)
+        flows = {date(2021, 1, 1): Decimal(1000), date(2021, 1, 3): Decimal(-500)}
+        daily = DailyValuation(start, [], None, None, [], None, np.array([0, 0, 1000, 1100, 660, 700.0]), None)
+        pivot = mock.Mock(daily_flows_rub=mock.Mock(return_value=flows))
+        with mock.patch.object(type(main.config), 'now_date', new_callable=mock.PropertyMock,
+                               return_value=datetime(2021, 1, 4)):
+            result = main.calculate_xirr_periods(pivot, daily, Decimal(20))
+        # на сегодня - оценка за вычетом налога, без подстановки рыночной стоимости
+        self.assertEqual([(period.label, period.value_end) for period in result['years']], [('2021', 680)])
+        self.assertEqual(daily.values[-1], 700)
+
+    def test_main_twr(self):
+        start = date(2020, 12, 30)
+        flows = {date(2021, 1, 1): Decimal(1000), date(2021, 1, 3): Decimal(-500)}
+        daily = DailyValuation(start, [], None, None, [], None, np.array([0, 0, 1000, 1100, 660, 740.0]), None)
+        pivot = mock.Mock(daily_flows_rub=mock.Mock(return_value=flows))
+        result = main.calculate_twr(pivot, daily, Decimal(20))
+        # 1.1 * 660 / (1100 - 500) * 720 / 660; на сегодня - оценка за вычетом налога
+        self.assertEqual(result['total'], 32.0)
+        self.assertEqual(result['years'], {2020: 0.0, 2021: 32.0})
+        self.assertEqual(result['annual'], round(((1.32 ** (365 / 4)) - 1) * 100, 2))
+        pivot.daily_flows_rub.return_value = {}
+        self.assertEqual(main.calculate_twr(pivot, daily, 0), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
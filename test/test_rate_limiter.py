@@ -0,0 +1,70 @@
+import asyncio
+import time
+import unittest
+
+import tinvest
+
+from rate_limiter import RateLimiter, TokenBucket
+
+
+class TestTokenBucket(unittest.TestCase):
+
+    def test_burst_then_wait(self):
+        bucket = TokenBucket(600, capacity=2)  # 10 запросов в секунду
+        self.assertEqual(bucket.reserve(), 0)
+        self.assertEqual(bucket.reserve(), 0)
+        # третий запрос - в долг, ждать около 0.1 с
+        self.assertAlmostEqual(bucket.reserve(), 0.1, delta=0.02)
+        self.assertAlmostEqual(bucket.reserve(), 0.2, delta=0.02)
+
+    def test_drain(self):
+        bucket = TokenBucket(600, capacity=5)
+        bucket.drain()
+        self.assertGreater(bucket.reserve(), 0)
+
+
+class TestRateLimiter(unittest.TestCase):
+
+    def setUp(self):
+        self.limiter = RateLimiter({'market': 6000}, base_delay=0.01, max_delay=0.02,
+                                   max_retries=3)
+        self.calls = 0
+
+    def throttled_method(self, fail_times, result='ok'):
+        self.calls += 1
+        if self.calls <= fail_times:
+            raise tinvest.exceptions.TooManyRequestsError
+        return result
+
+    def test_retry_after_throttling(self):
+        self.assertEqual(self.limiter.call('market', self.throttled_method, 2), 'ok')
+        self.assertEqual(self.calls, 3)
+        stats = self.limiter.stats['market']
+        self.assertEqual(stats.throttled, 2)
+        self.assertEqual(stats.requests, 3)
+
+    def test_give_up(self):
+        with self.assertRaises(tinvest.exceptions.TooManyRequestsError):
+            self.limiter.call('market', self.throttled_method, 10)
+        self.assertEqual(self.calls, 4)
+
+    def test_async_retry(self):
+        async def method():
+            return self.throttled_method(1, 'async ok')
+
+        result = asyncio.run(self.limiter.call_async('market', method))
+        self.assertEqual(result, 'async ok')
+        self.assertEqual(self.limiter.stats['market'].throttled, 1)
+
+    def test_quota_is_kept(self):
+        limiter = RateLimiter({'market': 1200})  # 20 в секунду, пачка до 120
+        limiter.buckets['market'] = TokenBucket(1200, capacity=1)
+        start = time.monotonic()
+        for _ in range(5):
+            limiter.call('market', lambda: None)
+        self.assertGreaterEqual(time.monotonic() - start, 0.19)
+        self.assertGreater(limiter.stats['market'].scheduled_wait, 0.19)
+
+
+if __name__ == '__main__':
+    unittest.main()
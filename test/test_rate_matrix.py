@@ -0,0 +1,91 @@
+import os
+import unittest
+from unittest import mock
+
+from datetime import datetime
+from decimal import Decimal
+
+import numpy as np
+
+import rate_matrix
+from database import Database
+
+
+class TestRateMatrix(unittest.TestCase):
+    db_file_name = "assets_matrix_test_db.db"
+    matrix_file_name = "rates_matrix_test.npy"
+
+    @classmethod
+    def setUpClass(self):
+        self.database = Database(self.db_file_name)
+        self.database.put_exchange_rates([
+            (datetime(2020, 12, 30), "USD", "73.8757"),
+            (datetime(2020, 12, 31), "USD", "73.8757"),
+            (datetime(2021, 1, 1), "USD", "73.8757"),
+            # праздники - курса нет до 12 января
+            (datetime(2021, 1, 12), "USD", "74.2726"),
+            (datetime(2021, 1, 12), "EUR", "90.6612"),
+        ])
+
+    @classmethod
+    def tearDownClass(self):
+        self.database.close_database_connection()
+        os.remove(self.db_file_name)
+        for file_name in (self.matrix_file_name, self.matrix_file_name + '.json'):
+            if os.path.isfile(file_name):
+                os.remove(file_name)
+
+    def test_forward_fill(self):
+        matrix = rate_matrix.build(self.database, ["USD", "EUR"], datetime(2021, 1, 5), datetime(2021, 1, 15))
+        self.assertEqual(len(matrix.values), 11)
+        rates = matrix.rates([datetime(2021, 1, 5), datetime(2021, 1, 12), datetime(2021, 1, 15),
+                              datetime(2021, 1, 5)], ["USD", "USD", "EUR", "EUR"])
+        self.assertEqual(list(rates[:3]), [73.8757, 74.2726, 90.6612])
+        # курс евро до периода неизвестен
+        self.assertTrue(np.isnan(rates[3]))
+        with self.assertRaises(KeyError):
+            matrix.day_index([datetime(2021, 1, 16)])
+
+    def test_convert(self):
+        matrix = rate_matrix.build(self.database, ["USD"], datetime(2021, 1, 1), datetime(2021, 1, 31))
+        converted = matrix.convert([Decimal("100.5"), Decimal("-20"), Decimal("1")],
+                                   ["USD", "USD", "CHF"],
+                                   [datetime(2021, 1, 1), datetime(2021, 1, 20), datetime(2021, 1, 20)])
+        self.assertEqual(converted[:2], [Decimal("100.5") * Decimal("73.8757"),
+                                         Decimal("-20") * Decimal("74.2726")])
+        self.assertIsNone(converted[2])
+        self.assertIsInstance(converted[0], Decimal)
+
+    def test_convert_falls_back_when_not_exact(self):
+        matrix = rate_matrix.build(self.database, ["USD"], datetime(2021, 1, 1), datetime(2021, 1, 31))
+        # доли копеек в int64 не пересчитываются - только в Decimal
+        converted = matrix.convert([Decimal("0.001"), Decimal("0.01")], ["USD", "USD"],
+                                   [datetime(2021, 1, 20), datetime(2021, 1, 20)])
+        self.assertEqual(converted, [None, Decimal("0.01") * Decimal("74.2726")])
+
+    def test_saved_matrix_is_memory_mapped(self):
+        date_from, date_to = datetime(2021, 1, 1), datetime(2021, 1, 31)
+        matrix = rate_matrix.get_rate_matrix(self.database, ["USD", "EUR"], date_from, date_to,
+                                             self.matrix_file_name)
+        self.assertIsInstance(matrix.values, np.memmap)
+        self.assertEqual(matrix.rates([datetime(2021, 1, 31)], ["EUR"])[0], 90.6612)
+        # новых курсов нет - используется сохраненная матрица
+        with mock.patch('rate_matrix.build') as build:
+            rate_matrix.get_rate_matrix(self.database, ["USD"], date_from, date_to, self.matrix_file_name)
+            build.assert_not_called()
+            self.database.put_exchange_rate(datetime(2021, 1, 13), "USD", "74.1")
+            rate_matrix.get_rate_matrix(self.database, ["USD"], date_from, date_to, self.matrix_file_name)
+            build.assert_called_once()
+
+    def test_corrected_rate_rebuilds_matrix(self):
+        date_from, date_to = datetime(2021, 1, 1), datetime(2021, 1, 31)
+        rate_matrix.get_rate_matrix(self.database, ["USD"], date_from, date_to, self.matrix_file_name)
+        # курс исправлен на месте - количество курсов в базе то же
+        self.database.put_exchange_rate(datetime(2021, 1, 12), "USD", "74.2727")
+        matrix = rate_matrix.get_rate_matrix(self.database, ["USD"], date_from, date_to, self.matrix_file_name)
+        self.assertEqual(matrix.rates([datetime(2021, 1, 12)], ["USD"])[0], 74.2727)
+        self.database.put_exchange_rate(datetime(2021, 1, 12), "USD", "74.2726")
+
+
+if __name__ == '__main__':
+    unittest.main()
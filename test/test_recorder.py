@@ -0,0 +1,134 @@
+import asyncio
+import os
+import tempfile
+import unittest
+
+from datetime import datetime
+from decimal import Decimal
+
+import tinvest
+
+from recorder import Recorder, ReplayError, request_key
+
+
+class FakeClient:
+
+    def __init__(self):
+        self.calls = 0
+
+    def get_market_orderbook(self, figi, depth=20):
+        self.calls += 1
+        return tinvest.OrderbookResponse(
+            trackingId='test', status='Ok',
+            payload=tinvest.Orderbook(figi=figi, depth=depth, bids=[], asks=[],
+                                      tradeStatus='NormalTrading', minPriceIncrement=0.01,
+                                      lastPrice=100 + self.calls))
+
+    def get_operations(self, from_, to, broker_account_id=None):
+        self.calls += 1
+        return (from_, to, broker_account_id)
+
+    def get_market_search_by_figi(self, figi):
+        raise ValueError(f"unknown figi {figi}")
+
+    async def get_market_candles(self, figi, from_, to, interval):
+        self.calls += 1
+        return [figi, interval]
+
+
+class TestRecorder(unittest.TestCase):
+
+    def setUp(self):
+        self.client = FakeClient()
+        self.file_name = os.path.join(tempfile.mkdtemp(), 'run.pkl.gz')
+
+    def tearDown(self):
+        if os.path.isfile(self.file_name):
+            os.remove(self.file_name)
+
+    def record(self, *calls):
+        recorder = Recorder()
+        recorder.start_recording(self.file_name)
+        results = [recorder.call(None, method, *args, **kwargs) for method, args, kwargs in calls]
+        recorder.save()
+        return results
+
+    def replay(self):
+        recorder = Recorder()
+        recorder.start_replay(self.file_name)
+        return recorder
+
+    def test_request_key(self):
+        # позиционные и именованные аргументы дают один ключ
+        self.assertEqual(request_key(self.client.get_market_orderbook, ('FIGI', 0), {}),
+                         request_key(self.client.get_market_orderbook, (), {'figi': 'FIGI', 'depth': 0}))
+        self.assertNotEqual(request_key(self.client.get_market_orderbook, ('FIGI', 0), {}),
+                            request_key(self.client.get_market_orderbook, ('FIGI', 1), {}))
+        key = request_key(self.client.get_operations, (datetime(2021, 1, 1), Decimal('1.5')), {})
+        self.assertEqual(key, ('get_operations', ('from_', '2021-01-01T00:00:00'), ('to', '1.5')))
+
+    def test_replay(self):
+        recorded = self.record((self.client.get_market_orderbook, ('FIGI',), {'depth': 0}),
+                               (self.client.get_market_orderbook, ('FIGI',), {'depth': 0}))
+        calls = self.client.calls
+        recorder = self.replay()
+        first = recorder.call('market', self.client.get_market_orderbook, figi='FIGI', depth=0)
+        second = recorder.call('market', self.client.get_market_orderbook, 'FIGI', 0)
+        third = recorder.call('market', self.client.get_market_orderbook, 'FIGI', 0)
+        self.assertEqual(self.client.calls, calls)  # API не вызывался
+        # ответы - по порядку записи, после последнего - последний
+        self.assertEqual(first, recorded[0])
+        self.assertEqual(second.payload.last_price, recorded[1].payload.last_price)
+        self.assertEqual(third.payload.last_price, recorded[1].payload.last_price)
+        self.assertIsNot(second, third)
+        self.assertEqual(recorder.replayed, 3)
+        with self.assertRaises(ReplayError):
+            recorder.call('market', self.client.get_market_orderbook, 'OTHER', 0)
+
+    def test_replay_other_dates(self):
+        # запись сделана в другой день - запросы с другими датами находятся по остальным аргументам
+        self.record((self.client.get_operations, (datetime(2021, 1, 1), datetime(2021, 4, 1), '1'), {}),
+                    (self.client.get_operations, (datetime(2021, 4, 1), datetime(2021, 5, 5), '1'), {}))
+        recorder = self.replay()
+        self.assertEqual(recorder.call(None, self.client.get_operations,
+                                       datetime(2021, 1, 1), datetime(2021, 4, 1), '1')[1],
+                         datetime(2021, 4, 1))
+        self.assertEqual(recorder.call(None, self.client.get_operations,
+                                       datetime(2021, 4, 1), datetime(2021, 5, 8), '1')[1],
+                         datetime(2021, 5, 5))
+        with self.assertRaises(ReplayError):
+            recorder.call(None, self.client.get_operations, datetime(2021, 4, 1), datetime(2021, 5, 8), '2')
+
+    def test_replay_exception(self):
+        recorder = Recorder()
+        recorder.start_recording(self.file_name)
+        with self.assertRaises(ValueError):
+            recorder.call(None, self.client.get_market_search_by_figi, 'FIGI')
+        recorder.save()
+        with self.assertRaises(ValueError):
+            self.replay().call(None, self.client.get_market_search_by_figi, 'FIGI')
+
+    def test_async(self):
+        recorder = Recorder()
+        recorder.start_recording(self.file_name)
+        recorded = asyncio.run(recorder.call_async('market', self.client.get_market_candles,
+                                                   'FIGI', datetime(2021, 1, 1), datetime(2021, 1, 2),
+                                                   tinvest.CandleResolution.day))
+        recorder.save()
+        replayed = asyncio.run(self.replay().call_async('market', self.client.get_market_candles,
+                                                        'FIGI', datetime(2021, 1, 1), datetime(2021, 1, 2),
+                                                        tinvest.CandleResolution.day))
+        self.assertEqual(replayed, recorded)
+        self.assertEqual(self.client.calls, 1)
+
+    def test_no_mode(self):
+        # без записи и воспроизведения - обычный вызов
+        recorder = Recorder()
+        recorder.call(None, self.client.get_market_orderbook, 'FIGI')
+        recorder.call(None, self.client.get_market_orderbook, 'FIGI')
+        self.assertEqual(self.client.calls, 2)
+        self.assertFalse(recorder.responses)
+
+
+if __name__ == '__main__':
+    unittest.main()
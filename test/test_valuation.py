@@ -0,0 +1,137 @@
+import os
+import tempfile
+import unittest
+
+from datetime import date, datetime, timedelta, timezone
+from decimal import Decimal
+
+import numpy as np
+import tinvest
+
+import valuation
+from database import Database
+
+msk = timezone(timedelta(hours=3))
+
+
+def operation(day, op_type, payment, currency='RUB', figi=None, quantity=0, price=None, status='Done'):
+    return tinvest.Operation(id=f'{day}{op_type}{payment}', status=status, date=datetime(2021, 3, day, 12, tzinfo=msk),
+                             operationType=op_type, currency=currency, payment=Decimal(payment),
+                             figi=figi, quantityExecuted=quantity, price=price, isMarginCall=False)
+
+
+class TestValuation(unittest.TestCase):
+
+    def setUp(self):
+        self.database = Database(':memory:')
+        self.database.put_exchange_rates([(datetime(2021, 2, 28) + timedelta(days=day), currency, rate)
+                                          for day in range(8)
+                                          for currency, rate in (('RUB', '1'), ('USD', str(70 + day)))])
+        # акция в рублях; облигация в долларах, свечи - в процентах от номинала 1000
+        self.database.put_candles('STOCK', [(datetime(2021, 3, day), 0, 0, 0, 100 + day, 1) for day in (1, 2, 4, 5)])
+        self.database.put_candles('BOND', [(datetime(2021, 3, day), 0, 0, 0, 98 + day / 10, 1) for day in (2, 3, 4)])
+        # API отдает операции от новых к старым
+        self.operations = [
+            operation(5, 'Sell', '208', figi='STOCK', quantity=2, price='104'),
+            operation(4, 'Buy', '-9820', figi='BOND', quantity=10, price='982', status='Decline'),
+            operation(3, 'Buy', '-983', currency='USD', figi='BOND', quantity=1, price='983'),
+            operation(3, 'PayIn', '1000', currency='USD'),
+            operation(2, 'BrokerCommission', '-1'),
+            operation(1, 'Buy', '-505', figi='STOCK', quantity=5, price='101'),
+            operation(1, 'PayIn', '1000'),
+        ]
+
+    def tearDown(self):
+        self.database.close_database_connection()
+
+    def test_trades(self):
+        trades = valuation.Trades(self.operations)
+        self.assertEqual(trades.figis, ['STOCK', 'BOND'])
+        self.assertEqual(trades.currency, {'BOND': 'USD', 'STOCK': 'RUB'})
+        days = np.array([date(2021, 3, day).toordinal() for day in (2, 3, 6)])
+        np.testing.assert_array_equal(trades.holdings(days), [[5, 0], [5, 1], [3, 1]])
+        self.assertEqual(trades.currencies, ['RUB', 'USD'])
+        np.testing.assert_allclose(trades.balances(days), [[494, 0], [494, 17], [702, 17]])
+
+    def test_close_prices(self):
+        candles = self.database.get_candles('STOCK', datetime(2021, 3, 1), datetime(2021, 3, 31))
+        days = np.array([date(2021, 2, 28).toordinal(), date(2021, 3, 3).toordinal(), date(2021, 3, 9).toordinal()])
+        np.testing.assert_array_equal(valuation.close_prices(candles, days), [np.nan, 102, 105])
+
+    def value(self, valuation, day):
+        return valuation.values[(day - valuation.start).days]
+
+    def test_daily_values(self):
+        prefetched = []
+        result = valuation.build_daily_valuation(self.operations, self.database, date(2021, 2, 28),
+                                                 date(2021, 3, 6), prefetch=prefetched.extend)
+        self.assertEqual(len(result.values), 7)
+        self.assertEqual(result.holdings.shape, (7, 2))
+        self.assertEqual(result.values[0], 0)
+        self.assertAlmostEqual(result.values[1], 495 + 5 * 101)
+        # облигация - по цене свечи, пересчитанной из процентов в доллары, и курсу на день оценки
+        self.assertAlmostEqual(self.value(result, date(2021, 3, 3)), 494 + 5 * 102 + (17 + 983) * 73)
+        self.assertAlmostEqual(self.value(result, date(2021, 3, 6)), 702 + 3 * 105 + (17 + 984) * 76)
+        self.assertEqual(result.scales.tolist(), [1.0, 10.0])
+        # свечи запрашиваются с первой сделки, кроме последнего дня
+        self.assertIn(('BOND', datetime(2021, 3, 3)), prefetched)
+        self.assertNotIn(('STOCK', datetime(2021, 3, 6)), prefetched)
+
+    def test_no_candles(self):
+        # бумага без свечей - по цене последней сделки, множитель цен не известен
+        result = valuation.build_daily_valuation([operation(1, 'Buy', '-50', figi='OTHER', quantity=1, price='50')],
+                                                 self.database, date(2021, 3, 1), date(2021, 3, 2))
+        np.testing.assert_allclose(result.values, [0, 0])
+        self.assertTrue(np.isnan(result.scales[0]))
+        self.assertEqual(result.provisional.tolist(), [True, True])
+
+    def test_provisional_days_are_recomputed(self):
+        # на первом запуске свечей облигации нет - дни с ней оценены по цене сделки
+        file_name = os.path.join(tempfile.mkdtemp(), 'valuation_test.npz')
+        operations = [operation(3, 'Buy', '-983', currency='USD', figi='LATE', quantity=1, price='983'),
+                      operation(3, 'PayIn', '1000', currency='USD')]
+        first = valuation.get_daily_valuation(operations, self.database, date(2021, 2, 20), date(2021, 3, 31),
+                                              file_name)
+        self.assertFalse(first.provisional[:11].any())
+        self.assertTrue(first.provisional[11:].all())
+        self.assertAlmostEqual(self.value(first, date(2021, 3, 4)), 1000 * 74)
+        # свечи появились - пересчет с первого приблизительного дня, хотя операции те же
+        self.database.put_candles('LATE', [(datetime(2021, 3, 3), 0, 0, 0, 98.3, 1),
+                                           (datetime(2021, 3, 4), 0, 0, 0, 99.3, 1)])
+        self.assertEqual(valuation.unchanged_days(valuation.DailyValuation.load(file_name), date(2021, 2, 20),
+                                                  valuation.Trades(operations).checksums(first.day_numbers)), 11)
+        second = valuation.get_daily_valuation(operations, self.database, date(2021, 2, 20), date(2021, 3, 31),
+                                               file_name)
+        self.assertAlmostEqual(self.value(second, date(2021, 3, 4)), (17 + 993) * 74)
+        self.assertFalse(second.provisional.any())
+        os.remove(file_name)
+
+    def test_incremental(self):
+        file_name = os.path.join(tempfile.mkdtemp(), 'valuation_test.npz')
+        valuation.get_daily_valuation(self.operations, self.database, date(2021, 2, 1), date(2021, 3, 6), file_name)
+        saved = valuation.DailyValuation.load(file_name)
+        self.assertEqual(saved.figis, ['STOCK', 'BOND'])
+        self.assertEqual(saved.end, date(2021, 3, 6))
+        # сохраненные дни не пересчитываются: метка в начале файла остается
+        saved.values[:20] = -1
+        saved.save(file_name)
+        extended = valuation.get_daily_valuation(self.operations, self.database, date(2021, 2, 1),
+                                                 date(2021, 3, 7), file_name)
+        self.assertEqual(len(extended.values), 35)
+        self.assertEqual(extended.values[:20].tolist(), [-1] * 20)
+        # последние дни пересчитываются всегда
+        self.assertAlmostEqual(self.value(extended, date(2021, 3, 1)), 495 + 5 * 101)
+        # изменилась операция - пересчет с ее дня
+        self.operations[-1] = operation(1, 'PayIn', '2000')
+        self.assertEqual(valuation.unchanged_days(valuation.DailyValuation.load(file_name), date(2021, 2, 1),
+                                                  valuation.Trades(self.operations).checksums(extended.day_numbers)),
+                         (date(2021, 3, 1) - date(2021, 2, 1)).days)
+        # другая дата начала - оценка строится заново
+        rebuilt = valuation.get_daily_valuation(self.operations, self.database, date(2021, 2, 2),
+                                                date(2021, 3, 7), file_name)
+        self.assertEqual(rebuilt.values[:10].tolist(), [0] * 10)
+        os.remove(file_name)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,396 @@
+# Historical portfolio value in RUB
+# Операции счета проигрываются в плотную матрицу позиций день x figi, которая умножается
+# на цены закрытия дневных свечей из локальной базы и курсы ЦБ.
+# Оценка сохраняется в файл - следующий запуск пересчитывает только новые и изменившиеся дни,
+# а также дни, оцененные по неполным данным
+import logging
+import os
+import zlib
+
+from collections import defaultdict
+from datetime import datetime, timedelta
+from enum import Enum
+
+import numpy as np
+
+import rate_matrix
+from currencies import supported_currencies
+
+logger = logging.getLogger("Valuation")
+logger.setLevel(logging.INFO)
+
+valuation_file_name = "valuation_{}.npz"
+file_version = 2
+trade_signs = {'Buy': 1, 'BuyCard': 1, 'Sell': -1}
+# отношение цены сделки к цене свечи, в пределах которого цены считаются в одних единицах;
+# за пределами - свечи в процентах от номинала (облигации)
+same_units = (0.5, 2.0)
+# последние дни сохраненной оценки пересчитываются: свечи и курсы за них могли появиться позже
+recompute_days = 7
+# свечи читаются с запасом до первого пересчитываемого дня - для цены на его начало
+candles_lookback = timedelta(days=30)
+# шаг дней, на которые запрашиваются свечи - загрузка идет периодами, пропуски внутри них не важны
+prefetch_step = 7
+
+
+def _value(field):
+    # str-перечисления tinvest -> строка
+    return field.value if isinstance(field, Enum) else field
+
+
+def _day(date):
+    return datetime(date.year, date.month, date.day).date()
+
+
+class Trades:
+    """Операции счета в виде массивов: сделки с бумагами и движения денег по валютам
+
+    Args:
+        operations (iterable): операции счета из API
+    """
+
+    def __init__(self, operations):
+        figis = {}
+        self.currency = {}  # figi -> валюта бумаги
+        trade_days, trade_figis, quantities, prices = [], [], [], []
+        cash = defaultdict(list)
+        checks = []
+        for operation in operations:
+            day = _day(operation.date).toordinal()
+            # контрольная сумма операции - по ней находится первый день с изменениями в истории
+            checks.append((day, zlib.crc32(f"{operation.id}|{_value(operation.status)}|{operation.payment}|"
+                                           f"{operation.quantity_executed}".encode())))
+            if _value(operation.status) != 'Done':
+                continue
+            currency = _value(operation.currency)
+            if operation.payment:
+                cash[currency].append((day, float(operation.payment)))
+            sign = trade_signs.get(_value(operation.operation_type))
+            if sign is None or not operation.figi or not operation.quantity_executed:
+                continue
+            self.currency.setdefault(operation.figi, currency)
+            trade_days.append(day)
+            trade_figis.append(figis.setdefault(operation.figi, len(figis)))
+            quantities.append(sign * operation.quantity_executed)
+            prices.append(float(operation.price or 0))
+        self.figis = list(figis)
+        # API отдает операции от новых к старым - массивы сделок упорядочиваются по дням
+        order = np.argsort(np.array(trade_days, dtype=np.int64), kind='stable')
+        self.days = np.array(trade_days, dtype=np.int64)[order]
+        self.columns = np.array(trade_figis, dtype=np.int64)[order]
+        self.quantities = np.array(quantities, dtype=np.float64)[order]
+        self.prices = np.array(prices, dtype=np.float64)[order]
+        self.currencies = sorted(cash)
+        self.cash_days = {currency: np.array([day for day, payment in flows], dtype=np.int64)
+                          for currency, flows in cash.items()}
+        self.cash = {currency: np.array([payment for day, payment in flows])
+                     for currency, flows in cash.items()}
+        self.check_days = np.array([day for day, check in checks], dtype=np.int64)
+        self.check_values = np.array([check for day, check in checks], dtype=np.int64)
+
+    def checksums(self, days):
+        """Контрольные суммы операций по дням
+
+        Args:
+            days (numpy.ndarray): номера дней подряд
+
+        Returns:
+            numpy.ndarray: сумма контрольных сумм операций дня; операции до первого дня - в первом
+        """
+        sums = np.zeros(len(days), dtype=np.int64)
+        rows = np.searchsorted(days, self.check_days, side='left')
+        inside = rows < len(days)
+        np.add.at(sums, rows[inside], self.check_values[inside])
+        return sums
+
+    def holdings(self, days):
+        """Количество бумаг на конец каждого дня
+
+        Args:
+            days (numpy.ndarray): возрастающие номера дней (date.toordinal())
+
+        Returns:
+            numpy.ndarray: матрица день x figi в порядке self.figis
+        """
+        matrix = np.zeros((len(days), len(self.figis)))
+        # сделка учитывается с первого дня оценки не раньше дня сделки
+        rows = np.searchsorted(days, self.days, side='left')
+        inside = rows < len(days)
+        np.add.at(matrix, (rows[inside], self.columns[inside]), self.quantities[inside])
+        return np.cumsum(matrix, axis=0)
+
+    def balances(self, days):
+        """Денежные остатки на конец каждого дня - накопленная сумма платежей
+
+        Returns:
+            numpy.ndarray: матрица день x валюта в порядке self.currencies
+        """
+        matrix = np.zeros((len(days), len(self.currencies)))
+        for column, currency in enumerate(self.currencies):
+            rows = np.searchsorted(days, self.cash_days[currency], side='left')
+            inside = rows < len(days)
+            np.add.at(matrix[:, column], rows[inside], self.cash[currency][inside])
+        return np.cumsum(matrix, axis=0)
+
+
+def close_prices(candles, days):
+    """Последняя цена закрытия на конец каждого дня
+
+    Args:
+        candles (numpy.ndarray): свечи с типом database.candle_dtype по возрастанию дат
+        days (numpy.ndarray): номера дней
+
+    Returns:
+        numpy.ndarray: цены, nan - до первой свечи
+    """
+    if not len(candles):
+        return np.full(len(days), np.nan)
+    candle_days = (candles['date'] - np.datetime64('0001-01-01', 'D')).astype(np.int64) + 1
+    index = np.searchsorted(candle_days, days, side='right') - 1
+    return np.where(index >= 0, candles['close'][np.maximum(index, 0)], np.nan)
+
+
+def price_scale(trades, column, closes_on_trades):
+    """Множитель цены свечи до цены в валюте - для облигаций, свечи которых в процентах
+
+    Args:
+        trades (Trades): сделки
+        column (int): номер бумаги в trades.figis
+        closes_on_trades (numpy.ndarray): цены свечей на дни сделок этой бумаги
+
+    Returns:
+        float: множитель, nan - если нет свечей на дни сделок
+    """
+    prices = trades.prices[trades.columns == column]
+    known = (prices > 0) & (closes_on_trades > 0)
+    if not known.any():
+        return np.nan
+    ratio = float(np.median(prices[known] / closes_on_trades[known]))
+    return 1.0 if same_units[0] < ratio < same_units[1] else ratio
+
+
+def _rates(database, currencies, days):
+    # курсы ЦБ по дням из матрицы курсов и дни, на которые курс подставлен:
+    # до первого известного курса - первый известный
+    matrix = rate_matrix.build(database, currencies, datetime.fromordinal(int(days[0])),
+                               datetime.fromordinal(int(days[-1])))
+    rates, estimated = {}, {}
+    for column, currency in enumerate(matrix.currencies):
+        values = np.array(matrix.values[:, column])
+        known = np.flatnonzero(~np.isnan(values))
+        if not len(known):
+            logger.warning(f"No CB rates for {currency} in the local database")
+            continue
+        values[:known[0]] = values[known[0]]
+        rates[currency] = values
+        estimated[currency] = np.arange(len(values)) < known[0]
+    return rates, estimated
+
+
+def _prices(trades, column, days, database, scale=np.nan):
+    # цены бумаги в валюте по дням, множитель цен свечей
+    # и дни, на которые цена приблизительная: множитель не известен или цена сделки вместо свечи
+    figi = trades.figis[column]
+    trade_days = trades.days[trades.columns == column]
+    trade_prices = trades.prices[trades.columns == column]
+    # без сохраненного множителя свечи нужны с первой сделки - для сверки цен
+    first = days[0] - candles_lookback.days if np.isfinite(scale) else min(days[0], trade_days[0])
+    candles = database.get_candles(figi, datetime.fromordinal(int(first)), datetime.fromordinal(int(days[-1])))
+    if not len(candles):
+        logger.warning(f"No candles for {figi} in the local database, using trade prices")
+    if not np.isfinite(scale):
+        scale = price_scale(trades, column, close_prices(candles, trade_days))
+    # множитель не известен - в оценке цены свечей без пересчета, в файле - nan до следующего запуска
+    prices = close_prices(candles, days) * (scale if np.isfinite(scale) else 1.0)
+    # до первой свечи - цена последней сделки
+    last_trade = np.searchsorted(trade_days, days, side='right') - 1
+    fallback = np.where(last_trade >= 0, trade_prices[np.maximum(last_trade, 0)], 0.0)
+    estimated = np.isnan(prices) | (not np.isfinite(scale))
+    return np.where(np.isnan(prices), fallback, prices), scale, estimated
+
+
+class DailyValuation:
+    """Стоимость портфеля по дням: строка - день начиная со start
+
+    Args:
+        start (date): первый день
+        figis (list): столбцы матрицы позиций
+        holdings (numpy.ndarray): количество бумаг на конец дня, день x figi
+        scales (numpy.ndarray): множители цен свечей по figi, см. price_scale(); nan - не известен
+        currencies (list): столбцы матрицы денежных остатков
+        cash (numpy.ndarray): денежные остатки на конец дня, день x валюта
+        values (numpy.ndarray): стоимость портфеля в рублях на конец дня
+        checksums (numpy.ndarray): контрольные суммы операций по дням, см. Trades.checksums()
+        provisional (numpy.ndarray, optional): дни, оцененные по неполным данным (множитель цен
+            не известен, цена сделки вместо свечи, нет курса) - следующий запуск их пересчитывает
+    """
+
+    def __init__(self, start, figis, holdings, scales, currencies, cash, values, checksums, provisional=None):
+        self.start = _day(start)
+        self.figis = list(figis)
+        self.holdings = holdings
+        self.scales = scales
+        self.currencies = list(currencies)
+        self.cash = cash
+        self.values = values
+        self.checksums = checksums
+        self.provisional = np.zeros(len(values), dtype=bool) if provisional is None else provisional
+
+    @property
+    def end(self):
+        return self.start + timedelta(days=len(self.values) - 1)
+
+    @property
+    def day_numbers(self):
+        return np.arange(self.start.toordinal(), self.start.toordinal() + len(self.values))
+
+    @property
+    def days(self):
+        return [self.start + timedelta(days=day) for day in range(len(self.values))]
+
+    def save(self, file_name):
+        # запись во временный файл - прерванный запуск не портит сохраненную оценку
+        with open(file_name + '.tmp', 'wb') as npz_file:
+            np.savez_compressed(npz_file, version=file_version, start=self.start.toordinal(),
+                                figis=np.array(self.figis, dtype=str), holdings=self.holdings,
+                                scales=self.scales, currencies=np.array(self.currencies, dtype=str),
+                                cash=self.cash, values=self.values, checksums=self.checksums,
+                                provisional=self.provisional)
+        os.replace(file_name + '.tmp', file_name)
+
+    @classmethod
+    def load(cls, file_name):
+        """Читает сохраненную оценку
+
+        Returns:
+            DailyValuation: оценка или None, если файла нет или он другой версии
+        """
+        if not os.path.isfile(file_name):
+            return None
+        try:
+            with np.load(file_name, allow_pickle=False) as data:
+                if int(data['version']) != file_version:
+                    logger.info(f"Valuation {file_name} has another version, it will be rebuilt")
+                    return None
+                return cls(datetime.fromordinal(int(data['start'])), data['figis'].tolist(), data['holdings'],
+                           data['scales'], data['currencies'].tolist(), data['cash'], data['values'],
+                           data['checksums'], data['provisional'])
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"Valuation {file_name} is broken: {e!r}")
+            return None
+
+
+def unchanged_days(saved, start, checksums):
+    """Сколько первых дней сохраненной оценки можно не пересчитывать
+
+    Args:
+        saved (DailyValuation): оценка предыдущего запуска или None
+        start (date): первый день новой оценки
+        checksums (numpy.ndarray): контрольные суммы операций по дням новой оценки
+
+    Returns:
+        int: дни до первого дня с изменившимися операциями или оцененного по неполным данным,
+            без последних recompute_days
+    """
+    if saved is None or saved.start != _day(start):
+        return 0
+    days = min(len(saved.values), len(checksums))
+    changed = np.flatnonzero((saved.checksums[:days] != checksums[:days]) | saved.provisional[:days])
+    days = changed[0] if len(changed) else days
+    return int(max(0, min(days, len(saved.values) - recompute_days)))
+
+
+def build_daily_valuation(operations, database, date_from, date_to, saved=None, prefetch=None):
+    """Стоимость портфеля в рублях по курсу ЦБ на конец каждого дня периода
+
+    Цены бумаг - закрытие последней дневной свечи в локальной базе на этот день или раньше;
+    бумаги без свечей оцениваются по цене последней сделки.
+    Дни saved до первого дня с изменившимися операциями или оцененного по неполным данным
+    (и без последних recompute_days) не пересчитываются.
+
+    Args:
+        operations (iterable): операции счета из API
+        database (Database): база со свечами и курсами
+        date_from (date): первый день
+        date_to (date): последний день (включительно)
+        saved (DailyValuation, optional): оценка предыдущего запуска
+        prefetch (callable, optional): загрузка свечей в базу: prefetch([(figi, дата), ...])
+
+    Returns:
+        DailyValuation: оценка
+    """
+    start = _day(date_from)
+    days = np.arange(start.toordinal(), _day(date_to).toordinal() + 1)
+    trades = Trades(operations)
+    checksums = trades.checksums(days)
+    holdings = trades.holdings(days)
+    cash = trades.balances(days)
+    first = unchanged_days(saved, start, checksums)
+    values = np.zeros(len(days))
+    provisional = np.zeros(len(days), dtype=bool)
+    saved_scales = {}
+    if first:
+        values[:first] = saved.values[:first]
+        saved_scales = dict(zip(saved.figis, saved.scales.tolist()))
+    scales = np.array([saved_scales.get(figi, np.nan) for figi in trades.figis])
+    tail = days[first:]
+    if not len(tail):
+        return DailyValuation(start, trades.figis, holdings, scales, trades.currencies, cash, values, checksums,
+                              provisional)
+
+    held = np.flatnonzero(holdings[first:].any(axis=0))
+    if prefetch is not None and len(held):
+        # свечи за последний день еще могут измениться - он не запрашивается
+        history_dates = []
+        for column in held:
+            in_tail = tail[:-1][holdings[first:-1, column] != 0][::prefetch_step].tolist()
+            in_tail += trades.days[trades.columns == column][:1].tolist()
+            history_dates += [(trades.figis[column], datetime.fromordinal(day)) for day in in_tail]
+        prefetch(history_dates)
+
+    currencies = {trades.currency[trades.figis[column]] for column in held} | set(trades.currencies)
+    rates, estimated = _rates(database, [currency for currency in supported_currencies if currency in currencies],
+                              tail)
+    for column in held:
+        figi = trades.figis[column]
+        currency = trades.currency[figi]
+        in_portfolio = holdings[first:, column] != 0
+        if currency not in rates:
+            logger.warning(f"Unsupported currency {currency} of {figi}, position is not valued")
+            if currency in supported_currencies:
+                provisional[first:] |= in_portfolio  # курсов еще нет в базе
+            continue
+        prices, scales[column], estimated_prices = _prices(trades, column, tail, database, scales[column])
+        values[first:] += holdings[first:, column] * prices * rates[currency]
+        provisional[first:] |= in_portfolio & (estimated_prices | estimated[currency])
+    for column, currency in enumerate(trades.currencies):
+        in_portfolio = cash[first:, column] != 0
+        if currency not in rates:
+            logger.warning(f"Unsupported currency {currency}, cash is not valued")
+            if currency in supported_currencies:
+                provisional[first:] |= in_portfolio
+            continue
+        values[first:] += cash[first:, column] * rates[currency]
+        provisional[first:] |= in_portfolio & estimated[currency]
+    logger.info(f"{len(tail)} of {len(days)} days valued, {first} days taken from the saved valuation, "
+                f"{np.count_nonzero(provisional)} days valued with incomplete data")
+    return DailyValuation(start, trades.figis, holdings, scales, trades.currencies, cash, values, checksums,
+                          provisional)
+
+
+def get_daily_valuation(operations, database, date_from, date_to, file_name=None, prefetch=None):
+    """Возвращает оценку портфеля по дням: сохраненную и дополненную новыми днями
+
+    Args:
+        file_name (str, optional): файл оценки; None - не сохранять
+        остальные - см. build_daily_valuation()
+
+    Returns:
+        DailyValuation: оценка
+    """
+    saved = DailyValuation.load(file_name) if file_name else None
+    logger.info('valuing portfolio by days..')
+    valuation = build_daily_valuation(operations, database, date_from, date_to, saved, prefetch)
+    if file_name:
+        valuation.save(file_name)
+    return valuation